@@ -0,0 +1,427 @@
+"""
+An asyncio NBD client.
+
+This client goes through the same handshake as PythonNbdClient, whose steps
+python_nbd_client implements without any I/O, and only sends and receives
+their bytes asynchronously. In the transmission phase, instead of blocking
+on its socket, it multiplexes any number of concurrent requests over one
+connection: every request is sent immediately, and a single receiver task
+matches the replies to the waiting requests by their handles.
+The TLS upgrade uses StreamWriter.start_tls, which requires Python 3.11.
+"""
+
+import asyncio
+import socket
+import struct
+import logging
+
+from python_nbd_client import (
+    NBD_CMD_BLOCK_STATUS,
+    NBD_CMD_DISC,
+    NBD_CMD_FLUSH,
+    NBD_CMD_READ,
+    NBD_CMD_WRITE,
+    NBD_CMD_WRITE_ZEROES,
+    NBD_FLAG_SEND_FLUSH,
+    NBD_OPT_LIST_META_CONTEXT,
+    NBD_OPT_SET_META_CONTEXT,
+    NBD_SIMPLE_REPLY_MAGIC,
+    NBD_STRUCTURED_REPLY_MAGIC,
+    NBDEOFError,
+    NBDProtocolError,
+    NBDTransmissionError,
+    NBDUnexpectedReplyHandleError,
+    abort_option,
+    check_alignment,
+    encode_request,
+    export_name_option,
+    fixed_newstyle_greeting,
+    info_option,
+    is_error_chunk,
+    is_final_structured_reply_chunk,
+    make_tls_context,
+    meta_context_option,
+    oldstyle_greeting,
+    parse_structured_reply_header,
+    parse_structured_reply_payload,
+    starttls_option,
+    structured_reply_option,
+)
+
+LOGGER = logging.getLogger('async_nbd_client')
+
+
+class _Request(object):
+    """
+    An in-flight request waiting for its reply.
+    """
+    def __init__(self, request_type, length, future):
+        self.request_type = request_type
+        self.length = length
+        self.future = future
+        self.chunks = []
+
+
+class AsyncNbdClient(object):
+    """
+    An asyncio NBD client. Use AsyncNbdClient.open to create a connection.
+
+    Any number of coroutines may issue requests on the same client
+    concurrently, in the transmission phase each of them only waits for its
+    own reply.
+    """
+
+    def __init__(self, reader, writer, timeout):
+        self._reader = reader
+        self._writer = writer
+        self._timeout = timeout
+        self._flushed = True
+        self._closed = False
+        self._handle = 0
+        self._structured_reply = False
+        self._transmission_phase = False
+        self._pending = {}
+        self._receiver = None
+
+    @classmethod
+    async def open(cls,
+                   address,
+                   exportname="",
+                   port=10809,
+                   timeout=60,
+                   subject=None,
+                   cert=None,
+                   use_tls=True,
+                   new_style_handshake=True,
+                   unix=False,
+                   connect=True):
+        """
+        Connects to the server and performs the handshake. Takes the same
+        arguments as the PythonNbdClient constructor.
+        """
+        LOGGER.info("Creating connection to address '%s' and port '%s'",
+                    address, port)
+        if unix:
+            opening = asyncio.open_unix_connection(address)
+        else:
+            opening = asyncio.open_connection(address, int(port))
+        (reader, writer) = await asyncio.wait_for(opening, timeout)
+        if not unix:
+            writer.get_extra_info('socket').setsockopt(
+                socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        client = cls(reader=reader, writer=writer, timeout=timeout)
+        try:
+            if new_style_handshake:
+                await client._fixed_new_style_handshake(
+                    cert=cert,
+                    subject=subject,
+                    use_tls=use_tls)
+                if connect:
+                    await client.connect(exportname=exportname)
+            else:
+                await client._old_style_handshake()
+        except BaseException:
+            writer.close()
+            raise
+        return client
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def close(self):
+        """
+        Sends a flush request to the server if necessary and the server
+        supports it, followed by a disconnect request.
+        """
+        if self._closed:
+            return
+        try:
+            if self._transmission_phase and (not self._flushed):
+                await self.flush()
+            await self._disconnect()
+        finally:
+            self._closed = True
+            if self._receiver is not None:
+                self._receiver.cancel()
+            self._writer.close()
+
+    async def _recvall(self, length):
+        try:
+            return await asyncio.wait_for(
+                self._reader.readexactly(length), self._timeout)
+        except asyncio.IncompleteReadError as exc:
+            raise NBDEOFError from exc
+
+    async def _send(self, data):
+        self._writer.write(data)
+        await self._writer.drain()
+
+    # Handshake phase
+
+    async def _negotiate(self, step):
+        """
+        Runs the given step of the handshake of python_nbd_client on the
+        connection, and returns its result, like PythonNbdClient._negotiate.
+        """
+        try:
+            request = next(step)
+            while True:
+                if isinstance(request, int):
+                    request = step.send(await self._recvall(request))
+                else:
+                    await self._send(request)
+                    request = step.send(None)
+        except StopIteration as stop:
+            return stop.value
+
+    #  Newstyle handshake
+
+    async def _upgrade_socket_to_tls(self, cert, subject):
+        context = make_tls_context(cert=cert, subject=subject)
+        await asyncio.wait_for(
+            self._writer.start_tls(context, server_hostname=subject),
+            self._timeout)
+
+    async def request_info(self, export_name, info_requests):
+        """Query information from the server."""
+        return await self._negotiate(info_option(export_name, info_requests))
+
+    async def negotiate_structured_reply(self):
+        """
+        Negotiate use of the structured reply extension, fail if unsupported.
+        Only valid during the handshake phase.
+        """
+        await self._negotiate(structured_reply_option())
+        self._structured_reply = True
+
+    async def set_meta_contexts(self, export_name, queries):
+        """
+        Change the set of active metadata contexts. Only valid during the
+        handshake phase. Returns the list of selected metadata contexts as
+        (metadata context ID, metadata context name) pairs.
+        Structured replies must be negotiated first using
+        negotiate_structured_reply.
+        """
+        return await self._negotiate(meta_context_option(
+            option=NBD_OPT_SET_META_CONTEXT,
+            export_name=export_name,
+            queries=queries))
+
+    async def list_meta_contexts(self, export_name, queries):
+        """
+        Return the metadata contexts available on the export matching one or
+        more of the queries as (metadata context ID, metadata context name)
+        pairs.
+        Structured replies be negotiated first using
+        negotiate_structured_reply.
+        """
+        return await self._negotiate(meta_context_option(
+            option=NBD_OPT_LIST_META_CONTEXT,
+            export_name=export_name,
+            queries=queries))
+
+    async def _fixed_new_style_handshake(self, cert, subject, use_tls):
+        await self._negotiate(fixed_newstyle_greeting())
+        if use_tls:
+            # start TLS negotiation
+            await self._negotiate(starttls_option())
+            # upgrade socket to TLS
+            await self._upgrade_socket_to_tls(cert, subject)
+
+    async def connect(self, exportname):
+        """
+        Valid only during the handshake phase. Requests the given
+        export and enters the transmission phase.
+        """
+        (self._size, self._transmission_flags) = await self._negotiate(
+            export_name_option(exportname))
+        self._enter_transmission_phase()
+        LOGGER.debug("Connected")
+
+    #  Oldstyle handshake
+
+    async def _old_style_handshake(self):
+        (self._size, self._transmission_flags) = await self._negotiate(
+            oldstyle_greeting())
+        self._enter_transmission_phase()
+
+    # Transmission phase
+
+    def _enter_transmission_phase(self):
+        self._transmission_phase = True
+        self._receiver = asyncio.ensure_future(self._receive_replies())
+
+    async def _receive_replies(self):
+        """
+        Receives the replies sent by the server and completes the futures of
+        the requests they belong to, until the connection fails or closes.
+        """
+        try:
+            while True:
+                magic = await self._reader.readexactly(4)
+                magic = struct.unpack(">L", magic)[0]
+                if magic == NBD_SIMPLE_REPLY_MAGIC:
+                    await self._receive_simple_reply()
+                elif magic == NBD_STRUCTURED_REPLY_MAGIC:
+                    await self._receive_structured_reply_chunk()
+                else:
+                    raise NBDProtocolError(
+                        'Invalid reply magic: 0x{:x}'.format(magic))
+        except asyncio.CancelledError:
+            raise
+        except Exception as exc:
+            if isinstance(exc, asyncio.IncompleteReadError):
+                exc = NBDEOFError()
+            for request in self._pending.values():
+                if not request.future.done():
+                    request.future.set_exception(exc)
+            self._pending.clear()
+
+    def _pop_request(self, handle, final):
+        request = self._pending.get(handle)
+        if request is None:
+            raise NBDUnexpectedReplyHandleError(
+                expected=sorted(self._pending), received=handle)
+        if final:
+            del self._pending[handle]
+        return request
+
+    async def _receive_simple_reply(self):
+        reply = await self._reader.readexactly(4 + 8)
+        (errno, handle) = struct.unpack(">LQ", reply)
+        LOGGER.debug("NBD simple reply errno='%d' handle='%d'",
+                     errno, handle)
+        request = self._pop_request(handle, final=True)
+        data_length = 0
+        if request.request_type == NBD_CMD_READ:
+            data_length = request.length
+        data = await self._reader.readexactly(data_length)
+        if request.future.done():
+            return
+        if errno != 0:
+            request.future.set_exception(NBDTransmissionError(errno))
+        else:
+            request.future.set_result(data)
+
+    async def _receive_structured_reply_chunk(self):
+        reply = await self._reader.readexactly(2 + 2 + 8 + 4)
+        fields = parse_structured_reply_header(reply)
+        LOGGER.debug("NBD structured reply flags='%s' reply_type='%d' "
+                     "handle='%d' data_length='%d'",
+                     fields['flags'], fields['reply_type'],
+                     fields['handle'], fields['data_length'])
+        final = is_final_structured_reply_chunk(flags=fields['flags'])
+        request = self._pop_request(fields['handle'], final=final)
+        payload = await self._reader.readexactly(fields['data_length'])
+        parse_structured_reply_payload(fields, payload)
+        request.chunks.append(fields)
+        if final and not request.future.done():
+            request.future.set_result(request.chunks)
+
+    async def _request(self, request_type, offset, length, data=b''):
+        """
+        Sends a request and waits for its reply: the data of a simple reply,
+        or the list of chunks of a structured reply.
+        """
+        if self._receiver is not None and self._receiver.done():
+            raise NBDEOFError
+        LOGGER.debug("NBD request offset=%d length=%d", offset, length)
+        self._handle += 1
+        handle = self._handle
+        header = encode_request(request_type, handle, offset, length)
+        future = asyncio.get_running_loop().create_future()
+        self._pending[handle] = _Request(request_type, length, future)
+        # A single write keeps the header and its payload together when
+        # several coroutines send requests concurrently:
+        await self._send(header + data if data else header)
+        return await asyncio.wait_for(future, self._timeout)
+
+    async def _simple_request(self, request_type, offset, length, data=b''):
+        reply = await self._request(request_type, offset, length, data)
+        if isinstance(reply, list):
+            # The server MAY respond with a structured reply, e.g. to report
+            # errors:
+            for chunk in reply:
+                if is_error_chunk(chunk['reply_type']):
+                    raise NBDTransmissionError(chunk['error'])
+
+    async def write(self, data, offset):
+        """
+        Writes the given bytes to the export, starting at the given
+        offset.
+        """
+        LOGGER.debug("NBD_CMD_WRITE")
+        check_alignment("offset", offset)
+        check_alignment("size", len(data))
+        self._flushed = False
+        await self._simple_request(NBD_CMD_WRITE, offset, len(data), data)
+        return len(data)
+
+    async def write_zeroes(self, offset, length):
+        """
+        Writes the given number of zeroes to the export, starting at the given
+        offset.
+        """
+        LOGGER.debug("NBD_CMD_WRITE_ZEROES")
+        check_alignment("offset", offset)
+        check_alignment("length", length)
+        self._flushed = False
+        await self._simple_request(NBD_CMD_WRITE_ZEROES, offset, length)
+        return length
+
+    async def read(self, offset, length):
+        """
+        Returns length number of bytes read from the export, starting at
+        the given offset.
+        If structured replies have been negotiated, it returns the list of the
+        reply chunks instead.
+        """
+        LOGGER.debug("NBD_CMD_READ")
+        check_alignment("offset", offset)
+        check_alignment("length", length)
+        return await self._request(NBD_CMD_READ, offset, length)
+
+    def _need_flush(self):
+        return self._transmission_flags & NBD_FLAG_SEND_FLUSH != 0
+
+    async def flush(self):
+        """
+        Sends a flush request to the server if the server supports it
+        and there are unflushed writes. This causes all completed writes
+        (the writes for which the server has already sent a reply to the
+        client) to be written to permanent storage.
+        """
+        if self._need_flush() is False:
+            self._flushed = True
+            return False
+        LOGGER.debug("NBD_CMD_FLUSH")
+        await self._simple_request(NBD_CMD_FLUSH, 0, 0)
+        self._flushed = True
+        return True
+
+    async def query_block_status(self, offset, length):
+        """
+        Query block status in the range defined by length and offset.
+        Returns a list of structured reply chunks.
+        The required meta contexts must have been negotiated using
+        set_meta_contexts.
+        """
+        LOGGER.debug("NBD_CMD_BLOCK_STATUS")
+        return await self._request(NBD_CMD_BLOCK_STATUS, offset, length)
+
+    async def _disconnect(self):
+        if self._transmission_phase:
+            LOGGER.debug("NBD_CMD_DISC")
+            self._handle += 1
+            await self._send(encode_request(NBD_CMD_DISC, self._handle, 0, 0))
+        else:
+            await self._negotiate(abort_option())
+
+    def get_size(self):
+        """
+        Return the size of the device in bytes.
+        """
+        return self._size
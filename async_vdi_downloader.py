@@ -0,0 +1,340 @@
+"""
+Code for backing up many VDIs concurrently from a single asyncio event loop.
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import os
+import threading
+
+from async_nbd_client import AsyncNbdClient
+from cbt_bitmap import CbtBitmap
+from output_sink import open_output, pwrite_all, punch_hole
+from python_nbd_client import (
+    DEFAULT_MAX_IN_FLIGHT,
+    NBD_REPLY_TYPE_OFFSET_DATA,
+    NBD_REPLY_TYPE_OFFSET_HOLE,
+    NBDOptionError,
+    NBDTransmissionError,
+    is_error_chunk,
+)
+from sparse_file import copy_sparse_file
+from vdi_downloader import get_nbd_info
+
+# The memory that the blocks being transferred may take up, shared by all the
+# transfers
+DEFAULT_MAX_BUFFERED_BYTES = 256 * 1024 * 1024
+
+
+def _punch_hole(fd, fresh_from, offset, length):
+    """
+    Makes the given range of the output file read back as zeroes. Nothing
+    needs to be done for the part of the range beyond fresh_from, the
+    original size of the file, which is still part of its sparse extension.
+    """
+    length = min(length, fresh_from - offset)
+    if length > 0:
+        punch_hole(fd, offset, length)
+
+
+class AsyncVdiDownloader(object):
+    """
+    The asyncio counterpart of VdiDownloader: provides a way of backing up the
+    data of a VDI incrementally to a file or downloading it completely, with
+    any number of such transfers running concurrently on one event loop.
+
+    Memory use is bounded by max_buffered_bytes, shared by all transfers, and
+    at most max_transfers NBD connections are open at the same time.
+
+    If structured_reply is True and the server supports it, the structured
+    reply extension is negotiated, and the ranges that the server reports as
+    holes are not transferred, but are left sparse in the output file, as
+    VdiDownloader does. Unlike VdiDownloader, each VDI is transferred over
+    a single connection with a fixed request size, the allocation of full
+    backups is not mapped beforehand, the changed extents are not
+    coalesced, and the received zero blocks are written.
+    """
+    # Calls to the XenAPI session are blocking and the session is not safe to
+    # use from several threads at once, so they are serialized on a single
+    # worker thread. The disk writes run on a separate thread pool.
+
+    def __init__(self,
+                 session,
+                 block_size,
+                 use_tls=True,
+                 max_in_flight=DEFAULT_MAX_IN_FLIGHT,
+                 max_transfers=64,
+                 max_buffered_bytes=DEFAULT_MAX_BUFFERED_BYTES,
+                 io_threads=8,
+                 structured_reply=True):
+        self._session = session
+        self._block_size = block_size
+        self._use_tls = use_tls
+        self._max_in_flight = max_in_flight
+        self._structured_reply = structured_reply
+        self._transfers = asyncio.Semaphore(max_transfers)
+        self._buffers = asyncio.Semaphore(
+            max(1, max_buffered_bytes // block_size))
+        self._xenapi_executor = ThreadPoolExecutor(max_workers=1)
+        self._io_executor = ThreadPoolExecutor(max_workers=io_threads)
+        self._copy_reports = []
+
+    def pop_copy_reports(self):
+        """
+        Returns the reports of the copies of the previous backups made by
+        the incremental backups since the last call, see
+        sparse_file.copy_sparse_file, and forgets them.
+        """
+        (reports, self._copy_reports) = (self._copy_reports, [])
+        return reports
+
+    def close(self):
+        """
+        Shuts down the worker threads used for XenAPI calls and disk writes.
+        """
+        self._xenapi_executor.shutdown()
+        self._io_executor.shutdown()
+
+    async def _xenapi(self, function, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._xenapi_executor, function, *args)
+
+    async def _io(self, function, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._io_executor, function, *args)
+
+    async def _nbd_client(self, vdi_nbd_server_info):
+        """
+        Connect using the given NBD server details and return the NBD client.
+        """
+        nbd_client = await AsyncNbdClient.open(
+            **vdi_nbd_server_info, use_tls=self._use_tls, connect=False)
+        try:
+            if self._structured_reply:
+                try:
+                    await nbd_client.negotiate_structured_reply()
+                except NBDOptionError:
+                    # Fall back to simple replies
+                    pass
+            await nbd_client.connect(
+                exportname=vdi_nbd_server_info['exportname'])
+        except BaseException:
+            await nbd_client.close()
+            raise
+        return nbd_client
+
+    def _split_into_blocks(self, extents):
+        for (offset, length) in extents:
+            end = offset + length
+            for current_offset in range(offset, end, self._block_size):
+                block_length = min(self._block_size, end - current_offset)
+                yield (current_offset, block_length)
+
+    async def _download_block(self, nbd_client, fd, fresh_from, offset,
+                              length):
+        reply = await nbd_client.read(offset=offset, length=length)
+        if not isinstance(reply, list):
+            await self._io(pwrite_all, fd, reply, offset)
+            return
+        # The data chunks of a structured reply are written, and the holes
+        # reported by the server are left sparse:
+        for chunk in reply:
+            reply_type = chunk['reply_type']
+            if reply_type == NBD_REPLY_TYPE_OFFSET_DATA:
+                await self._io(
+                    pwrite_all, fd, chunk['data'], chunk['offset'])
+            elif reply_type == NBD_REPLY_TYPE_OFFSET_HOLE:
+                await self._io(_punch_hole, fd, fresh_from, chunk['offset'],
+                               chunk['hole_size'])
+            elif is_error_chunk(reply_type=reply_type):
+                raise NBDTransmissionError(chunk['error'])
+
+    async def _download_nbd_extents(self, nbd_client, extents, fd,
+                                    fresh_from):
+        """
+        Write the given extents to the output file using positional writes,
+        with at most max_in_flight blocks requested at the same time. The
+        output file was extended from its original size fresh_from.
+        """
+        in_flight = asyncio.Semaphore(self._max_in_flight)
+        tasks = set()
+        failed = []
+
+        def _done(task):
+            tasks.discard(task)
+            in_flight.release()
+            self._buffers.release()
+            if not task.cancelled() and task.exception() is not None:
+                failed.append(task.exception())
+
+        try:
+            for (offset, length) in self._split_into_blocks(extents):
+                await in_flight.acquire()
+                await self._buffers.acquire()
+                if failed:
+                    in_flight.release()
+                    self._buffers.release()
+                    break
+                task = asyncio.ensure_future(self._download_block(
+                    nbd_client=nbd_client, fd=fd, fresh_from=fresh_from,
+                    offset=offset, length=length))
+                tasks.add(task)
+                task.add_done_callback(_done)
+            await asyncio.gather(*tasks, return_exceptions=True)
+        finally:
+            for task in list(tasks):
+                task.cancel()
+        if failed:
+            raise failed[0]
+
+    async def _download(self, vdi_nbd_server_info, out_file, extents=None):
+        """
+        Downloads the given extents of the network block device, or all of
+        it if extents is None, into the output file.
+        """
+        async with self._transfers:
+            nbd_client = await self._nbd_client(vdi_nbd_server_info)
+            async with nbd_client:
+                size = nbd_client.get_size()
+                (fd, fresh_from) = open_output(path=out_file, size=size)
+                try:
+                    if extents is None:
+                        extents = [(0, size)]
+                    await self._download_nbd_extents(
+                        nbd_client=nbd_client, extents=extents, fd=fd,
+                        fresh_from=fresh_from)
+                finally:
+                    os.close(fd)
+
+    async def incremental_vdi_backup(self, vdi, latest_backup, output_file,
+                                     bitmap=None, copy_base=True):
+        """
+        Downloads the blocks that changed between this VDI and the base VDI
+        and constructs a file containing this VDI's data.
+        The latest_backup argument should be a tuple (base_vdi, base_vdi_data),
+        where base_vdi_data is the file containing the data of base_vdi.
+        As for VdiDownloader.incremental_vdi_backup, the CbtBitmap of the two
+        VDIs is fetched unless it is given, and base_vdi_data is not copied
+        if copy_base is False.
+        """
+        (vdi_from, vdi_from_backup) = latest_backup
+        if bitmap is None:
+            bitmap = CbtBitmap(await self._xenapi(
+                self._session.xenapi.VDI.list_changed_blocks, vdi_from, vdi))
+        nbd_info = await self._xenapi(get_nbd_info, self._session, vdi)
+        if copy_base:
+            self._copy_reports.append(await self._io(
+                copy_sparse_file, vdi_from_backup, output_file))
+        await self._download(
+            vdi_nbd_server_info=nbd_info,
+            out_file=output_file,
+            extents=bitmap.get_extents())
+
+    async def full_vdi_backup(self, vdi, output_file):
+        """
+        Downloads the data of the VDI to the given output file.
+        """
+        nbd_info = await self._xenapi(get_nbd_info, self._session, vdi)
+        await self._download(vdi_nbd_server_info=nbd_info, out_file=output_file)
+
+
+class ThreadedAsyncVdiDownloader(object):
+    """
+    Runs an AsyncVdiDownloader, created with the given arguments, on an
+    event loop in a thread of its own, and offers the blocking interface of
+    VdiDownloader to any number of threads. The VDIs that these threads
+    back up at the same time are all transferred by this one event loop, and
+    share its limits on connections and buffered blocks.
+
+    The reports are kept for each calling thread. The ones of the features
+    of VdiDownloader that AsyncVdiDownloader lacks are always empty.
+    """
+
+    def __init__(self, **kwargs):
+        self._downloader = AsyncVdiDownloader(**kwargs)
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(
+            target=self._loop.run_forever, daemon=True)
+        self._thread.start()
+        self._local = threading.local()
+
+    def _run(self, coroutine):
+        """
+        Runs the given coroutine on the event loop, and waits for its result.
+        """
+        return asyncio.run_coroutine_threadsafe(
+            coroutine, self._loop).result()
+
+    def _copy_reports(self):
+        if not hasattr(self._local, 'copy_reports'):
+            self._local.copy_reports = []
+        return self._local.copy_reports
+
+    def full_vdi_backup(self, vdi, output_file):
+        """
+        See AsyncVdiDownloader.full_vdi_backup.
+        """
+        self._run(self._downloader.full_vdi_backup(
+            vdi=vdi, output_file=output_file))
+
+    def incremental_vdi_backup(self, vdi, latest_backup, output_file,
+                               bitmap=None, copy_base=True):
+        """
+        See AsyncVdiDownloader.incremental_vdi_backup. The previous backup is
+        copied by the calling thread, so that its report is kept with the
+        thread's reports.
+        """
+        if copy_base:
+            self._copy_reports().append(
+                copy_sparse_file(latest_backup[1], output_file))
+        self._run(self._downloader.incremental_vdi_backup(
+            vdi=vdi,
+            latest_backup=latest_backup,
+            output_file=output_file,
+            bitmap=bitmap,
+            copy_base=False))
+
+    def pop_copy_reports(self):
+        """
+        Returns the reports of the copies of the previous backups made by
+        the incremental backups of the calling thread since its last call,
+        see sparse_file.copy_sparse_file, and forgets them.
+        """
+        reports = self._copy_reports()
+        self._local.copy_reports = []
+        return reports
+
+    def pop_block_size_reports(self):
+        """
+        Returns an empty list, the request size is not tuned.
+        """
+        return []
+
+    def pop_coalescing_reports(self):
+        """
+        Returns an empty list, the changed extents are not coalesced.
+        """
+        return []
+
+    def pop_zero_bytes(self):
+        """
+        Returns 0, the received zero blocks are written.
+        """
+        return 0
+
+    def pop_block_hasher(self):
+        """
+        Returns None, the blocks are not hashed while they are downloaded.
+        """
+        return None
+
+    def close(self):
+        """
+        Stops the event loop, and shuts down the worker threads of the
+        AsyncVdiDownloader.
+        """
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+        self._downloader.close()
@@ -6,25 +6,72 @@
 # For example, run
 # "export REQUESTS_CA_BUNDLE=/etc/ssl/certs/ca-certificates.crt" on Ubuntu.
 
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
 from pathlib import Path
 import argparse
+import contextlib
 import datetime
 import logging
 import os
 import shutil
+import threading
 import time
 import xml.etree.ElementTree as ElementTree
 
 from xenapi import XenAPI
 
+from async_vdi_downloader import ThreadedAsyncVdiDownloader
 from cbt_bitmap import CbtBitmap
-from vdi_downloader import VdiDownloader
+from backup_scheduler import (
+    BackupScheduler, ResourceLimits, all_vm_uuids, format_summary)
+from cbt_history import save_changed_blocks
+from chunk_store import (
+    CHUNKS_DIR, ChunkMapReader, ChunkStore, is_chunked_backup)
+from hash_manifest import MANIFEST_FILE, load_manifest, manifest_for_backup
+from nbd_pool import NbdConnectionPool
+from nbd_stats import TransferStats
+from output_sink import SINKS
+from python_nbd_client import DEFAULT_MAX_IN_FLIGHT
+from vdi_downloader import DownloadOptions, VdiDownloader
+from vdi_uploader import VdiUploader
+from vhd import DynamicVhdStream
 import md5sum
 import verify
 
 PROGRAM_NAME = "backup.py"
 
 
+class SerializedSession(object):
+    """
+    Wraps a XenAPI session, so that it can be shared by several threads:
+    the XenAPI calls made through its xenapi attribute are serialized, as
+    the session's XML-RPC connection is not thread-safe. The other
+    attributes are those of the session.
+    """
+
+    def __init__(self, session, lock=None):
+        self._wrapped = session
+        self.xenapi = _SerializedCalls(
+            session.xenapi, lock or threading.RLock())
+
+    def __getattr__(self, name):
+        return getattr(self._wrapped, name)
+
+
+class _SerializedCalls(object):
+
+    def __init__(self, target, lock):
+        self._target = target
+        self._lock = lock
+
+    def __getattr__(self, name):
+        return _SerializedCalls(getattr(self._target, name), self._lock)
+
+    def __call__(self, *args):
+        with self._lock:
+            return self._target(*args)
+
+
 def get_vdis_of_vm(session, vm_ref):
     """
     Returns the non-empty VDIs that are connected to a VM by a plugged or
@@ -57,24 +104,57 @@ def enable_cbt(session, vm_ref):
                 session.xenapi.VDI.get_uuid(vdi)))
 
 
-def _compare_checksums(session, vdi, backup):
+def _start_server_checksum(session, vdi):
+    """
+    Starts computing the checksum of the VDI on the server, and returns the
+    task, see _check_server_checksum.
+    """
     print("Starting to checksum VDI on server side")
     # VDI.checksum is a hidden call, and therefore should not be used by
     # clients - it's output, or the checksum algorithm it uses, is not
     # guaranteed to remain the same
-    task = session.xenapi.Async.VDI.checksum(vdi)
-    print("Checksumming local backup")
-    backup_checksum = md5sum.md5sum(backup)
+    return session.xenapi.Async.VDI.checksum(vdi)
+
+
+def _check_server_checksum(session, task, backup_checksum):
+    """
+    Waits for the checksum started by _start_server_checksum, and compares
+    it with the given checksum of the backup.
+    """
     print("Waiting for server-side checksum to finish...")
     checksum = _wait_for_task_result(session=session, task=task)
     assert backup_checksum == checksum
 
 
-def restore_vdi(session, use_tls, host, sr, backup):
+def _compare_checksums(session, vdi, backup):
     """
-    Returns a new VDI with the data taken from the backup.
+    Compares the checksum of the VDI computed by the server with the one of
+    the backup, a file or a ChunkMapReader.
     """
-    size = os.path.getsize(str(backup))
+    task = _start_server_checksum(session=session, vdi=vdi)
+    print("Checksumming local backup")
+    if isinstance(backup, ChunkMapReader):
+        backup_checksum = backup.md5sum()
+    else:
+        backup_checksum = md5sum.md5sum(backup)
+    _check_server_checksum(
+        session=session, task=task, backup_checksum=backup_checksum)
+
+
+def restore_vdi(session, use_tls, host, sr, backup, uploader=None,
+                http_format='vhd'):
+    """
+    Returns a new VDI with the data taken from the backup, a file or a
+    ChunkMapReader of a backup in the chunk store.
+    If a VdiUploader is given, the data is written over NBD, otherwise, or if
+    the new VDI is not exported over NBD, it is uploaded over HTTP in the
+    given format, 'vhd' or 'raw'. Backups in the chunk store are read
+    straight from it over NBD, but written to a temporary file for HTTP.
+    """
+    if isinstance(backup, ChunkMapReader):
+        size = backup.size
+    else:
+        size = os.path.getsize(str(backup))
     print('Creating VDI of size {}'.format(size))
     vdi_record = {
         'SR': sr,
@@ -88,20 +168,59 @@ def restore_vdi(session, use_tls, host, sr, backup):
     }
     restored_vdi = session.xenapi.VDI.create(vdi_record)
 
+    report = None
+    if uploader is not None:
+        # The new VDI reads as zeroes, so the holes of the backup can be
+        # skipped:
+        report = uploader.upload(
+            vdi=restored_vdi, input_file=backup, zeroed=True)
+    if report is not None:
+        print('Restored the VDI over NBD: {}'.format(report))
+    else:
+        with _backup_file(backup) as path:
+            _upload_vdi_over_http(
+                session=session, use_tls=use_tls, host=host,
+                vdi=restored_vdi, backup=path, http_format=http_format)
+
+    _compare_checksums(session=session, vdi=restored_vdi, backup=backup)
+
+    return restored_vdi
+
+
+@contextlib.contextmanager
+def _backup_file(backup):
+    """
+    Yields the path of the data of the given backup, written to a temporary
+    file if it is a ChunkMapReader.
+    """
+    if not isinstance(backup, ChunkMapReader):
+        yield backup
+        return
+    with backup.temporary_file() as path:
+        yield path
+
+
+def _upload_vdi_over_http(session, use_tls, host, vdi, backup, http_format):
+    """
+    Uploads the backup into the VDI with a single PUT request. In the 'vhd'
+    format only the allocated blocks of the backup are sent, encoded as a
+    dynamic VHD while they are being uploaded.
+    """
     s = verify.session_for_host(session, host)
 
     address = session.xenapi.host.get_address(host)
     protocol = 'https' if use_tls else 'http'
-    url = '{}://{}/import_raw_vdi?session_id={}&vdi={}&format=raw'.format(
-            protocol, address, session._session, restored_vdi)
-
+    url = '{}://{}/import_raw_vdi?session_id={}&vdi={}&format={}'.format(
+            protocol, address, session._session, vdi, http_format)
+
+    if http_format == 'vhd':
+        stream = DynamicVhdStream(backup)
+        print('Uploading {} bytes of VHD'.format(len(stream)))
+        s.put(url, data=stream).raise_for_status()
+        return
     with Path(backup).open('rb') as f:
         s.put(url, data=f).raise_for_status()
 
-    _compare_checksums(session=session, vdi=restored_vdi, backup=backup)
-
-    return restored_vdi
-
 
 def _get_timestamp():
     # Avoid characters that are invalid in filenames.
@@ -145,16 +264,111 @@ def _save_vm_metadata(session, use_tls, vm_uuid, backup_dir):
 
 
 class BackupConfig(object):
-    def __init__(self, session, backup_dir, use_tls):
-        self._session = session
+    def __init__(self,
+                 session,
+                 backup_dir,
+                 use_tls,
+                 max_in_flight=DEFAULT_MAX_IN_FLIGHT,
+                 connections=1,
+                 warm_connections=0,
+                 stats=False,
+                 restore_method='nbd',
+                 sparse_restore=True,
+                 vdi_concurrency=1,
+                 vdi_limits=None,
+                 server_checksum='all',
+                 dedup=False,
+                 downloader='threads',
+                 download_options=None):
+        if download_options is None:
+            download_options = DownloadOptions()
+        # The XenAPI calls of the VDIs backed up concurrently are serialized
+        self._session = SerializedSession(session)
         self._use_tls = use_tls
+        self._nbd_pool = NbdConnectionPool(
+            use_tls=use_tls, warm_connections=warm_connections)
 
         self._backup_dir = backup_dir
 
-        self._downloader = VdiDownloader(
+        self._stats = stats
+        self._vdi_concurrency = vdi_concurrency
+        # The limits on the VDI backups running on each host, SR and backup
+        # disk, shared by the VMs backed up at the same time:
+        self._vdi_limits = vdi_limits
+        self._local = threading.local()
+        # Which backups are compared with the checksum of the whole VDI
+        # computed by the server: 'all', 'full' or 'none'. This is the only
+        # end-to-end check of a backup: the block hash manifests are computed
+        # from the local data, so the others are not verified against the
+        # server.
+        self._server_checksum = server_checksum
+        self._hash_workers = download_options.hash_workers
+        # If dedup is True, new backups are moved into the chunk store,
+        # which is also read for the incremental backups and the restores
+        # of the backups already there:
+        self._dedup = dedup
+        self._chunk_store = ChunkStore(backup_dir / CHUNKS_DIR)
+
+        self._downloader_options = dict(
             session=self._session,
             block_size=4 * 1024 * 1024,
-            use_tls=use_tls)
+            use_tls=use_tls,
+            max_in_flight=max_in_flight,
+            connections=connections,
+            pool=self._nbd_pool,
+            hash_blocks=True,
+            options=download_options)
+
+        # With the 'asyncio' downloader, all the VDIs backed up at the same
+        # time are transferred by one event loop, shared by the threads:
+        self._async_downloader = None
+        if downloader == 'asyncio':
+            self._async_downloader = ThreadedAsyncVdiDownloader(
+                session=self._session,
+                block_size=4 * 1024 * 1024,
+                use_tls=use_tls,
+                max_in_flight=max_in_flight)
+
+        # Restores fall back to uploading VHDs over HTTP when the VDIs are
+        # not exported over NBD:
+        self._http_format = 'raw' if restore_method == 'raw' else 'vhd'
+        self._uploader = None
+        if restore_method == 'nbd':
+            self._uploader = VdiUploader(
+                session=self._session,
+                block_size=4 * 1024 * 1024,
+                use_tls=use_tls,
+                max_in_flight=max_in_flight,
+                connections=connections,
+                pool=self._nbd_pool,
+                sparse=sparse_restore)
+
+    def close(self):
+        """
+        Closes the idle NBD connections kept open by this object, and stops
+        the event loop of the asyncio downloader.
+        """
+        self._nbd_pool.close()
+        if self._async_downloader is not None:
+            self._async_downloader.close()
+
+    def _downloader(self):
+        """
+        Returns the VdiDownloader of the calling thread, and its
+        TransferStats, or None if stats are disabled. The VDIs that are
+        backed up concurrently each use their own, so that their reports are
+        not mixed up, and share the NBD connection pool. The asyncio
+        downloader is shared by all the threads, and keeps their reports
+        apart itself, and does not collect TransferStats.
+        """
+        if self._async_downloader is not None:
+            return (self._async_downloader, None)
+        local = self._local
+        if not hasattr(local, 'downloader'):
+            local.stats = TransferStats() if self._stats else None
+            local.downloader = VdiDownloader(
+                stats=local.stats, **self._downloader_options)
+        return (local.downloader, local.stats)
 
     def _get_vm_dir(self, vm_uuid):
         vm_dir = self._backup_dir / vm_uuid
@@ -162,9 +376,17 @@ class BackupConfig(object):
         return vm_dir
 
     def _get_local_backup_of_snapshot(self, snapshot):
+        """
+        Returns the path of the data of the backup of the given snapshot
+        VDI, or None if there is none. The data of a backup in the chunk
+        store is not kept in that file.
+        """
         uuid = self._session.xenapi.VDI.get_uuid(snapshot)
-        glob = '**/{}/data'.format(uuid)
-        return next(self._backup_dir.glob(glob), None)
+        # <backup dir>/<VM UUID>/<timestamp>/vdis/<snapshot VDI UUID>
+        for vdi_dir in self._backup_dir.glob('*/*/vdis/{}'.format(uuid)):
+            if (vdi_dir / 'data').exists() or is_chunked_backup(vdi_dir):
+                return vdi_dir / 'data'
+        return None
 
     def _snapshot_timestamp(self, snapshot):
         return self._session.xenapi.VDI.get_snapshot_time(snapshot)
@@ -195,6 +417,9 @@ class BackupConfig(object):
         """
         vdi_uuid = self._session.xenapi.VDI.get_uuid(vdi)
         print("Backing up VDI {} with UUID {}".format(vdi, vdi_uuid))
+        (downloader, transfer_stats) = self._downloader()
+        if transfer_stats is not None:
+            transfer_stats.reset()
         latest_backup = None
         if self._session.xenapi.VDI.get_cbt_enabled(vdi):
             latest_backup = self._get_latest_backup_of_vdi(vdi)
@@ -213,31 +438,149 @@ class BackupConfig(object):
 
         # Then backup the data of the snapshot VDI
         output_file = vdi_dir / "data"
+        base_vdi_dir = None
+        changed_blocks = None
         if latest_backup is None:
             print("Performing a full backup")
-            self._downloader.full_vdi_backup(
+            downloader.full_vdi_backup(
                 vdi=vdi,
                 output_file=output_file)
         else:
             print("Performing an incremental backup")
-            changed_blocks = self._session.xenapi.VDI.list_changed_blocks(
-                    latest_backup[0], vdi)
-            stats = CbtBitmap(changed_blocks).get_statistics()
+            # The bitmap is fetched only once, and kept with the backup
+            bitmap = CbtBitmap(self._session.xenapi.VDI.list_changed_blocks(
+                    latest_backup[0], vdi))
+            stats = bitmap.get_statistics()
             print("Stats: {}".format(stats))
-            self._downloader.incremental_vdi_backup(
+            # The latest backup is stored in the directory named by the UUID
+            # of its snapshot VDI:
+            base_vdi_dir = latest_backup[1].parent
+            changed_blocks = bitmap.get_extent_set()
+            copy_base = not is_chunked_backup(base_vdi_dir)
+            if not copy_base:
+                self._write_chunked_base(
+                    vdi=vdi,
+                    base_vdi_dir=base_vdi_dir,
+                    output_file=output_file,
+                    changed_blocks=changed_blocks)
+            downloader.incremental_vdi_backup(
                 vdi=vdi,
                 latest_backup=latest_backup,
-                output_file=output_file)
-        _compare_checksums(session=self._session, vdi=vdi, backup=output_file)
-
-    def _vm_backup(self, vm_snapshot, backup_dir):
-        vdis = list(get_vdis_of_vm(self._session, vm_snapshot))
+                output_file=output_file,
+                bitmap=bitmap,
+                copy_base=copy_base)
+            save_changed_blocks(
+                vdi_dir=vdi_dir,
+                changed_blocks=changed_blocks,
+                base_snapshot_uuid=base_vdi_dir.name)
+        print("Block sizes: {}".format(
+            downloader.pop_block_size_reports()))
+        for report in downloader.pop_coalescing_reports():
+            print("Coalesced extents: {}".format(report))
+        for report in downloader.pop_copy_reports():
+            print("Copied the previous backup: {}".format(report))
+        print("Zero bytes left as holes: {}".format(
+            downloader.pop_zero_bytes()))
+        if transfer_stats is not None:
+            print("Transfer stats: {}".format(transfer_stats.snapshot()))
+        task = None
+        if self._server_checksum == 'all' or (
+                self._server_checksum == 'full' and latest_backup is None):
+            task = _start_server_checksum(session=self._session, vdi=vdi)
+        # Only the changed blocks of incremental backups are hashed, and the
+        # ones hashed while they were downloaded are not read back. The
+        # backups compared with the server checksum are read only once, for
+        # both their MD5 checksum and their block hashes.
+        (manifest, manifest_report) = manifest_for_backup(
+            vdi_dir=vdi_dir,
+            base_vdi_dir=base_vdi_dir,
+            changed_extents=changed_blocks,
+            workers=self._hash_workers,
+            hasher=downloader.pop_block_hasher(),
+            md5=task is not None)
+        print("Block hash manifest: {}".format(manifest_report))
+        if task is not None:
+            _check_server_checksum(
+                session=self._session,
+                task=task,
+                backup_checksum=manifest_report['md5'])
+        if self._dedup:
+            report = self._chunk_store.put(manifest=manifest, path=output_file)
+            # The data file is only deleted once the chunks and the manifest,
+            # which is then the only map of the data, are on the disk:
+            with (vdi_dir / MANIFEST_FILE).open('rb') as manifest_file:
+                os.fsync(manifest_file.fileno())
+            output_file.unlink()
+            print("Moved into the chunk store: {}".format(report))
+
+    def _write_chunked_base(self, vdi, base_vdi_dir, output_file,
+                            changed_blocks):
+        """
+        Writes the data of a base backup kept in the chunk store into the
+        output file of an incremental backup, in place of a copy of its data
+        file. If the incremental backup also goes into the chunk store, and
+        does not need the whole data for the server checksum, only the blocks
+        containing changes are written, as it only stores these.
+        """
+        manifest = load_manifest(base_vdi_dir)
+        extents = None
+        size = int(self._session.xenapi.VDI.get_virtual_size(vdi))
+        if (self._dedup and self._server_checksum != 'all' and
+                manifest.size == size):
+            extents = changed_blocks
+        self._chunk_store.write_blocks(
+            manifest=manifest, path=output_file, extents=extents)
+
+    def _vdi_resources(self, backup_dir, vdi):
+        """
+        Returns the host serving the VDI over NBD, its SR, and the backup
+        disk, which the backup of the VDI holds in the VDI limits.
+        """
+        nbd_infos = self._session.xenapi.VDI.get_nbd_info(vdi)
+        return {'host': nbd_infos[0]['address'] if nbd_infos else None,
+                'sr': self._session.xenapi.VDI.get_SR(vdi),
+                'disk': os.stat(str(backup_dir)).st_dev}
 
-        # Back up the VDIs:
-        for vdi in vdis:
+    def _limited_vdi_backup(self, backup_dir, vdi):
+        if self._vdi_limits is None:
+            self._vdi_backup(backup_dir=backup_dir, vdi=vdi)
+            return
+        with self._vdi_limits.hold(self._vdi_resources(backup_dir, vdi)):
             self._vdi_backup(backup_dir=backup_dir, vdi=vdi)
 
-        # Remove the backed up data from the server:
+    def _vdi_backups(self, backup_dir, vdis):
+        """
+        Backs up the given VDIs, up to vdi_concurrency of them at the same
+        time, starting with the largest ones. If one fails, the ones that
+        have not started yet are skipped, and its error is raised once the
+        running ones have finished.
+        """
+        if self._vdi_concurrency <= 1 or len(vdis) <= 1:
+            for vdi in vdis:
+                self._limited_vdi_backup(backup_dir=backup_dir, vdi=vdi)
+            return
+        vdis = sorted(
+            vdis,
+            key=lambda vdi: int(
+                self._session.xenapi.VDI.get_virtual_size(vdi)),
+            reverse=True)
+        with ThreadPoolExecutor(
+                max_workers=min(self._vdi_concurrency, len(vdis))) as pool:
+            futures = [pool.submit(self._limited_vdi_backup,
+                                   backup_dir=backup_dir, vdi=vdi)
+                       for vdi in vdis]
+            (_, not_done) = wait(futures, return_when=FIRST_EXCEPTION)
+            for future in not_done:
+                future.cancel()
+        for future in futures:
+            if not future.cancelled():
+                future.result()
+
+    def _remove_snapshot(self, vm_snapshot, vdis):
+        """
+        Removes the VM snapshot and the backed up data of its VDIs from the
+        server.
+        """
         # The VM snapshot has to be removed before data_destroying the VDIs -
         # data_destroy isn't allowed if the VDI has any plugged or unplugged
         # VBDs, so as long as the VDI is linked to the VM snapshot by a VBD, we
@@ -249,6 +592,25 @@ class BackupConfig(object):
             else:
                 self._session.xenapi.VDI.destroy(vdi)
 
+    def _vm_backup(self, vm_snapshot, backup_dir):
+        vdis = list(get_vdis_of_vm(self._session, vm_snapshot))
+
+        # Back up the VDIs, and remove the snapshot from the server even if
+        # the backup of a VDI failed. In that case the error of the backup is
+        # the one raised, and a failure to remove the snapshot is only
+        # logged, so that it does not hide the root cause:
+        try:
+            self._vdi_backups(backup_dir=backup_dir, vdis=vdis)
+        except BaseException:
+            try:
+                self._remove_snapshot(vm_snapshot=vm_snapshot, vdis=vdis)
+            except Exception:
+                logging.exception(
+                    'Failed to remove VM snapshot %s after a failed backup',
+                    vm_snapshot)
+            raise
+        self._remove_snapshot(vm_snapshot=vm_snapshot, vdis=vdis)
+
     def _snapshot_vm(self, vm):
         new_name = self._session.xenapi.VM.get_name_label(
             vm) + "_tmp_cbt_backup_snapshot"
@@ -273,7 +635,7 @@ class BackupConfig(object):
             snapshot = self._snapshot_vm(vm=vm)
             snapshot_uuid = self._session.xenapi.VM.get_uuid(snapshot)
 
-            _save_vm_metadata(session=session, use_tls=self._use_tls, vm_uuid=vm_uuid, backup_dir=backup_dir)
+            _save_vm_metadata(session=self._session, use_tls=self._use_tls, vm_uuid=vm_uuid, backup_dir=backup_dir)
 
             self._vm_backup(vm_snapshot=snapshot, backup_dir=backup_dir)
 
@@ -287,8 +649,12 @@ class BackupConfig(object):
         vdi_map = {}
         vm_metadata = backup_dir / "VM_metadata"
         for backup in (backup_dir / "vdis").iterdir():
+            data = backup / 'data'
+            if is_chunked_backup(backup):
+                data = self._chunk_store.reader(backup)
             restored = restore_vdi(
-                    session=self._session, use_tls=self._use_tls, host=host, sr=sr, backup=(backup/'data'))
+                    session=self._session, use_tls=self._use_tls, host=host, sr=sr, backup=data,
+                    uploader=self._uploader, http_format=self._http_format)
             with (backup / "original_uuid").open('r') as infile:
                 original_uuid = infile.readline().strip()
             restored_uuid = self._session.xenapi.VDI.get_uuid(restored)
@@ -325,11 +691,37 @@ if __name__ == '__main__':
     parser.add_argument('--tls', dest='tls', action='store_true')
     parser.add_argument('--no-tls', dest='tls', action='store_false')
     parser.set_defaults(tls=True)
+    parser.add_argument('--max-in-flight', type=int, default=DEFAULT_MAX_IN_FLIGHT, help="Number of pipelined NBD read requests to keep outstanding per connection")
+    parser.add_argument('--sink', choices=sorted(SINKS), default='buffer_pool', help="How downloaded blocks are written to the backup files")
+    parser.add_argument('--connections', type=int, default=1, help="Number of NBD connections to open to each VDI, if the server supports multiple connections")
+    parser.add_argument('--warm-connections', type=int, default=0, help="Number of idle NBD connections to keep open to each host, ready for the next VDI")
+    parser.add_argument('--adaptive-block-size', action='store_true', help="Tune the NBD request size of each connection from the measured throughput and latency")
+    parser.add_argument('--restore-method', choices=['nbd', 'vhd', 'raw'], default='nbd', help="Write restored VDIs over NBD, or upload them over HTTP as sparse VHDs or as raw images")
+    parser.add_argument('--no-sparse-restore', dest='sparse_restore', action='store_false', help="Write every byte of the backups when restoring over NBD")
+    parser.add_argument('--no-detect-zeroes', dest='detect_zeroes', action='store_false', help="Write the downloaded blocks of zeroes to the backups instead of leaving holes")
+    parser.add_argument('--vdi-concurrency', type=int, default=1, help="Number of VDIs of a VM to back up and verify at the same time")
+    parser.add_argument('--writers', type=int, default=1, help="Number of threads writing the downloaded blocks to the backups")
+    parser.add_argument('--write-queue-size', type=int, default=16, help="Maximum number of downloaded blocks waiting to be written")
+    parser.add_argument('--preallocate', action='store_true', help="Allocate the disk space of the blocks to download before downloading them")
+    parser.add_argument('--no-coalesce', dest='coalesce', action='store_false', help="Download each changed extent of incremental backups separately")
+    parser.add_argument('--latency', type=float, help="Round-trip time to the hosts in milliseconds, measured if not given")
+    parser.add_argument('--bandwidth', type=float, help="Bandwidth of the link to the hosts in MiB/s, measured if not given")
+    parser.add_argument('--server-checksum', choices=['all', 'full', 'none'], default='all', help="Which backups to compare with the checksum of the whole VDI computed by the server")
+    parser.add_argument('--hash-workers', type=int, default=None, help="Number of threads hashing the blocks of the backups, one per CPU by default")
+    parser.add_argument('--dedup', action='store_true', help="Store the blocks of new backups once in a store shared by all backups")
+    parser.add_argument('--downloader', choices=['threads', 'asyncio'], default='threads', help="Download the VDIs with blocking NBD connections or from one asyncio event loop")
+    parser.add_argument('--stats', action='store_true', help="Print the NBD request counts, latencies and the time spent receiving and writing for each VDI")
 
     subparsers = parser.add_subparsers(dest='command_name')
 
     backup_parser = subparsers.add_parser('backup')
-    backup_parser.add_argument('--vm', required=True, help="The UUID of the VM on the server to back up")
+    backup_vms = backup_parser.add_mutually_exclusive_group(required=True)
+    backup_vms.add_argument('--vm', action='append', help="The UUID of a VM on the server to back up, can be given more than once")
+    backup_vms.add_argument('--all-vms', action='store_true', help="Back up all the VMs of the pool, other than templates, snapshots and control domains")
+    backup_parser.add_argument('--jobs', type=int, default=1, help="Number of VMs to back up at the same time")
+    backup_parser.add_argument('--host-limit', type=int, help="Maximum number of VDI backups reading from the same host at the same time")
+    backup_parser.add_argument('--sr-limit', type=int, help="Maximum number of VDI backups reading from the same SR at the same time")
+    backup_parser.add_argument('--disk-limit', type=int, help="Maximum number of VDI backups writing to the same backup disk at the same time")
 
     backup_parser = subparsers.add_parser('restore')
     backup_parser.add_argument('--vm', required=True, help="The UUID of the locally backed up VM, which is to be restored")
@@ -344,16 +736,56 @@ if __name__ == '__main__':
         args.uname, args.pwd, "1.0", PROGRAM_NAME)
     try:
         backup_dir = Path.home() / ".cbt_backups"
+        vdi_limits = None
+        if args.command_name == 'backup':
+            vdi_limits = ResourceLimits({'host': args.host_limit,
+                                         'sr': args.sr_limit,
+                                         'disk': args.disk_limit})
         config = BackupConfig(
             session=session,
             backup_dir=backup_dir,
-            use_tls=args.tls)
-        if args.command_name == 'backup':
-            print(config.backup(vm_uuid=args.vm))
-        elif args.command_name == 'restore':
-            sr = session.xenapi.SR.get_by_uuid(args.sr)
-            host = session.xenapi.host.get_by_uuid(args.host)
-            print(config.restore(vm_uuid=args.vm, timestamp=args.ts, sr=sr, host=host))
+            use_tls=args.tls,
+            max_in_flight=args.max_in_flight,
+            connections=args.connections,
+            warm_connections=args.warm_connections,
+            stats=args.stats,
+            restore_method=args.restore_method,
+            sparse_restore=args.sparse_restore,
+            vdi_concurrency=args.vdi_concurrency,
+            vdi_limits=vdi_limits,
+            server_checksum=args.server_checksum,
+            dedup=args.dedup,
+            downloader=args.downloader,
+            download_options=DownloadOptions(
+                sink=args.sink,
+                detect_zeroes=args.detect_zeroes,
+                writers=args.writers,
+                write_queue_size=args.write_queue_size,
+                preallocate=args.preallocate,
+                hash_workers=args.hash_workers,
+                adaptive_block_size=args.adaptive_block_size,
+                coalesce=args.coalesce,
+                latency=(None if args.latency is None
+                         else args.latency / 1000),
+                bandwidth=(None if args.bandwidth is None
+                           else args.bandwidth * 1024 * 1024)))
+        try:
+            if args.command_name == 'backup':
+                if args.vm is not None and len(args.vm) == 1:
+                    print(config.backup(vm_uuid=args.vm[0]))
+                else:
+                    vm_uuids = args.vm or all_vm_uuids(session)
+                    summary = BackupScheduler(
+                        session=session,
+                        config=config,
+                        workers=args.jobs).run(vm_uuids)
+                    print(format_summary(summary))
+            elif args.command_name == 'restore':
+                sr = session.xenapi.SR.get_by_uuid(args.sr)
+                host = session.xenapi.host.get_by_uuid(args.host)
+                print(config.restore(vm_uuid=args.vm, timestamp=args.ts, sr=sr, host=host))
+        finally:
+            config.close()
     except Exception:
         logging.exception('Operation failed')
         raise
@@ -0,0 +1,160 @@
+"""
+Backs up many VMs at the same time, with limits on the number of VDI backups
+that run at the same time on each host, SR and backup disk.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+import logging
+import threading
+import time
+
+LOGGER = logging.getLogger('backup_scheduler')
+
+
+def all_vm_uuids(session):
+    """
+    Returns the UUIDs of the VMs of the pool, other than templates, snapshots
+    and control domains.
+    """
+    return sorted(
+        record['uuid']
+        for record in session.xenapi.VM.get_all_records().values()
+        if not (record['is_a_template'] or record['is_a_snapshot'] or
+                record['is_control_domain']))
+
+
+class ResourceLimits(object):
+    """
+    Limits the number of jobs that use the same resource at the same time.
+    Each job holds one resource of each kind, for example a host, an SR and
+    a backup disk, and waits until all of them are available, which avoids
+    deadlocks between jobs that share some of their resources.
+    """
+
+    def __init__(self, limits):
+        """
+        The limits argument maps each kind of resource to the maximum number
+        of jobs that can hold the same resource of that kind, or None for no
+        limit.
+        """
+        self._limits = {kind: limit for (kind, limit) in limits.items()
+                        if limit is not None}
+        self._condition = threading.Condition()
+        # (kind, resource) -> number of jobs holding it
+        self._held = {}
+
+    def _available(self, keys):
+        return all(self._held.get(key, 0) < self._limits[key[0]]
+                   for key in keys)
+
+    @contextlib.contextmanager
+    def hold(self, resources):
+        """
+        Waits until the given resources, a dictionary mapping each kind of
+        resource to the one used by the job, are available, and holds them
+        until the end of the with block.
+        """
+        keys = [(kind, resource) for (kind, resource) in resources.items()
+                if kind in self._limits]
+        with self._condition:
+            self._condition.wait_for(lambda: self._available(keys))
+            for key in keys:
+                self._held[key] = self._held.get(key, 0) + 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                for key in keys:
+                    self._held[key] -= 1
+                    if self._held[key] == 0:
+                        del self._held[key]
+                self._condition.notify_all()
+
+
+class BackupScheduler(object):
+    """
+    Runs the backups of many VMs in a pool of workers, using a BackupConfig.
+    The VMs are started from the largest to the smallest, by the total size
+    of their disks, so that the longest backups do not end up running alone
+    at the end (longest processing time first), which keeps the total time
+    close to the shortest possible.
+    """
+
+    def __init__(self, session, config, workers=1):
+        """
+        The workers argument sets the number of VMs backed up at the same
+        time. The VDI backups of all the VMs are subject to the
+        ResourceLimits of the BackupConfig, if any.
+        """
+        self._session = session
+        self._config = config
+        self._workers = workers
+
+    def _estimate(self, vm_uuid):
+        """
+        Returns the total virtual size of the disks of the VM.
+        """
+        xenapi = self._session.xenapi
+        vm = xenapi.VM.get_by_uuid(vm_uuid)
+        size = 0
+        for vbd in xenapi.VM.get_VBDs(vm):
+            if not xenapi.VBD.get_empty(vbd):
+                size += int(xenapi.VDI.get_virtual_size(
+                    xenapi.VBD.get_VDI(vbd)))
+        return size
+
+    def _run_job(self, vm_uuid, estimated_bytes, start):
+        started = time.monotonic()
+        job = {'vm': vm_uuid,
+               'estimated_bytes': estimated_bytes,
+               'start': started - start,
+               'timestamp': None,
+               'error': None}
+        try:
+            job['timestamp'] = self._config.backup(vm_uuid=vm_uuid)
+        except Exception as error:
+            LOGGER.exception("Backup of VM %s failed", vm_uuid)
+            job['error'] = repr(error)
+        job['seconds'] = time.monotonic() - started
+        return job
+
+    def run(self, vm_uuids):
+        """
+        Backs up the given VMs. The failure of a VM's backup does not stop
+        the others.
+        Returns a summary: the total time, the number of failed backups, and
+        for each VM its estimated size, when its backup started relative to
+        the start of the batch, how long it took, and its timestamp or its
+        error, in the order in which they were started.
+        """
+        estimates = {vm_uuid: self._estimate(vm_uuid)
+                     for vm_uuid in vm_uuids}
+        order = sorted(estimates, key=estimates.get, reverse=True)
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self._workers) as pool:
+            futures = [pool.submit(self._run_job, vm_uuid,
+                                   estimates[vm_uuid], start)
+                       for vm_uuid in order]
+        jobs = [future.result() for future in futures]
+        return {'seconds': time.monotonic() - start,
+                'failed': sum(1 for job in jobs if job['error'] is not None),
+                'jobs': jobs}
+
+
+def format_summary(summary):
+    """
+    Formats the summary returned by BackupScheduler.run as a table.
+    """
+    lines = ['{:<36}  {:>10}  {:>8}  {:>8}  {}'.format(
+        'vm', 'size_mib', 'start_s', 'seconds', 'result')]
+    for job in summary['jobs']:
+        lines.append('{:<36}  {:>10}  {:>8.1f}  {:>8.1f}  {}'.format(
+            job['vm'],
+            job['estimated_bytes'] // (1024 * 1024),
+            job['start'],
+            job['seconds'],
+            job['timestamp'] if job['error'] is None else job['error']))
+    lines.append('{} VMs in {:.1f} s, {} failed'.format(
+        len(summary['jobs']), summary['seconds'], summary['failed']))
+    return '\n'.join(lines)
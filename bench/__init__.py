@@ -0,0 +1,4 @@
+"""
+Benchmarks of backup.py against a local stand-in for a XenServer pool, see
+bench.benchmark.
+"""
@@ -0,0 +1,411 @@
+#!/usr/bin/env python3
+
+"""
+End-to-end benchmarks of backup.py against a local stand-in for a XenServer
+pool: the fake XenAPI of bench.fake_xenapi, and the NBD server of
+bench.nbd_server serving sparse image files over TCP, TLS or a Unix socket.
+
+Each scenario creates a VM with a disk of the given size, takes a full
+backup, changes the given ratio of the disk, takes an incremental backup,
+and restores the latest backup. The throughput and the CPU time per GiB of
+data are reported for each phase, and the peak RSS of the backup process
+once for each scenario: the kernel only keeps the peak of the whole life of
+a process, which the later phases of a scenario would all repeat.
+
+Every scenario runs in a new process, and the servers and the checksumming
+run in other processes, so that the CPU time and the peak RSS are those of
+the backup code alone.
+
+Run it from the root of the repository:
+    python3 -m bench.benchmark --help
+"""
+
+from pathlib import Path
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import random
+import resource
+import ssl
+import subprocess
+import sys
+import tempfile
+import time
+
+import backup
+from bench.fake_xenapi import CBT_BLOCK_SIZE, FakeXapi, XapiHttpServer
+from bench.nbd_server import NbdServer
+from output_sink import SINKS
+from python_nbd_client import DEFAULT_MAX_IN_FLIGHT
+from vdi_downloader import DownloadOptions
+
+MIB = 1024 * 1024
+GIB = 1024 * MIB
+
+TRANSPORTS = ['tcp', 'tls', 'unix']
+
+# The image files are written in chunks of this size
+_IMAGE_CHUNK = MIB
+
+
+def _generate_certificate(directory):
+    """
+    Creates a self-signed certificate for localhost in the given directory
+    with openssl, and returns the paths of the certificate and its key.
+    """
+    cert = str(Path(directory) / 'cert.pem')
+    key = str(Path(directory) / 'key.pem')
+    subprocess.check_call(
+        ['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+         '-days', '1', '-subj', '/CN=localhost',
+         '-addext', 'subjectAltName=DNS:localhost',
+         '-keyout', key, '-out', cert],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return (cert, key)
+
+
+def _serve(images_dir, transport, certificate, latency, bandwidth,
+           connection):
+    """
+    Runs the NBD and the HTTP server in the server process, until something
+    is received on the given connection.
+    """
+    ssl_context = None
+    if certificate is not None:
+        ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        ssl_context.load_cert_chain(*certificate)
+    if transport == 'unix':
+        nbd_server = NbdServer(
+            images_dir=images_dir,
+            address=os.path.join(images_dir, '.nbd.sock'),
+            unix=True,
+            latency=latency,
+            bandwidth=bandwidth)
+    else:
+        nbd_server = NbdServer(
+            images_dir=images_dir,
+            ssl_context=ssl_context,
+            latency=latency,
+            bandwidth=bandwidth)
+    http_server = XapiHttpServer(
+        images_dir=images_dir,
+        ssl_context=ssl_context,
+        bandwidth=bandwidth)
+    nbd_server.start()
+    http_server.start()
+    connection.send((nbd_server.address, http_server.address))
+    connection.recv()
+    nbd_server.stop()
+    http_server.stop()
+
+
+@contextlib.contextmanager
+def _servers(images_dir, transport, certificate, latency, bandwidth):
+    """
+    Starts the servers in a new process, and returns the NBD info for the
+    fake XenAPI, and the address of the HTTP server.
+    """
+    context = multiprocessing.get_context('spawn')
+    (connection, child_connection) = context.Pipe()
+    process = context.Process(
+        target=_serve,
+        args=(str(images_dir), transport,
+              certificate if transport == 'tls' else None,
+              latency, bandwidth, child_connection))
+    process.start()
+    child_connection.close()
+    try:
+        (nbd_address, http_address) = connection.recv()
+        if transport == 'unix':
+            nbd_info = {'address': nbd_address, 'unix': True}
+        else:
+            nbd_info = {'address': nbd_address[0], 'port': nbd_address[1]}
+            if transport == 'tls':
+                with open(certificate[0]) as cert:
+                    nbd_info['cert'] = cert.read()
+                nbd_info['subject'] = 'localhost'
+        yield (nbd_info, http_address)
+    finally:
+        connection.send(None)
+        process.join()
+
+
+def _fill_image(image, size, allocation, rng):
+    """
+    Writes random data to the given ratio of the empty image file, in
+    extents of 1 to 16 MiB separated by holes. Returns the number of bytes
+    written.
+    """
+    written = 0
+    offset = 0
+    with open(image, 'r+b') as out:
+        while offset < size:
+            length = min(rng.randint(1, 16) * _IMAGE_CHUNK, size - offset)
+            if allocation > 0:
+                out.seek(offset)
+                for start in range(0, length, _IMAGE_CHUNK):
+                    out.write(os.urandom(min(_IMAGE_CHUNK, length - start)))
+                written += length
+            if allocation >= 1:
+                offset += length
+            else:
+                hole = int(length * (1 - allocation) / max(allocation, 1e-9))
+                offset += length + hole // _IMAGE_CHUNK * _IMAGE_CHUNK
+    return written
+
+
+def _change_disk(xapi, image, size, change_ratio, rng):
+    """
+    Overwrites the given ratio of the 64K CBT blocks of the disk with random
+    data, in runs of 1 to 32 blocks. Returns the number of bytes changed.
+    """
+    blocks = size // CBT_BLOCK_SIZE
+    changed = set()
+    target = int(blocks * change_ratio)
+    while len(changed) < target:
+        length = min(rng.randint(1, 32), target - len(changed))
+        first = rng.randrange(0, blocks - length + 1)
+        xapi.write_blocks(image=image,
+                          offset=first * CBT_BLOCK_SIZE,
+                          data=os.urandom(length * CBT_BLOCK_SIZE))
+        changed.update(range(first, first + length))
+    return len(changed) * CBT_BLOCK_SIZE
+
+
+def _wait_for_next_timestamp():
+    # Backups are stored in directories named by their timestamp, which has
+    # a resolution of one second.
+    timestamp = backup._get_timestamp()
+    while backup._get_timestamp() == timestamp:
+        time.sleep(0.05)
+
+
+def _measure(phase, data_bytes, function):
+    """
+    Runs the given function with its output suppressed, and returns its
+    result and its measurements.
+    """
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = function()
+    elapsed = time.perf_counter() - start
+    after = resource.getrusage(resource.RUSAGE_SELF)
+    cpu = (after.ru_utime - usage.ru_utime) + (after.ru_stime - usage.ru_stime)
+    measurement = {
+        'phase': phase,
+        'data_bytes': data_bytes,
+        'seconds': elapsed,
+        'mib_per_second': data_bytes / MIB / elapsed,
+        'cpu_seconds': cpu,
+        'cpu_seconds_per_gib': cpu / (data_bytes / GIB) if data_bytes else None,
+    }
+    return (result, measurement)
+
+
+def _run_scenario(scenario, options, certificate, connection):
+    """
+    Runs one scenario in the scenario process, and sends the list of the
+    measurements of its phases and the summary of the scenario on the given
+    connection.
+    """
+    rng = random.Random(options['seed'])
+    size = scenario['size']
+    with tempfile.TemporaryDirectory(dir=options['workdir']) as workdir:
+        images_dir = Path(workdir) / 'images'
+        backup_dir = Path(workdir) / 'backups'
+        images_dir.mkdir()
+        backup_dir.mkdir()
+        if scenario['transport'] == 'tls':
+            # Used by requests for the HTTPS calls
+            os.environ['REQUESTS_CA_BUNDLE'] = certificate[0]
+        with _servers(images_dir=images_dir,
+                      transport=scenario['transport'],
+                      certificate=certificate,
+                      latency=options['latency'],
+                      bandwidth=options['bandwidth']) as (nbd_info,
+                                                         http_address):
+            xapi = FakeXapi(images_dir=images_dir,
+                            nbd_info=nbd_info,
+                            http_address=http_address,
+                            hostname='localhost')
+            config = backup.BackupConfig(
+                session=xapi.session(),
+                backup_dir=backup_dir,
+                use_tls=scenario['transport'] == 'tls',
+                max_in_flight=options['max_in_flight'],
+                connections=options['connections'],
+                restore_method=options['restore_method'],
+                dedup=options['dedup'],
+                downloader=options['downloader'],
+                download_options=DownloadOptions(
+                    sink=options['sink'],
+                    coalesce=options['coalesce'],
+                    writers=options['writers'],
+                    preallocate=options['preallocate']))
+            try:
+                (vm_uuid, images) = xapi.create_vm([size])
+                allocated = _fill_image(
+                    images[0], size, options['allocation'], rng)
+                measurements = []
+                (timestamp, measurement) = _measure(
+                    'full', allocated,
+                    lambda: config.backup(vm_uuid=vm_uuid))
+                measurements.append(measurement)
+                changed = _change_disk(
+                    xapi, images[0], size, scenario['change_ratio'], rng)
+                _wait_for_next_timestamp()
+                (timestamp, measurement) = _measure(
+                    'incremental', changed,
+                    lambda: config.backup(vm_uuid=vm_uuid))
+                measurements.append(measurement)
+                (_, measurement) = _measure(
+                    'restore', size,
+                    lambda: config.restore(vm_uuid=vm_uuid,
+                                           timestamp=timestamp,
+                                           sr=xapi.sr(),
+                                           host=xapi.host()))
+                measurements.append(measurement)
+            finally:
+                config.close()
+                xapi.close()
+    for measurement in measurements:
+        measurement.update(scenario)
+    summary = dict(scenario)
+    # ru_maxrss is in KiB on Linux
+    summary['peak_rss_mib'] = (
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)
+    connection.send((measurements, summary))
+
+
+def run_scenario(scenario, options, certificate=None):
+    """
+    Runs the given scenario in a new process, and returns the measurements
+    of its phases, and its summary with the peak RSS of the whole scenario.
+    """
+    context = multiprocessing.get_context('spawn')
+    (connection, child_connection) = context.Pipe()
+    process = context.Process(
+        target=_run_scenario,
+        args=(scenario, options, certificate, child_connection))
+    process.start()
+    # Only the scenario process has to hold its end, so that its exit is
+    # noticed:
+    child_connection.close()
+    try:
+        if not connection.poll(options['timeout']):
+            raise RuntimeError("Scenario {} timed out".format(scenario))
+        return connection.recv()
+    except EOFError:
+        raise RuntimeError("Scenario {} failed".format(scenario))
+    finally:
+        process.join(1)
+        if process.is_alive():
+            process.terminate()
+
+
+_SCENARIO_COLUMNS = [
+    ('transport', '{}'),
+    ('size', '{:.0f}', lambda m: m['size'] / MIB),
+    ('change_ratio', '{:g}'),
+]
+
+_PHASE_COLUMNS = _SCENARIO_COLUMNS + [
+    ('phase', '{}'),
+    ('data_mib', '{:.0f}', lambda m: m['data_bytes'] / MIB),
+    ('seconds', '{:.2f}'),
+    ('mib_per_second', '{:.1f}'),
+    ('cpu_s_per_gib', '{:.2f}', lambda m: m['cpu_seconds_per_gib']),
+]
+
+_SUMMARY_COLUMNS = _SCENARIO_COLUMNS + [
+    ('peak_rss_mib', '{:.0f}'),
+]
+
+
+def _format_table(columns, measurements):
+    rows = [[name if name != 'size' else 'size_mib'
+             for (name, *_) in columns]]
+    for measurement in measurements:
+        row = []
+        for (name, fmt, *getter) in columns:
+            value = getter[0](measurement) if getter else measurement[name]
+            row.append('-' if value is None else fmt.format(value))
+        rows.append(row)
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    return '\n'.join('  '.join(cell.rjust(width)
+                               for (cell, width) in zip(row, widths))
+                     for row in rows)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark backup.py against a local fake XenServer pool")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[256, 1024], help="Virtual sizes of the disks in MiB")
+    parser.add_argument('--change-ratios', type=float, nargs='+', default=[0.01, 0.1], help="Ratios of the disk changed before the incremental backup")
+    parser.add_argument('--transports', choices=TRANSPORTS, nargs='+', default=['tcp'], help="How the NBD server is reached")
+    parser.add_argument('--allocation', type=float, default=0.5, help="Ratio of the disk allocated before the full backup")
+    parser.add_argument('--latency', type=float, default=0, help="Round-trip time added to every NBD request, in milliseconds")
+    parser.add_argument('--bandwidth', type=float, default=None, help="Bandwidth of the emulated network link in MiB/s, unlimited by default")
+    parser.add_argument('--max-in-flight', type=int, default=DEFAULT_MAX_IN_FLIGHT, help="Passed to backup.py")
+    parser.add_argument('--sink', choices=sorted(SINKS), default='buffer_pool', help="Passed to backup.py")
+    parser.add_argument('--connections', type=int, default=1, help="Passed to backup.py")
+    parser.add_argument('--restore-method', choices=['nbd', 'vhd', 'raw'], default='nbd', help="Passed to backup.py")
+    parser.add_argument('--no-coalesce', dest='coalesce', action='store_false', help="Passed to backup.py")
+    parser.add_argument('--writers', type=int, default=1, help="Passed to backup.py")
+    parser.add_argument('--preallocate', action='store_true', help="Passed to backup.py")
+    parser.add_argument('--dedup', action='store_true', help="Passed to backup.py")
+    parser.add_argument('--downloader', choices=['threads', 'asyncio'], default='threads', help="Passed to backup.py")
+    parser.add_argument('--seed', type=int, default=0, help="Seed of the random layout of the disks and the changes")
+    parser.add_argument('--workdir', default=None, help="Directory for the images and the backups, needs space for about three times the largest size")
+    parser.add_argument('--timeout', type=float, default=3600, help="Time limit of each scenario in seconds")
+    parser.add_argument('--json', default=None, help="Also write the measurements to this file as JSON")
+    args = parser.parse_args(argv)
+
+    options = {
+        'allocation': args.allocation,
+        'latency': args.latency / 1000,
+        'bandwidth': args.bandwidth * MIB if args.bandwidth else None,
+        'max_in_flight': args.max_in_flight,
+        'sink': args.sink,
+        'connections': args.connections,
+        'restore_method': args.restore_method,
+        'coalesce': args.coalesce,
+        'writers': args.writers,
+        'preallocate': args.preallocate,
+        'dedup': args.dedup,
+        'downloader': args.downloader,
+        'seed': args.seed,
+        'workdir': args.workdir,
+        'timeout': args.timeout,
+    }
+    measurements = []
+    summaries = []
+    with tempfile.TemporaryDirectory() as certificate_dir:
+        certificate = None
+        if 'tls' in args.transports:
+            certificate = _generate_certificate(certificate_dir)
+        for transport in args.transports:
+            for size in args.sizes:
+                for change_ratio in args.change_ratios:
+                    scenario = {'transport': transport,
+                                'size': size * MIB,
+                                'change_ratio': change_ratio}
+                    print("Running {}".format(scenario), file=sys.stderr)
+                    (phases, summary) = run_scenario(
+                        scenario, options, certificate)
+                    measurements += phases
+                    summaries.append(summary)
+    print(_format_table(_PHASE_COLUMNS, measurements))
+    print()
+    print(_format_table(_SUMMARY_COLUMNS, summaries))
+    if args.json is not None:
+        with open(args.json, 'w') as out:
+            json.dump({'phases': measurements, 'scenarios': summaries},
+                      out, indent=2)
+
+
+if __name__ == '__main__':
+    main()
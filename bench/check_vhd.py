@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+
+"""
+Checks the dynamic VHD encoding of vhd.DynamicVhdStream on a small sparse
+image: the checksums of the footers and of the dynamic disk header, the
+layout of the BAT and of the allocated blocks, their sector bitmaps, and
+that decoding the VHD gives back the image.
+
+The allocation of the image is the one reported by SEEK_DATA and SEEK_HOLE,
+which depends on the file system, so the expected layout is derived from
+sparse_file.file_extents.
+
+Run it from the root of the repository:
+    python3 -m bench.check_vhd
+"""
+
+from pathlib import Path
+import os
+import struct
+import tempfile
+
+from sparse_file import file_extents
+import vhd
+
+MIB = 1024 * 1024
+
+
+def _write_image(path):
+    """
+    Writes a sparse image with data at the start of its first block, in the
+    middle of it, and at the end of its last block, which is partial, and
+    whose size is not a multiple of the sector size. Returns its content.
+    """
+    size = 5 * MIB + 1000
+    image = bytearray(size)
+    image[512:1024] = b'\x01' * 512
+    image[MIB:MIB + 4096] = b'\x02' * 4096
+    image[size - 1000:] = b'\x03' * 1000
+    with path.open('wb') as out:
+        out.truncate(size)
+        for (offset, length) in [(512, 512), (MIB, 4096),
+                                 (size - 1000, 1000)]:
+            out.seek(offset)
+            out.write(image[offset:offset + length])
+    return bytes(image)
+
+
+def _data_sectors(path, size):
+    """
+    Returns the set of the sectors of the image that the VHD must mark as
+    containing data.
+    """
+    sectors = set()
+    fd = os.open(str(path), os.O_RDONLY)
+    try:
+        for (offset, length, is_data) in file_extents(fd, 0, size):
+            if is_data:
+                sectors.update(range(
+                    offset // vhd.SECTOR_SIZE,
+                    -(-(offset + length) // vhd.SECTOR_SIZE)))
+    finally:
+        os.close(fd)
+    return sectors
+
+
+def check(directory):
+    path = Path(directory) / 'image'
+    image = _write_image(path)
+    block_size = vhd.VHD_BLOCK_SIZE
+    sectors_per_block = block_size // vhd.SECTOR_SIZE
+    bitmap_size = sectors_per_block // 8
+    size = -(-len(image) // vhd.SECTOR_SIZE) * vhd.SECTOR_SIZE
+    data_sectors = _data_sectors(path, size)
+
+    stream = vhd.DynamicVhdStream(path)
+    encoded = b''.join(stream)
+    assert len(encoded) == len(stream), (len(encoded), len(stream))
+
+    footer = encoded[:vhd.FOOTER_SIZE]
+    assert encoded[-vhd.FOOTER_SIZE:] == footer
+    assert vhd.has_valid_checksum(footer, vhd.FOOTER_CHECKSUM_OFFSET)
+    assert footer[:8] == b'conectix'
+    (data_offset,) = struct.unpack_from('>Q', footer, 16)
+    (original_size, current_size) = struct.unpack_from('>QQ', footer, 40)
+    (disk_type,) = struct.unpack_from('>L', footer, 60)
+    assert data_offset == vhd.FOOTER_SIZE
+    assert original_size == current_size == size
+    assert disk_type == vhd.DISK_TYPE_DYNAMIC
+
+    header = encoded[data_offset:data_offset + vhd.DYNAMIC_HEADER_SIZE]
+    assert vhd.has_valid_checksum(
+        header, vhd.DYNAMIC_HEADER_CHECKSUM_OFFSET)
+    assert header[:8] == b'cxsparse'
+    (table_offset,) = struct.unpack_from('>Q', header, 16)
+    (max_table_entries, header_block_size) = struct.unpack_from(
+        '>LL', header, 28)
+    blocks = -(-size // block_size)
+    assert table_offset == vhd.FOOTER_SIZE + vhd.DYNAMIC_HEADER_SIZE
+    assert max_table_entries == blocks
+    assert header_block_size == block_size
+
+    bat = struct.unpack_from('>{}L'.format(blocks), encoded, table_offset)
+    table_end = table_offset + blocks * 4
+    padding_end = -(-table_end // vhd.SECTOR_SIZE) * vhd.SECTOR_SIZE
+    assert set(encoded[table_end:padding_end]) <= {0xFF}
+    # The allocated blocks follow the BAT, in the order of their index
+    sector = padding_end // vhd.SECTOR_SIZE
+    decoded = bytearray(blocks * block_size)
+    for (block, block_sector) in enumerate(bat):
+        first = block * sectors_per_block
+        expected = {index for index in range(sectors_per_block)
+                    if first + index in data_sectors}
+        if not expected:
+            assert block_sector == vhd.BAT_UNUSED, (block, block_sector)
+            continue
+        assert block_sector == sector, (block, block_sector, sector)
+        start = block_sector * vhd.SECTOR_SIZE
+        bitmap = encoded[start:start + bitmap_size]
+        marked = {index for index in range(sectors_per_block)
+                  if bitmap[index // 8] & (0x80 >> (index % 8))}
+        assert marked == expected, block
+        start += -(-bitmap_size // vhd.SECTOR_SIZE) * vhd.SECTOR_SIZE
+        decoded[block * block_size:(block + 1) * block_size] = (
+            encoded[start:start + block_size])
+        sector = (start + block_size) // vhd.SECTOR_SIZE
+    assert sector * vhd.SECTOR_SIZE + vhd.FOOTER_SIZE == len(encoded)
+    assert bytes(decoded[:len(image)]) == image
+    assert not any(decoded[len(image):])
+
+
+def main():
+    with tempfile.TemporaryDirectory() as directory:
+        check(directory)
+    print("OK")
+
+
+if __name__ == '__main__':
+    main()
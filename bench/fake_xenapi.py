@@ -0,0 +1,542 @@
+"""
+An in-process stand-in for the parts of the XenAPI used by backup.py, and
+the HTTP handlers of the host that it talks to.
+
+The fake keeps its objects in memory. The data of each VDI is an image file
+in a directory that is also served by the benchmark NBD server, the export
+name of a VDI is the name of its image file. CBT is emulated by recording
+the 64K blocks changed by write_blocks between snapshots.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import parse_qs, urlparse
+import base64
+import http.server
+import itertools
+import os
+import struct
+import threading
+import uuid
+
+from xenapi import XenAPI
+
+import md5sum
+import vhd
+
+from bench.nbd_server import Link
+
+# The block size of the CBT bitmaps
+CBT_BLOCK_SIZE = 64 * 1024
+
+_NULL_REF = 'OpaqueRef:NULL'
+
+_CBT_OPERATIONS = ['vdi_enable_cbt', 'vdi_list_changed_blocks',
+                   'vdi_data_destroy']
+
+
+def _new_ref():
+    return 'OpaqueRef:' + str(uuid.uuid4())
+
+
+class _Vdi(object):
+    def __init__(self, image, virtual_size, sr):
+        self.uuid = str(uuid.uuid4())
+        self.image = image
+        self.virtual_size = virtual_size
+        self.sr = sr
+        self.cbt_enabled = False
+        self.data_destroyed = False
+        self.snapshot_of = _NULL_REF
+        self.snapshots = []
+        self.snapshot_time = None
+        # The sets of blocks changed in each epoch, an epoch ends when a
+        # snapshot is taken:
+        self.changes = [set()]
+        # The number of epochs that a snapshot contains
+        self.epoch = None
+
+
+class _Vm(object):
+    def __init__(self, name_label, vbds, is_a_snapshot=False):
+        self.uuid = str(uuid.uuid4())
+        self.name_label = name_label
+        self.vbds = vbds
+        self.is_a_snapshot = is_a_snapshot
+
+
+class _Task(object):
+    def __init__(self, future=None, result=''):
+        self.future = future
+        self.result = result
+
+
+class FakeXapi(object):
+    """
+    The state of the fake pool: a single host serving the NBD and HTTP
+    requests, a single SR, and the VMs created with create_vm.
+
+    The nbd_info dictionary, without the exportname, is returned by
+    VDI.get_nbd_info. http_address is the address:port returned by
+    host.get_address.
+    """
+
+    def __init__(self, images_dir, nbd_info, http_address, hostname):
+        self._images_dir = str(images_dir)
+        self._nbd_info = nbd_info
+        self._lock = threading.RLock()
+        self._timestamps = itertools.count()
+        self._host = _new_ref()
+        self._host_record = {'address': http_address, 'hostname': hostname}
+        self._sr = _new_ref()
+        self._vms = {}
+        self._vbds = {}
+        self._vdis = {}
+        self._tasks = {}
+        # The checksums are computed in another process, like on a real
+        # host, so that they do not count towards the CPU time of the
+        # benchmarked process:
+        self._checksums = ProcessPoolExecutor(max_workers=1)
+
+    def close(self):
+        """
+        Stops the checksumming process.
+        """
+        self._checksums.shutdown()
+
+    def session(self):
+        """
+        Returns a session object that can be used instead of a
+        XenAPI.Session.
+        """
+        return FakeSession(self)
+
+    def host(self):
+        """
+        Returns the reference of the host.
+        """
+        return self._host
+
+    def sr(self):
+        """
+        Returns the reference of the SR.
+        """
+        return self._sr
+
+    def _create_vdi(self, virtual_size):
+        vdi = _Vdi(image=None, virtual_size=virtual_size, sr=self._sr)
+        vdi.image = os.path.join(self._images_dir, vdi.uuid)
+        with open(vdi.image, 'wb') as image:
+            image.truncate(virtual_size)
+        ref = 'OpaqueRef:' + vdi.uuid
+        self._vdis[ref] = vdi
+        return ref
+
+    def create_vm(self, disk_sizes):
+        """
+        Creates a VM with an empty disk of each of the given sizes, and
+        returns its UUID and the paths of the image files of its disks.
+        """
+        with self._lock:
+            vbds = []
+            images = []
+            for size in disk_sizes:
+                vdi = self._create_vdi(size)
+                vbd = _new_ref()
+                self._vbds[vbd] = vdi
+                vbds.append(vbd)
+                images.append(self._vdis[vdi].image)
+            vm = _Vm(name_label='benchmark', vbds=vbds)
+            self._vms[_new_ref()] = vm
+            return (vm.uuid, images)
+
+    def write_blocks(self, image, offset, data):
+        """
+        Writes the given data to the image file of a disk, and marks the
+        blocks that it covers as changed for CBT.
+        """
+        with self._lock:
+            vdi = next(vdi for vdi in self._vdis.values()
+                       if vdi.image == image and vdi.snapshot_of == _NULL_REF)
+            with open(image, 'r+b') as out:
+                out.seek(offset)
+                out.write(data)
+            first = offset // CBT_BLOCK_SIZE
+            last = (offset + len(data) - 1) // CBT_BLOCK_SIZE
+            vdi.changes[-1].update(range(first, last + 1))
+
+    def call(self, method, args):
+        """
+        Calls the fake implementation of the given XenAPI method.
+        """
+        implementation = getattr(self, '_' + method.replace('.', '_'), None)
+        if implementation is None:
+            raise XenAPI.Failure(['MESSAGE_METHOD_UNKNOWN', method])
+        with self._lock:
+            return implementation(*args)
+
+    def _lookup(self, table, ref):
+        try:
+            return table[ref]
+        except KeyError:
+            raise XenAPI.Failure(['HANDLE_INVALID', ref])
+
+    # session and host
+
+    def _session_get_this_host(self, session):
+        return self._host
+
+    def _host_get_address(self, host):
+        return self._host_record['address']
+
+    def _host_get_hostname(self, host):
+        return self._host_record['hostname']
+
+    # SR
+
+    def _SR_get_allowed_operations(self, sr):
+        return list(_CBT_OPERATIONS)
+
+    # VM
+
+    def _VM_get_by_uuid(self, vm_uuid):
+        for (ref, vm) in self._vms.items():
+            if vm.uuid == vm_uuid:
+                return ref
+        raise XenAPI.Failure(['UUID_INVALID', 'VM', vm_uuid])
+
+    def _VM_get_uuid(self, vm):
+        return self._lookup(self._vms, vm).uuid
+
+    def _VM_get_name_label(self, vm):
+        return self._lookup(self._vms, vm).name_label
+
+    def _VM_get_all_records(self):
+        return {ref: {'uuid': vm.uuid,
+                      'name_label': vm.name_label,
+                      'is_a_template': False,
+                      'is_a_snapshot': vm.is_a_snapshot,
+                      'is_control_domain': False}
+                for (ref, vm) in self._vms.items()}
+
+    def _VM_get_VBDs(self, vm):
+        return list(self._lookup(self._vms, vm).vbds)
+
+    def _VM_snapshot(self, vm, new_name):
+        vbds = []
+        timestamp = '{:020d}'.format(next(self._timestamps))
+        for vbd in self._lookup(self._vms, vm).vbds:
+            ref = self._vbds[vbd]
+            vdi = self._vdis[ref]
+            # The snapshot shares the image of the disk: the benchmark only
+            # writes to the disk after the snapshot has been backed up.
+            snapshot = _Vdi(image=vdi.image,
+                            virtual_size=vdi.virtual_size,
+                            sr=vdi.sr)
+            snapshot.cbt_enabled = vdi.cbt_enabled
+            snapshot.snapshot_of = ref
+            snapshot.snapshot_time = timestamp
+            snapshot.epoch = len(vdi.changes)
+            vdi.changes.append(set())
+            snapshot_ref = 'OpaqueRef:' + snapshot.uuid
+            self._vdis[snapshot_ref] = snapshot
+            vdi.snapshots.append(snapshot_ref)
+            snapshot_vbd = _new_ref()
+            self._vbds[snapshot_vbd] = snapshot_ref
+            vbds.append(snapshot_vbd)
+        snapshot_vm = _new_ref()
+        self._vms[snapshot_vm] = _Vm(
+            name_label=new_name, vbds=vbds, is_a_snapshot=True)
+        return snapshot_vm
+
+    def _VM_destroy(self, vm):
+        for vbd in self._lookup(self._vms, vm).vbds:
+            del self._vbds[vbd]
+        del self._vms[vm]
+
+    # VBD
+
+    def _VBD_get_VDI(self, vbd):
+        return self._lookup(self._vbds, vbd)
+
+    def _VBD_get_empty(self, vbd):
+        self._lookup(self._vbds, vbd)
+        return False
+
+    # VDI
+
+    def _VDI_create(self, record):
+        return self._create_vdi(int(record['virtual_size']))
+
+    def _VDI_get_uuid(self, vdi):
+        return self._lookup(self._vdis, vdi).uuid
+
+    def _VDI_get_virtual_size(self, vdi):
+        return str(self._lookup(self._vdis, vdi).virtual_size)
+
+    def _VDI_get_SR(self, vdi):
+        return self._lookup(self._vdis, vdi).sr
+
+    def _VDI_enable_cbt(self, vdi):
+        self._lookup(self._vdis, vdi).cbt_enabled = True
+
+    def _VDI_get_cbt_enabled(self, vdi):
+        return self._lookup(self._vdis, vdi).cbt_enabled
+
+    def _VDI_get_snapshot_of(self, vdi):
+        return self._lookup(self._vdis, vdi).snapshot_of
+
+    def _VDI_get_snapshots(self, vdi):
+        return list(self._lookup(self._vdis, vdi).snapshots)
+
+    def _VDI_get_snapshot_time(self, vdi):
+        return self._lookup(self._vdis, vdi).snapshot_time
+
+    def _VDI_list_changed_blocks(self, vdi_from, vdi_to):
+        snapshot_from = self._lookup(self._vdis, vdi_from)
+        snapshot_to = self._lookup(self._vdis, vdi_to)
+        vdi = self._lookup(self._vdis, snapshot_to.snapshot_of)
+        blocks = -(-snapshot_to.virtual_size // CBT_BLOCK_SIZE)
+        bitmap = bytearray(-(-blocks // 8))
+        for changes in vdi.changes[snapshot_from.epoch:snapshot_to.epoch]:
+            for block in changes:
+                bitmap[block // 8] |= 0x80 >> (block % 8)
+        return base64.b64encode(bytes(bitmap)).decode('ascii')
+
+    def _VDI_get_nbd_info(self, vdi):
+        record = self._lookup(self._vdis, vdi)
+        if record.data_destroyed:
+            return []
+        info = dict(self._nbd_info)
+        info['exportname'] = os.path.basename(record.image)
+        return [info]
+
+    def _VDI_data_destroy(self, vdi):
+        self._lookup(self._vdis, vdi).data_destroyed = True
+
+    def _VDI_destroy(self, vdi):
+        record = self._lookup(self._vdis, vdi)
+        if record.snapshot_of != _NULL_REF:
+            self._vdis[record.snapshot_of].snapshots.remove(vdi)
+        del self._vdis[vdi]
+
+    def _Async_VDI_checksum(self, vdi):
+        record = self._lookup(self._vdis, vdi)
+        task = _new_ref()
+        self._tasks[task] = _Task(
+            self._checksums.submit(md5sum.md5sum, record.image))
+        return task
+
+    # task
+
+    def _task_create(self, label, description):
+        # The tasks created by backup.py are passed to import_metadata, which
+        # results in a new VM. The fake does not parse the metadata, the VM
+        # has no disks.
+        vm = _new_ref()
+        self._vms[vm] = _Vm(name_label=label, vbds=[])
+        task = _new_ref()
+        self._tasks[task] = _Task(result=vm)
+        return task
+
+    def _task_get_status(self, task):
+        future = self._lookup(self._tasks, task).future
+        if future is not None:
+            # Finish the task now rather than making the caller poll it
+            future.exception()
+        return 'success'
+
+    def _task_get_record(self, task):
+        record = self._lookup(self._tasks, task)
+        result = record.result
+        if record.future is not None:
+            result = record.future.result()
+        return {'status': 'success',
+                'result': '<value>{}</value>'.format(result)}
+
+
+class _Namespace(object):
+    """
+    Turns session.xenapi.Class.method(args) calls into FakeXapi.call calls.
+    """
+
+    def __init__(self, xapi, name=None):
+        self._xapi = xapi
+        self._name = name
+
+    def __getattr__(self, name):
+        if self._name is not None:
+            name = self._name + '.' + name
+        return _Namespace(self._xapi, name)
+
+    def __call__(self, *args):
+        return self._xapi.call(self._name, args)
+
+
+class FakeSession(object):
+    """
+    A logged in session of the fake XenAPI.
+    """
+
+    def __init__(self, xapi):
+        self._session = _new_ref()
+        self.xenapi = _Namespace(xapi)
+
+
+class _HttpHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Serves the HTTP calls that backup.py makes to the host.
+    """
+
+    def log_message(self, format, *args):
+        pass
+
+    def _query(self):
+        url = urlparse(self.path)
+        return (url.path, {key: values[0] for (key, values)
+                           in parse_qs(url.query).items()})
+
+    def _receive(self, out=None):
+        """
+        Receives the body of the request, writing it to the given file if it
+        is not None.
+        """
+        remaining = int(self.headers.get('Content-Length', 0))
+        while remaining > 0:
+            data = self._read(min(remaining, 1024 * 1024))
+            if out is not None:
+                out.write(data)
+            remaining -= len(data)
+
+    def _read(self, length):
+        """
+        Reads the given number of bytes of the body of the request.
+        """
+        data = self.rfile.read(length)
+        if len(data) != length:
+            raise EOFError("Truncated request body")
+        self.server.upstream.transmit(length)
+        return data
+
+    def _receive_vhd(self, out):
+        """
+        Receives a dynamic VHD, as sent by backup.py, and writes the sectors
+        marked in the bitmaps of its allocated blocks to the given file.
+        """
+        remaining = int(self.headers.get('Content-Length', 0))
+        position = 0
+
+        def _read(length):
+            nonlocal position
+            position += length
+            return self._read(length)
+
+        footer = _read(vhd.FOOTER_SIZE)
+        assert vhd.has_valid_checksum(footer, vhd.FOOTER_CHECKSUM_OFFSET)
+        header = _read(vhd.DYNAMIC_HEADER_SIZE)
+        assert header[:8] == b'cxsparse'
+        assert vhd.has_valid_checksum(
+            header, vhd.DYNAMIC_HEADER_CHECKSUM_OFFSET)
+        (table_offset,) = struct.unpack_from('>Q', header, 16)
+        (max_table_entries, block_size) = struct.unpack_from(
+            '>LL', header, 28)
+        _read(table_offset - position)
+        bat = struct.unpack(
+            '>{}L'.format(max_table_entries), _read(max_table_entries * 4))
+        # One bit per sector, padded to a sector boundary:
+        sectors_per_block = block_size // vhd.SECTOR_SIZE
+        bitmap_size = (-(-sectors_per_block // 8 // vhd.SECTOR_SIZE) *
+                       vhd.SECTOR_SIZE)
+        blocks = sorted((sector, block) for (block, sector) in enumerate(bat)
+                        if sector != vhd.BAT_UNUSED)
+        for (sector, block) in blocks:
+            # The blocks must not overlap the BAT or each other
+            assert sector * vhd.SECTOR_SIZE >= position
+            _read(sector * vhd.SECTOR_SIZE - position)
+            bitmap = _read(bitmap_size)
+            data = _read(block_size)
+            if bitmap[:sectors_per_block // 8] == b'\xff' * (
+                    sectors_per_block // 8):
+                out.seek(block * block_size)
+                out.write(data)
+                continue
+            for index in range(sectors_per_block):
+                if bitmap[index // 8] & (0x80 >> (index % 8)):
+                    out.seek(block * block_size + index * vhd.SECTOR_SIZE)
+                    out.write(data[index * vhd.SECTOR_SIZE:
+                                   (index + 1) * vhd.SECTOR_SIZE])
+        _read(remaining - position - vhd.FOOTER_SIZE)
+        assert _read(vhd.FOOTER_SIZE) == footer
+
+    def _reply(self, status, body=b''):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        (path, _) = self._query()
+        if path == '/export_metadata':
+            self._reply(200, b'<value><struct/></value>')
+        else:
+            self._reply(404)
+
+    def do_PUT(self):
+        (path, query) = self._query()
+        if (path == '/import_raw_vdi' and
+                query.get('format', 'raw') in ('raw', 'vhd')):
+            vdi_uuid = query['vdi'][len('OpaqueRef:'):]
+            image = os.path.join(self.server.images_dir, vdi_uuid)
+            with open(image, 'r+b') as out:
+                if query.get('format', 'raw') == 'vhd':
+                    self._receive_vhd(out)
+                else:
+                    self._receive(out)
+            self._reply(200)
+        elif path == '/import_metadata':
+            self._receive()
+            self._reply(200)
+        else:
+            self._reply(404)
+
+
+class _HttpServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+
+class XapiHttpServer(object):
+    """
+    Serves the export_metadata, import_metadata and import_raw_vdi HTTP
+    calls of the host, writing the imported VDIs into images_dir. The given
+    bandwidth in bytes per second is emulated for uploads.
+    """
+
+    def __init__(self, images_dir, ssl_context=None, bandwidth=None):
+        self._server = _HttpServer(('127.0.0.1', 0), _HttpHandler)
+        if ssl_context is not None:
+            self._server.socket = ssl_context.wrap_socket(
+                self._server.socket, server_side=True)
+        self._server.images_dir = str(images_dir)
+        self._server.upstream = Link(bandwidth=bandwidth)
+        self._thread = None
+
+    @property
+    def address(self):
+        """
+        The address:port string the server is listening on.
+        """
+        return '{}:{}'.format(*self._server.server_address)
+
+    def start(self):
+        """
+        Starts serving in a background thread.
+        """
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops the server.
+        """
+        self._server.shutdown()
+        self._server.server_close()
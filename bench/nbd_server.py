@@ -0,0 +1,457 @@
+"""
+A local NBD server for the benchmarks, serving the image files of a
+directory over TCP or a Unix socket, optionally with TLS.
+
+It implements the parts of the protocol used by PythonNbdClient: the
+fixed-newstyle handshake with STARTTLS, NBD_OPT_INFO, structured replies,
+the base:allocation metadata context, and the read, write, flush, trim,
+write zeroes and block status commands. The holes of the sparse image files
+are reported as holes.
+
+The network between the client and the server can be slowed down by
+emulating the round-trip time and the bandwidth of a link.
+"""
+
+import errno
+import os
+import queue
+import socketserver
+import struct
+import threading
+import time
+
+from output_sink import punch_hole
+from sparse_file import file_extents
+from python_nbd_client import (
+    BASE_ALLOCATION,
+    NBD_CMD_BLOCK_STATUS,
+    NBD_CMD_DISC,
+    NBD_CMD_FLUSH,
+    NBD_CMD_READ,
+    NBD_CMD_WRITE,
+    NBD_CMD_WRITE_ZEROES,
+    NBD_FLAG_C_FIXED_NEWSTYLE,
+    NBD_FLAG_CAN_MULTI_CONN,
+    NBD_FLAG_HAS_FLAGS,
+    NBD_FLAG_SEND_FLUSH,
+    NBD_FLAG_SEND_WRITE_ZEROES,
+    NBD_INFO_BLOCK_SIZE,
+    NBD_INFO_EXPORT,
+    NBD_OPT_ABORT,
+    NBD_OPT_EXPORT_NAME,
+    NBD_OPT_INFO,
+    NBD_OPT_LIST_META_CONTEXT,
+    NBD_OPT_SET_META_CONTEXT,
+    NBD_OPT_STARTTLS,
+    NBD_OPT_STRUCTURED_REPLY,
+    NBD_REP_ACK,
+    NBD_REP_ERROR_BIT,
+    NBD_REP_INFO,
+    NBD_REP_META_CONTEXT,
+    NBD_REPLY_FLAG_DONE,
+    NBD_REPLY_TYPE_BLOCK_STATUS,
+    NBD_REPLY_TYPE_ERROR,
+    NBD_REPLY_TYPE_OFFSET_DATA,
+    NBD_REPLY_TYPE_OFFSET_HOLE,
+    NBD_REQUEST_MAGIC,
+    NBD_SIMPLE_REPLY_MAGIC,
+    NBD_STATE_HOLE,
+    NBD_STATE_ZERO,
+    NBD_STRUCTURED_REPLY_MAGIC,
+    OPTION_REPLY_MAGIC,
+)
+
+# Not needed by the client, only by the server
+NBD_OPT_GO = 7
+NBD_CMD_TRIM = 4
+NBD_FLAG_FIXED_NEWSTYLE = (1 << 0)
+NBD_FLAG_SEND_TRIM = (1 << 5)
+NBD_REP_ERR_UNSUP = NBD_REP_ERROR_BIT | 1
+NBD_REP_ERR_INVALID = NBD_REP_ERROR_BIT | 3
+NBD_REP_ERR_TLS_REQD = NBD_REP_ERROR_BIT | 5
+NBD_REP_ERR_UNKNOWN = NBD_REP_ERROR_BIT | 6
+
+# The block size constraints reported with NBD_INFO_BLOCK_SIZE
+MINIMUM_BLOCK_SIZE = 512
+PREFERRED_BLOCK_SIZE = 64 * 1024
+MAXIMUM_BLOCK_SIZE = 32 * 1024 * 1024
+
+# The context ID of base:allocation, the only metadata context offered
+BASE_ALLOCATION_ID = 1
+
+
+class Link(object):
+    """
+    One direction of an emulated network link, with the given latency in
+    seconds and bandwidth in bytes per second (None for unlimited).
+    A link may be shared by several connections, which then share its
+    bandwidth.
+    """
+
+    def __init__(self, latency=0.0, bandwidth=None):
+        self._latency = latency
+        self._bandwidth = bandwidth
+        self._lock = threading.Lock()
+        self._free_at = 0.0
+
+    def transmit(self, length, sent=None):
+        """
+        Blocks until length bytes, sent at the given time.monotonic() time
+        or now, would have arrived at the other end of the link.
+        """
+        now = time.monotonic()
+        if sent is None:
+            sent = now
+        arrival = sent + self._latency
+        if self._bandwidth:
+            with self._lock:
+                # The bytes wait for the ones sent before them
+                self._free_at = (max(self._free_at, sent) +
+                                 length / self._bandwidth)
+                arrival = self._free_at + self._latency
+        delay = arrival - now
+        if delay > 0:
+            time.sleep(delay)
+
+
+def _recvall(sock, length):
+    data = bytearray(length)
+    view = memoryview(data)
+    while view:
+        received = sock.recv_into(view)
+        if received == 0:
+            raise EOFError()
+        view = view[received:]
+    return data
+
+
+class _Handler(socketserver.BaseRequestHandler):
+    """
+    Serves one NBD connection.
+    """
+
+    def setup(self):
+        self._sock = self.request
+        self._structured_reply = False
+        self._meta_contexts = False
+        self._fd = None
+        self._size = 0
+        self._send_lock = threading.Lock()
+
+    def handle(self):
+        try:
+            if self._handshake():
+                self._transmission()
+        except (EOFError, OSError):
+            pass
+
+    def finish(self):
+        if self._fd is not None:
+            os.close(self._fd)
+
+    # Handshake phase
+
+    def _send_option_reply(self, option, reply_type, data=b''):
+        self._sock.sendall(struct.pack('>QLLL', OPTION_REPLY_MAGIC, option,
+                                       reply_type, len(data)) + data)
+
+    def _open_export(self, name):
+        path = os.path.join(self.server.images_dir, os.path.basename(name))
+        if not name or not os.path.isfile(path):
+            return False
+        self._fd = os.open(path, os.O_RDWR)
+        self._size = os.fstat(self._fd).st_size
+        return True
+
+    def _transmission_flags(self):
+        flags = (NBD_FLAG_HAS_FLAGS | NBD_FLAG_SEND_FLUSH |
+                 NBD_FLAG_SEND_TRIM | NBD_FLAG_SEND_WRITE_ZEROES)
+        if self.server.multi_conn:
+            flags |= NBD_FLAG_CAN_MULTI_CONN
+        return flags
+
+    def _handshake(self):
+        """
+        Negotiates the options, returns True when an export has been
+        selected.
+        """
+        self._sock.sendall(b'NBDMAGICIHAVEOPT' +
+                           struct.pack('>H', NBD_FLAG_FIXED_NEWSTYLE))
+        (client_flags,) = struct.unpack('>L', _recvall(self._sock, 4))
+        if client_flags & NBD_FLAG_C_FIXED_NEWSTYLE == 0:
+            return False
+        tls = False
+        while True:
+            if _recvall(self._sock, 8) != b'IHAVEOPT':
+                return False
+            (option, length) = struct.unpack('>LL', _recvall(self._sock, 8))
+            data = bytes(_recvall(self._sock, length))
+            if option == NBD_OPT_ABORT:
+                self._send_option_reply(option, NBD_REP_ACK)
+                return False
+            if self.server.ssl_context is not None and not tls:
+                if option == NBD_OPT_STARTTLS:
+                    self._send_option_reply(option, NBD_REP_ACK)
+                    self._sock = self.server.ssl_context.wrap_socket(
+                        self._sock, server_side=True)
+                    tls = True
+                elif option == NBD_OPT_EXPORT_NAME:
+                    return False
+                else:
+                    self._send_option_reply(option, NBD_REP_ERR_TLS_REQD)
+            elif option == NBD_OPT_EXPORT_NAME:
+                if not self._open_export(data.decode('utf-8')):
+                    return False
+                self._sock.sendall(
+                    struct.pack('>QH', self._size,
+                                self._transmission_flags()) + bytes(124))
+                return True
+            elif option in (NBD_OPT_INFO, NBD_OPT_GO):
+                if self._info(option, data) and option == NBD_OPT_GO:
+                    return True
+            elif option == NBD_OPT_STRUCTURED_REPLY:
+                self._structured_reply = True
+                self._send_option_reply(option, NBD_REP_ACK)
+            elif option in (NBD_OPT_LIST_META_CONTEXT,
+                            NBD_OPT_SET_META_CONTEXT):
+                self._meta_context(option, data)
+            else:
+                self._send_option_reply(option, NBD_REP_ERR_UNSUP)
+
+    def _info(self, option, data):
+        (name_length,) = struct.unpack('>L', data[:4])
+        name = data[4:4 + name_length].decode('utf-8')
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+        if not self._open_export(name):
+            self._send_option_reply(option, NBD_REP_ERR_UNKNOWN)
+            return False
+        self._send_option_reply(option, NBD_REP_INFO, struct.pack(
+            '>HQH', NBD_INFO_EXPORT, self._size, self._transmission_flags()))
+        self._send_option_reply(option, NBD_REP_INFO, struct.pack(
+            '>HLLL', NBD_INFO_BLOCK_SIZE, MINIMUM_BLOCK_SIZE,
+            PREFERRED_BLOCK_SIZE, MAXIMUM_BLOCK_SIZE))
+        self._send_option_reply(option, NBD_REP_ACK)
+        if option == NBD_OPT_INFO:
+            os.close(self._fd)
+            self._fd = None
+        return True
+
+    def _meta_context(self, option, data):
+        if not self._structured_reply:
+            self._send_option_reply(option, NBD_REP_ERR_INVALID)
+            return
+        (name_length,) = struct.unpack('>L', data[:4])
+        position = 4 + name_length
+        (count,) = struct.unpack('>L', data[position:position + 4])
+        position += 4
+        queries = []
+        for _ in range(count):
+            (length,) = struct.unpack('>L', data[position:position + 4])
+            position += 4
+            queries.append(data[position:position + length].decode('utf-8'))
+            position += length
+        offered = False
+        if option == NBD_OPT_LIST_META_CONTEXT and not queries:
+            offered = True
+        for query in queries:
+            if query in (BASE_ALLOCATION, 'base:'):
+                offered = True
+        if offered:
+            self._send_option_reply(
+                option, NBD_REP_META_CONTEXT,
+                struct.pack('>L', BASE_ALLOCATION_ID) +
+                BASE_ALLOCATION.encode('utf-8'))
+        if option == NBD_OPT_SET_META_CONTEXT:
+            self._meta_contexts = offered
+        self._send_option_reply(option, NBD_REP_ACK)
+
+    # Transmission phase
+
+    def _transmission(self):
+        # Requests are received by this thread, and processed in order by
+        # another one, which sends the replies when the emulated link would
+        # have delivered them, so that pipelined requests are delayed
+        # together instead of one after the other.
+        requests = queue.Queue()
+        worker = threading.Thread(target=self._process, args=(requests,))
+        worker.start()
+        try:
+            while True:
+                header = _recvall(self._sock, 28)
+                (magic, _, request_type, handle, offset,
+                 length) = struct.unpack('>LHHQQL', header)
+                if magic != NBD_REQUEST_MAGIC:
+                    break
+                received = time.monotonic()
+                payload = None
+                if request_type == NBD_CMD_WRITE:
+                    payload = _recvall(self._sock, length)
+                    self.server.upstream.transmit(length, sent=received)
+                requests.put(
+                    (received, request_type, handle, offset, length, payload))
+                if request_type == NBD_CMD_DISC:
+                    break
+        finally:
+            requests.put(None)
+            worker.join()
+
+    def _process(self, requests):
+        try:
+            while True:
+                request = requests.get()
+                if request is None:
+                    return
+                (received, request_type, handle, offset, length,
+                 payload) = request
+                if request_type == NBD_CMD_DISC:
+                    return
+                replies = self._execute(
+                    request_type, handle, offset, length, payload)
+                self.server.downstream.transmit(
+                    sum(len(reply) for reply in replies), sent=received)
+                with self._send_lock:
+                    for reply in replies:
+                        self._sock.sendall(reply)
+        except OSError:
+            pass
+
+    def _simple_reply(self, handle, error=0, data=b''):
+        return [struct.pack('>LLQ', NBD_SIMPLE_REPLY_MAGIC, error, handle),
+                data]
+
+    def _chunk(self, handle, reply_type, length, done):
+        """
+        Returns the header of a structured reply chunk with a payload of
+        the given length.
+        """
+        flags = NBD_REPLY_FLAG_DONE if done else 0
+        return struct.pack('>LHHQL', NBD_STRUCTURED_REPLY_MAGIC, flags,
+                           reply_type, handle, length)
+
+    def _error_reply(self, request_type, handle, error):
+        if self._structured_reply and request_type in (NBD_CMD_READ,
+                                                      NBD_CMD_BLOCK_STATUS):
+            payload = struct.pack('>LH', error, 0)
+            return [self._chunk(handle, NBD_REPLY_TYPE_ERROR, len(payload),
+                                True),
+                    payload]
+        return self._simple_reply(handle, error=error)
+
+    def _execute(self, request_type, handle, offset, length, payload):
+        if offset + length > self._size:
+            return self._error_reply(request_type, handle, errno.EINVAL)
+        if request_type == NBD_CMD_READ:
+            return self._read(handle, offset, length)
+        if request_type == NBD_CMD_WRITE:
+            written = 0
+            view = memoryview(payload)
+            while written < length:
+                written += os.pwrite(self._fd, view[written:],
+                                     offset + written)
+            return self._simple_reply(handle)
+        if request_type == NBD_CMD_FLUSH:
+            os.fdatasync(self._fd)
+            return self._simple_reply(handle)
+        if request_type in (NBD_CMD_TRIM, NBD_CMD_WRITE_ZEROES):
+            if length:
+                punch_hole(self._fd, offset, length)
+            return self._simple_reply(handle)
+        if request_type == NBD_CMD_BLOCK_STATUS and self._meta_contexts:
+            return self._block_status(handle, offset, length)
+        return self._error_reply(request_type, handle, errno.EINVAL)
+
+    def _read(self, handle, offset, length):
+        if not self._structured_reply:
+            return self._simple_reply(
+                handle, data=os.pread(self._fd, length, offset))
+        replies = []
+        extents = list(file_extents(self._fd, offset, length))
+        for (index, (extent_offset, extent_length, is_data)) in enumerate(
+                extents):
+            done = index == len(extents) - 1
+            if is_data:
+                data = os.pread(self._fd, extent_length, extent_offset)
+                replies.append(self._chunk(
+                    handle, NBD_REPLY_TYPE_OFFSET_DATA, 8 + len(data), done))
+                replies.append(struct.pack('>Q', extent_offset))
+                replies.append(data)
+            else:
+                payload = struct.pack('>QL', extent_offset, extent_length)
+                replies.append(self._chunk(
+                    handle, NBD_REPLY_TYPE_OFFSET_HOLE, len(payload), done))
+                replies.append(payload)
+        return replies
+
+    def _block_status(self, handle, offset, length):
+        descriptors = []
+        for (_, extent_length, is_data) in file_extents(
+                self._fd, offset, length):
+            flags = 0 if is_data else NBD_STATE_HOLE | NBD_STATE_ZERO
+            descriptors.append(struct.pack('>LL', extent_length, flags))
+        payload = struct.pack('>L', BASE_ALLOCATION_ID) + b''.join(
+            descriptors)
+        return [self._chunk(handle, NBD_REPLY_TYPE_BLOCK_STATUS,
+                            len(payload), True),
+                payload]
+
+
+class _TCPServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class _UnixServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+class NbdServer(object):
+    """
+    Serves the image files in images_dir, the export name is the name of
+    the file. Listens on the given (host, port) TCP address, or on the Unix
+    socket at the given path if unix is True.
+    If ssl_context is not None, clients have to upgrade their connection to
+    TLS with it. The given latency in seconds is added to the round trip of
+    every request, and the given bandwidth in bytes per second (None for
+    unlimited) is shared by all connections, in each direction.
+    """
+
+    def __init__(self,
+                 images_dir,
+                 address=('127.0.0.1', 0),
+                 unix=False,
+                 ssl_context=None,
+                 latency=0.0,
+                 bandwidth=None,
+                 multi_conn=True):
+        server_class = _UnixServer if unix else _TCPServer
+        self._server = server_class(address, _Handler)
+        self._server.images_dir = str(images_dir)
+        self._server.ssl_context = ssl_context
+        self._server.multi_conn = multi_conn
+        self._server.upstream = Link(bandwidth=bandwidth)
+        self._server.downstream = Link(latency=latency, bandwidth=bandwidth)
+        self._thread = None
+
+    @property
+    def address(self):
+        """
+        The address the server is listening on.
+        """
+        return self._server.server_address
+
+    def start(self):
+        """
+        Starts serving in a background thread.
+        """
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops accepting new connections.
+        """
+        self._server.shutdown()
+        self._server.server_close()
@@ -0,0 +1,191 @@
+"""
+Tunes the size of the NBD read requests of a connection from the measured
+throughput and latency, within the block size constraints of the server.
+"""
+
+import time
+
+# The range of request sizes used when the server does not report its
+# block size constraints.
+DEFAULT_MIN_BLOCK_SIZE = 64 * 1024
+DEFAULT_MAX_BLOCK_SIZE = 32 * 1024 * 1024
+
+# The server must accept requests of up to 32 MiB, the NBD protocol does
+# not allow clients to assume more than that without its block size
+# constraints.
+PROTOCOL_MAX_BLOCK_SIZE = 32 * 1024 * 1024
+
+# Throughput has to improve by this factor for a size change to be kept
+IMPROVEMENT_THRESHOLD = 1.05
+
+
+def _round_down_to_power_of_two(value):
+    return 1 << (max(1, value).bit_length() - 1)
+
+
+def _round_up_to_power_of_two(value):
+    return 1 << (max(1, value) - 1).bit_length()
+
+
+class BlockSizeTuner(object):
+    """
+    Chooses the request size of one connection by hill climbing: the data of
+    the requests completed in a window is measured, and after each window
+    the size is doubled or halved. The direction is kept as long as the
+    throughput improves, and reversed otherwise, so the size settles around
+    the one with the best throughput, within the constraints reported by the
+    server.
+
+    Sizes are powers of two and multiples of the server's minimum block size
+    (and 512 bytes, which PythonNbdClient requires).
+    """
+
+    def __init__(self,
+                 initial_block_size,
+                 constraints=None,
+                 adaptive=True,
+                 window_bytes=64 * 1024 * 1024,
+                 min_window_requests=4):
+        """
+        The constraints argument is the dictionary returned by
+        PythonNbdClient.get_block_size_constraints, or None.
+        If adaptive is False, the initial size, fitted to the constraints, is
+        kept, and the tuner is only used for measuring it.
+        """
+        self._constraints = constraints
+        self._adaptive = adaptive
+        minimum = DEFAULT_MIN_BLOCK_SIZE
+        maximum = DEFAULT_MAX_BLOCK_SIZE
+        if constraints is not None:
+            minimum = max(minimum, constraints['minimum_block_size'], 512)
+            maximum = min(constraints['maximum_block_size'],
+                          PROTOCOL_MAX_BLOCK_SIZE)
+            if not initial_block_size:
+                initial_block_size = constraints['preferred_block_size']
+        self._minimum = _round_up_to_power_of_two(minimum)
+        self._maximum = max(_round_down_to_power_of_two(maximum),
+                            self._minimum)
+        initial_block_size = initial_block_size or self._minimum
+        if adaptive:
+            initial_block_size = _round_down_to_power_of_two(
+                initial_block_size)
+        self._initial = self._clamp(initial_block_size)
+        self._block_size = self._initial
+        self._window_bytes = window_bytes
+        self._min_window_requests = min_window_requests
+        self._direction = 2
+        self._best_throughput = None
+        self._window_start = None
+        self._window_data = 0
+        self._window_requests = 0
+        self._window_latency = 0.0
+        # block size -> [bytes transferred, seconds spent, requests,
+        #                total latency of the requests]
+        self._history = {}
+        # For estimating the link: the time the first request was sent and
+        # the last one completed, the bytes transferred in between, and the
+        # shortest latency with the length of its request
+        self._first_sent = None
+        self._last_completed = None
+        self._total_bytes = 0
+        self._min_latency = None
+
+    def _clamp(self, block_size):
+        return min(max(block_size, self._minimum), self._maximum)
+
+    def block_size(self):
+        """
+        Returns the size to use for the next request.
+        """
+        return self._block_size
+
+    def record(self, length, latency):
+        """
+        Records a completed request of the given length, that took latency
+        seconds from sending the request to receiving its reply.
+        """
+        now = time.monotonic()
+        if self._first_sent is None:
+            self._first_sent = now - latency
+        self._last_completed = now
+        self._total_bytes += length
+        if self._min_latency is None or latency < self._min_latency[0]:
+            self._min_latency = (latency, length)
+        if self._window_start is None:
+            # The first window starts when the first request was sent
+            self._window_start = now - latency
+        self._window_data += length
+        self._window_requests += 1
+        self._window_latency += latency
+        if (self._window_data < self._window_bytes or
+                self._window_requests < self._min_window_requests):
+            return
+        elapsed = max(now - self._window_start, 1e-9)
+        throughput = self._window_data / elapsed
+        stats = self._history.setdefault(self._block_size, [0, 0.0, 0, 0.0])
+        stats[0] += self._window_data
+        stats[1] += elapsed
+        stats[2] += self._window_requests
+        stats[3] += self._window_latency
+        self._adjust(throughput)
+        self._window_start = now
+        self._window_data = 0
+        self._window_requests = 0
+        self._window_latency = 0.0
+
+    def _adjust(self, throughput):
+        if not self._adaptive:
+            return
+        if self._best_throughput is not None and \
+                throughput < self._best_throughput * IMPROVEMENT_THRESHOLD:
+            # No improvement: try the other direction
+            self._direction = 1 / self._direction
+        self._best_throughput = max(throughput, self._best_throughput or 0)
+        self._block_size = self._clamp(
+            int(self._block_size * self._direction))
+
+    def link_estimate(self):
+        """
+        Returns the estimated round-trip time and bandwidth of the link, in
+        a dictionary with the keys 'latency' (seconds) and 'bandwidth'
+        (bytes per second), or None if no request has been recorded.
+        The bandwidth is the throughput of all the requests, and the round
+        trip time is the shortest latency of a request, less the time
+        needed for transferring its data.
+        """
+        if self._min_latency is None:
+            return None
+        elapsed = self._last_completed - self._first_sent
+        if elapsed <= 0:
+            return None
+        bandwidth = self._total_bytes / elapsed
+        (latency, length) = self._min_latency
+        return {'latency': max(0.0, latency - length / bandwidth),
+                'bandwidth': bandwidth}
+
+    def report(self):
+        """
+        Returns a dictionary describing the block sizes chosen for this
+        connection: the server's constraints, the range of sizes
+        considered, the initial and the final size, and the throughput and
+        average latency measured at each size used.
+        """
+        sizes = {}
+        for (block_size, stats) in sorted(self._history.items()):
+            (data, elapsed, requests, latency) = stats
+            sizes[block_size] = {
+                'bytes': data,
+                'requests': requests,
+                'throughput': data / elapsed,
+                'average_latency': latency / requests,
+            }
+        return {
+            'adaptive': self._adaptive,
+            'server_constraints': self._constraints,
+            'minimum_block_size': self._minimum,
+            'maximum_block_size': self._maximum,
+            'initial_block_size': self._initial,
+            'final_block_size': self._block_size,
+            'sizes': sizes,
+            'link_estimate': self.link_estimate(),
+        }
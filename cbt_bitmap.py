@@ -3,15 +3,115 @@ Provides a class wrapping the return value of VDI.list_changed_blocks for
 extracting useful information from the CBT bitmap.
 """
 
+import array
 import base64
-
-from bitstring import BitArray
+import itertools
+import re
+import sys
 
 
 # 64K blocks
 BLOCK_SIZE = 64 * 1024
 
 
+def _byte_runs(value):
+    """
+    Returns the (start, end) runs of set bits of the given byte, most
+    significant bit first.
+    """
+    runs = []
+    bit = 0
+    while bit < 8:
+        if value & (0x80 >> bit):
+            start = bit
+            while bit < 8 and value & (0x80 >> bit):
+                bit += 1
+            runs.append((start, bit))
+        else:
+            bit += 1
+    return tuple(runs)
+
+
+_BYTE_RUNS = [_byte_runs(value) for value in range(256)]
+
+# The bitmap is scanned by the regex engine, so that Python code only runs
+# for the boundaries of the extents: first for the spans of non-zero bytes,
+# then within them for the runs of full bytes and the partially set bytes.
+_SPANS_PATTERN = re.compile(rb'[^\x00]+')
+_RUNS_PATTERN = re.compile(rb'\xff+|[^\xff]')
+
+
+def _bit_runs(cbt_bitmap):
+    """
+    Yields the (start, end) runs of set bits of the given bitmap, in
+    increasing order. The runs that continue in the next byte are not merged.
+    """
+    for span in _SPANS_PATTERN.finditer(cbt_bitmap):
+        for match in _RUNS_PATTERN.finditer(cbt_bitmap, *span.span()):
+            (first, last) = match.span()
+            if cbt_bitmap[first] == 0xff:
+                yield (first * 8, last * 8)
+                continue
+            for (start, end) in _BYTE_RUNS[cbt_bitmap[first]]:
+                yield (first * 8 + start, first * 8 + end)
+
+
+def _bitmap_runs(cbt_bitmap):
+    """
+    Finds the runs of set bits of the given bitmap, and computes the
+    statistics of the corresponding extents in the same pass.
+
+    Returns:
+        A tuple (runs, stats), where runs is an array of the consecutive
+        start and end block numbers of the increasingly ordered,
+        non-overlapping runs, and stats is the dictionary returned by
+        CbtBitmap.get_statistics, without the size of the disk.
+    """
+    runs = array.array('Q')
+    changed_blocks = 0
+    min_length = None
+    max_length = None
+    start = None
+    end = None
+    # The sentinel run at the end closes the last run:
+    for (run_start, run_end) in itertools.chain(_bit_runs(cbt_bitmap),
+                                                [(-1, -1)]):
+        if run_start == end:
+            end = run_end
+            continue
+        if start is not None:
+            runs.append(start)
+            runs.append(end)
+            length = end - start
+            changed_blocks += length
+            if min_length is None or length < min_length:
+                min_length = length
+            if max_length is None or length > max_length:
+                max_length = length
+        (start, end) = (run_start, run_end)
+    n = len(runs) // 2
+    changed_blocks_size = changed_blocks * BLOCK_SIZE
+    stats = {
+        'average_extent_length':
+            None if n == 0 else (changed_blocks_size / n),
+        'max_extent_length':
+            None if max_length is None else max_length * BLOCK_SIZE,
+        'min_extent_length':
+            None if min_length is None else min_length * BLOCK_SIZE,
+        'changed_blocks_size': changed_blocks_size,
+        'extents': n}
+    return (runs, stats)
+
+
+def _runs_to_extents(runs):
+    """
+    Yields the (offset in bytes, length in bytes) extents of the given array
+    of runs returned by _bitmap_runs.
+    """
+    for i in range(0, len(runs), 2):
+        yield (runs[i] * BLOCK_SIZE, (runs[i + 1] - runs[i]) * BLOCK_SIZE)
+
+
 def _bitmap_to_extents(cbt_bitmap):
     """
     Given a CBT bitmap with 64K block size, this function will return the
@@ -24,21 +124,8 @@ def _bitmap_to_extents(cbt_bitmap):
         An iterator containing the increasingly ordered sequence of the
         non-overlapping extents corresponding to this bitmap.
     """
-    start = None
-    bitmap = BitArray(cbt_bitmap)
-    for i in range(0, len(bitmap)):
-        if bitmap[i]:
-            if start is None:
-                start = i
-                length = 1
-            else:
-                length += 1
-        else:
-            if start is not None:
-                yield (start * BLOCK_SIZE, length * BLOCK_SIZE)
-                start = None
-    if start is not None:
-        yield (start * BLOCK_SIZE, length * BLOCK_SIZE)
+    (runs, _) = _bitmap_runs(cbt_bitmap)
+    return _runs_to_extents(runs)
 
 
 def _get_changed_blocks_size(cbt_bitmap):
@@ -46,35 +133,215 @@ def _get_changed_blocks_size(cbt_bitmap):
     Returns the overall size of the changed 64K blocks in the
     given bitmap in bytes.
     """
-    bitmap = BitArray(cbt_bitmap)
-    modified = 0
-    for bit in bitmap:
-        if bit:
-            modified += 1
-    return modified * BLOCK_SIZE
+    (_, stats) = _bitmap_runs(cbt_bitmap)
+    return stats['changed_blocks_size']
 
 
 def _get_disk_size(cbt_bitmap):
-    bitmap = BitArray(cbt_bitmap)
-    return len(bitmap) * BLOCK_SIZE
+    return len(cbt_bitmap) * 8 * BLOCK_SIZE
+
+
+def set_bits(bitmap, start, end):
+    """
+    Sets the bits start to end (excluded) of the given bytearray, most
+    significant bit first.
+    """
+    while start < end and start % 8:
+        bitmap[start // 8] |= 0x80 >> (start % 8)
+        start += 1
+    full_end = max(start, end - end % 8)
+    bitmap[start // 8:full_end // 8] = b'\xff' * ((full_end - start) // 8)
+    for bit in range(full_end, end):
+        bitmap[bit // 8] |= 0x80 >> (bit % 8)
+
+
+# The value of the sentinel bound appended to the bounds while combining sets
+_END = 2 ** 64 - 1
+
+
+def _combine(a, b, table):
+    """
+    Sweeps the sorted bounds of two extent sets, and returns the bounds of
+    the ranges that belong to the result of the set operation given by its
+    truth table, indexed by 2 * in_a + in_b.
+    """
+    bounds = array.array('Q')
+    a = a + array.array('Q', [_END])
+    b = b + array.array('Q', [_END])
+    (i, j) = (0, 0)
+    (in_a, in_b, inside) = (0, 0, False)
+    while True:
+        (next_a, next_b) = (a[i], b[j])
+        position = next_a if next_a < next_b else next_b
+        if position == _END:
+            return bounds
+        if next_a == position:
+            in_a ^= 1
+            i += 1
+        if next_b == position:
+            in_b ^= 1
+            j += 1
+        if table[2 * in_a + in_b] == inside:
+            continue
+        inside = not inside
+        if inside and bounds and bounds[-1] == position:
+            # Adjacent to the previous range, extend it
+            bounds.pop()
+        else:
+            bounds.append(position)
+
+
+# The format bytes of the serialized extent sets, see ExtentSet.to_bytes
+_BOUNDS_FORMAT = b'\x00'
+_BITMAP_FORMAT = b'\x01'
+
+# The truth tables of the set operations, for (not in a and not in b,
+# only in b, only in a, in a and in b)
+_UNION = (False, True, True, True)
+_INTERSECTION = (False, False, False, True)
+_DIFFERENCE = (False, False, True, False)
+
+
+class ExtentSet(object):
+    """
+    An immutable set of byte ranges of a disk, stored compactly as an array
+    of the consecutive start and end offsets of its sorted, non-overlapping
+    and non-adjacent extents, 16 bytes per extent.
+
+    Iterating over it yields the (offset, length) extents, like
+    CbtBitmap.get_extents, so it can be passed to the downloaders. The set
+    operations |, & and - take time linear in the number of extents.
+    """
+
+    def __init__(self, bounds=()):
+        """
+        Creates the set from the given sorted bounds of its extents, use
+        from_extents to create it from (offset, length) pairs.
+        """
+        self._bounds = array.array('Q', bounds)
+        if len(self._bounds) % 2:
+            raise ValueError("Odd number of extent bounds")
+
+    @classmethod
+    def from_extents(cls, extents):
+        """
+        Returns the set of the given (offset, length) extents, which may be
+        unordered, overlapping or empty.
+        """
+        bounds = array.array('Q')
+        for (offset, length) in sorted(extents):
+            if length == 0:
+                continue
+            if bounds and offset <= bounds[-1]:
+                bounds[-1] = max(bounds[-1], offset + length)
+            else:
+                bounds.append(offset)
+                bounds.append(offset + length)
+        return cls(bounds)
+
+    @classmethod
+    def from_bitmap(cls, bitmap, block_size=BLOCK_SIZE):
+        """
+        Returns the set of the blocks of the given size that are marked in
+        the given bitmap, most significant bit first, like in CBT bitmaps.
+        """
+        (runs, _) = _bitmap_runs(bitmap)
+        return cls._from_runs(runs, block_size)
+
+    @classmethod
+    def _from_runs(cls, runs, block_size):
+        return cls(bound * block_size for bound in runs)
+
+    def to_bitmap(self, block_size=BLOCK_SIZE, size=None):
+        """
+        Returns the bitmap of the blocks of the given size that overlap
+        this set, for a disk of the given size, by default just large enough
+        for the last extent.
+        """
+        if size is None:
+            size = self._bounds[-1] if self._bounds else 0
+        blocks = -(-size // block_size)
+        bitmap = bytearray(-(-blocks // 8))
+        for i in range(0, len(self._bounds), 2):
+            start = self._bounds[i] // block_size
+            end = min(-(-self._bounds[i + 1] // block_size), blocks)
+            if start < end:
+                set_bits(bitmap, start, end)
+        return bytes(bitmap)
+
+    def to_bytes(self):
+        """
+        Serializes the set as a format byte followed by whichever of its two
+        encodings is smaller: its bounds, little-endian 64-bit integers, or,
+        if they are all multiples of BLOCK_SIZE, the bitmap of its blocks of
+        BLOCK_SIZE bytes. A CBT bitmap needs 1 bit per block, whereas its
+        extents need 16 bytes each, which is much larger for scattered
+        changes.
+        """
+        bounds = self._bounds
+        end = bounds[-1] if bounds else 0
+        bitmap_length = -(-(end // BLOCK_SIZE) // 8)
+        if (bitmap_length < 8 * len(bounds) and
+                all(bound % BLOCK_SIZE == 0 for bound in bounds)):
+            return _BITMAP_FORMAT + self.to_bitmap()
+        if sys.byteorder != 'little':
+            bounds = array.array('Q', bounds)
+            bounds.byteswap()
+        return _BOUNDS_FORMAT + bounds.tobytes()
+
+    @classmethod
+    def from_bytes(cls, data):
+        """
+        Deserializes a set serialized by to_bytes.
+        """
+        (data_format, data) = (data[:1], data[1:])
+        if data_format == _BITMAP_FORMAT:
+            return cls.from_bitmap(data)
+        if data_format != _BOUNDS_FORMAT:
+            raise ValueError("Unknown extent set format")
+        if len(data) % 16:
+            raise ValueError("Truncated extent set")
+        bounds = array.array('Q')
+        bounds.frombytes(data)
+        if sys.byteorder != 'little':
+            bounds.byteswap()
+        return cls(bounds)
+
+    @property
+    def total_length(self):
+        """
+        The number of bytes in the set.
+        """
+        return sum(self._bounds[1::2]) - sum(self._bounds[0::2])
+
+    def __iter__(self):
+        bounds = self._bounds
+        for i in range(0, len(bounds), 2):
+            yield (bounds[i], bounds[i + 1] - bounds[i])
+
+    def __len__(self):
+        return len(self._bounds) // 2
+
+    def __eq__(self, other):
+        if not isinstance(other, ExtentSet):
+            return NotImplemented
+        return self._bounds == other._bounds
+
+    def __repr__(self):
+        return 'ExtentSet.from_extents({!r})'.format(list(self))
+
+    def __or__(self, other):
+        return ExtentSet(_combine(
+            self._bounds, other._bounds, _UNION))
+
+    def __and__(self, other):
+        return ExtentSet(_combine(
+            self._bounds, other._bounds, _INTERSECTION))
+
+    def __sub__(self, other):
+        return ExtentSet(_combine(
+            self._bounds, other._bounds, _DIFFERENCE))
 
-def _get_extent_stats(extents):
-    average_length = None
-    max_length = None
-    min_length = None
-    changed_blocks_size = 0
-    n = 0
-    for (offset, length) in extents:
-        n += 1
-        changed_blocks_size += length
-        max_length = length if max_length is None else max(max_length, length)
-        min_length = length if min_length is None else min(min_length, length)
-    average_length = None if n == 0 else (changed_blocks_size / n)
-    return { 'average_extent_length': average_length,
-             'max_extent_length': max_length,
-             'min_extent_length': min_length,
-             'changed_blocks_size': changed_blocks_size,
-             'extents': n }
 
 class CbtBitmap(object):
     """
@@ -87,20 +354,38 @@ class CbtBitmap(object):
         Decodes the given base64-encoded CBT bitmap.
         """
         self.bitmap = base64.b64decode(cbt_bitmap_b64)
+        self._runs = None
+        self._stats = None
+
+    def _decode(self):
+        """
+        Extracts the runs of changed blocks and their statistics from the
+        bitmap, only once.
+        """
+        if self._runs is None:
+            (self._runs, self._stats) = _bitmap_runs(self.bitmap)
 
     def get_extents(self):
         """
         Returns an iterator containing the increasingly ordered sequence
         of the non-overlapping extents corresponding to this bitmap.
         """
-        extents = _bitmap_to_extents(self.bitmap)
-        return extents
+        self._decode()
+        return _runs_to_extents(self._runs)
+
+    def get_extent_set(self):
+        """
+        Returns the ExtentSet of the changed blocks.
+        """
+        self._decode()
+        return ExtentSet._from_runs(self._runs, BLOCK_SIZE)
 
     def get_statistics(self):
         """
         Return the size of the disk, and the total size of the changed
         blocks in a dictionary.
         """
-        stats = _get_extent_stats(self.get_extents())
+        self._decode()
+        stats = dict(self._stats)
         stats["size"] = _get_disk_size(self.bitmap)
         return stats
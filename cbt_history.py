@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+
+"""
+Keeps the changed blocks of each incremental VDI backup next to its data, so
+that the blocks that changed between two local backups of a VM can be found
+without contacting the pool, for example to restore, verify or copy only
+what changed, or to report how much data changes between backups.
+
+The backups of a VM are stored in <backup dir>/<VM UUID>/<timestamp>/, with
+the data of each VDI in vdis/<snapshot VDI UUID>/data. An incremental backup
+also stores there the ExtentSet of the blocks changed since its base backup,
+and the UUID of the snapshot VDI of its base backup.
+"""
+
+from pathlib import Path
+import argparse
+import json
+
+from cbt_bitmap import ExtentSet
+from hash_manifest import load_manifest
+
+# The serialized ExtentSet of the blocks changed since the base backup, as
+# a bitmap of the CBT blocks unless its extents are smaller
+CHANGED_BLOCKS_FILE = 'changed_blocks'
+
+# The UUID of the snapshot VDI of the base backup
+BASE_FILE = 'changed_blocks_base'
+
+
+def save_changed_blocks(vdi_dir, changed_blocks, base_snapshot_uuid):
+    """
+    Stores the ExtentSet of the blocks that changed since the backup of the
+    given snapshot VDI in the directory of a VDI backup.
+    """
+    vdi_dir = Path(vdi_dir)
+    with (vdi_dir / CHANGED_BLOCKS_FILE).open('wb') as out:
+        out.write(changed_blocks.to_bytes())
+    with (vdi_dir / BASE_FILE).open('w') as out:
+        out.write(base_snapshot_uuid)
+
+
+def load_changed_blocks(vdi_dir):
+    """
+    Returns the UUID of the snapshot VDI of the base backup and the
+    ExtentSet of the blocks changed since, for the given VDI backup, or None
+    for a full backup.
+    """
+    vdi_dir = Path(vdi_dir)
+    try:
+        with (vdi_dir / BASE_FILE).open('r') as infile:
+            base_snapshot_uuid = infile.readline().strip()
+        with (vdi_dir / CHANGED_BLOCKS_FILE).open('rb') as infile:
+            changed_blocks = ExtentSet.from_bytes(infile.read())
+    except FileNotFoundError:
+        return None
+    return (base_snapshot_uuid, changed_blocks)
+
+
+def _vdi_backups(vm_dir, timestamp):
+    """
+    Returns the directories of the VDI backups of the given backup of a VM,
+    by the UUID of the VDI that was snapshotted.
+    """
+    vdi_dirs = {}
+    for vdi_dir in (Path(vm_dir) / timestamp / 'vdis').iterdir():
+        with (vdi_dir / 'original_uuid').open('r') as infile:
+            vdi_dirs[infile.readline().strip()] = vdi_dir
+    return vdi_dirs
+
+
+def _find_vdi_backup(vm_dir, snapshot_uuid):
+    return next(Path(vm_dir).glob('*/vdis/{}'.format(snapshot_uuid)), None)
+
+
+def changes_between(vm_dir, from_timestamp, to_timestamp):
+    """
+    Returns the ExtentSets of the blocks that changed between two backups of
+    a VM, by the UUID of the VDI that was snapshotted, for the VDIs in the
+    later backup. The changes of the incremental backups are combined along
+    the chain of their base backups. The whole disk is considered changed
+    if the chain does not lead back to the earlier backup, for example
+    because of a full backup in between.
+    """
+    from_vdis = _vdi_backups(vm_dir, from_timestamp)
+    changes = {}
+    for (original_uuid, vdi_dir) in _vdi_backups(vm_dir, to_timestamp).items():
+        if (vdi_dir / 'data').exists():
+            size = (vdi_dir / 'data').stat().st_size
+        else:
+            # Kept in the chunk store
+            size = load_manifest(vdi_dir).size
+        from_dir = from_vdis.get(original_uuid)
+        changed_blocks = ExtentSet()
+        while vdi_dir is not None and vdi_dir != from_dir:
+            saved = load_changed_blocks(vdi_dir)
+            if saved is None:
+                vdi_dir = None
+                break
+            (base_snapshot_uuid, blocks) = saved
+            changed_blocks = changed_blocks | blocks
+            vdi_dir = _find_vdi_backup(vm_dir, base_snapshot_uuid)
+        if vdi_dir is None:
+            changed_blocks = ExtentSet.from_extents([(0, size)])
+        changes[original_uuid] = changed_blocks
+    return changes
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Reports the blocks that changed between two local backups of a VM")
+    parser.add_argument('--backup-dir', type=Path, default=Path.home() / ".cbt_backups", help="The directory of the backups")
+    parser.add_argument('--vm', required=True, help="The UUID of the locally backed up VM")
+    parser.add_argument('--from', dest='from_timestamp', required=True, help="The timestamp of the earlier backup")
+    parser.add_argument('--to', dest='to_timestamp', required=True, help="The timestamp of the later backup")
+    parser.add_argument('--extents', action='store_true', help="Also list the changed (offset, length) extents")
+    args = parser.parse_args()
+
+    changes = changes_between(
+        vm_dir=args.backup_dir / args.vm,
+        from_timestamp=args.from_timestamp,
+        to_timestamp=args.to_timestamp)
+    report = {}
+    for (original_uuid, changed_blocks) in changes.items():
+        report[original_uuid] = {
+            'changed_bytes': changed_blocks.total_length,
+            'extents': len(changed_blocks),
+        }
+        if args.extents:
+            report[original_uuid]['changed_extents'] = list(changed_blocks)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,347 @@
+"""
+A content-addressed store of the blocks of the backed up VDIs, shared by all
+the backups, in which each distinct block is stored only once, whichever
+VDI, VM or backup it comes from.
+
+The blocks are the 1 MiB blocks of the block hash manifests (see
+hash_manifest), and each one is stored in a chunk file named by its hash.
+A VDI backup in the store keeps no data file: its manifest is the map of
+the chunks that make up its data, and the blocks that only contain zeroes
+are not stored at all. The hashes of the stored chunks are appended to an
+index, which is loaded once, so that finding out whether a chunk is already
+stored does not read it.
+
+The chunks, their directories and the index are synced to the disk before
+put returns, so that the data file of a backup can be deleted once it is in
+the store.
+"""
+
+from pathlib import Path
+import contextlib
+import hashlib
+import os
+import tempfile
+import threading
+
+from hash_manifest import (
+    DIGEST_SIZE, MANIFEST_FILE, HashManifest, load_manifest)
+from sparse_file import FileReader
+
+# The name of the chunk store in the backup directory
+CHUNKS_DIR = 'chunks'
+
+# The hashes of the stored chunks, one after the other
+INDEX_FILE = 'index'
+
+
+def _fsync_directory(path):
+    """
+    Makes the entries of the given directory durable.
+    """
+    fd = os.open(str(path), os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def is_chunked_backup(vdi_dir):
+    """
+    Returns True if the given VDI backup is kept in the chunk store, rather
+    than in a data file.
+    """
+    vdi_dir = Path(vdi_dir)
+    return (not (vdi_dir / 'data').exists() and
+            (vdi_dir / MANIFEST_FILE).exists())
+
+
+class ChunkStore(object):
+    """
+    The chunk store in the given directory, which is created if needed.
+    Can be shared by several threads.
+    """
+
+    def __init__(self, path):
+        self._path = Path(path)
+        self._lock = threading.Lock()
+        self._index = None
+
+    @property
+    def path(self):
+        """
+        The directory of the chunk store.
+        """
+        return self._path
+
+    def _chunk_path(self, digest):
+        name = digest.hex()
+        return self._path / name[:2] / name[2:]
+
+    def _load_index(self):
+        """
+        Returns the set of the hashes of the stored chunks, loading the
+        index the first time.
+        """
+        with self._lock:
+            if self._index is None:
+                self._path.mkdir(parents=True, exist_ok=True)
+                index = set()
+                try:
+                    with (self._path / INDEX_FILE).open('rb') as infile:
+                        data = infile.read()
+                except FileNotFoundError:
+                    data = b''
+                # A partly written last entry is ignored
+                for start in range(0, len(data) - len(data) % DIGEST_SIZE,
+                                   DIGEST_SIZE):
+                    index.add(data[start:start + DIGEST_SIZE])
+                self._index = index
+            return self._index
+
+    def _is_stored(self, index, digest, length):
+        """
+        Returns True if the chunk with the given hash and length is in the
+        index, and its file is there with the right size: an index entry may
+        have outlived its chunk, for example after a crash.
+        """
+        if digest not in index:
+            return False
+        try:
+            return self._chunk_path(digest).stat().st_size == length
+        except FileNotFoundError:
+            return False
+
+    def _store_chunk(self, digest, data):
+        """
+        Writes the given chunk durably, and returns its directory, which
+        still has to be synced.
+        """
+        path = self._chunk_path(digest)
+        path.parent.mkdir(exist_ok=True)
+        # Written under a temporary name, so that a chunk file is always
+        # complete:
+        temporary = path.with_name('{}.{}.{}.tmp'.format(
+            path.name, os.getpid(), threading.get_ident()))
+        with temporary.open('wb') as out:
+            out.write(data)
+            out.flush()
+            os.fsync(out.fileno())
+        os.replace(str(temporary), str(path))
+        return path.parent
+
+    def _add_to_index(self, digests):
+        """
+        Appends the hashes of the given chunks, which are already durable,
+        to the index, and syncs it.
+        """
+        with self._lock:
+            with (self._path / INDEX_FILE).open('ab') as out:
+                out.write(b''.join(digests))
+                out.flush()
+                os.fsync(out.fileno())
+            self._index.update(digests)
+
+    def put(self, manifest, path):
+        """
+        Stores the blocks of the given file, whose HashManifest is given,
+        that are neither stored yet nor only zeroes. Only these blocks are
+        read from the file, so for an incremental backup, only its changed
+        blocks need to be in it. Each block is checked against its hash in
+        the manifest before it is stored, and a ValueError is raised if it
+        does not match. Everything is synced to the disk when it returns.
+
+        Returns:
+            A dictionary with the number of bytes of the non-zero blocks of
+            the file, of the ones that were not stored yet and were written,
+            and the ratio of the two, the deduplication ratio of the backup.
+        """
+        index = self._load_index()
+        referenced_bytes = 0
+        written_bytes = 0
+        written = set()
+        directories = set()
+        with FileReader(path) as reader:
+            for block in range(manifest.blocks):
+                if manifest.is_zero_block(block):
+                    continue
+                (offset, length) = manifest.block_range(block)
+                referenced_bytes += length
+                digest = manifest.block_hash(block)
+                if (digest in written or
+                        self._is_stored(index, digest, length)):
+                    continue
+                data = bytearray(length)
+                reader.pread_into(memoryview(data), offset)
+                if HashManifest.hash_block(data) != digest:
+                    raise ValueError(
+                        "Block at offset {} of {} does not match its "
+                        "manifest".format(offset, path))
+                directories.add(self._store_chunk(digest, data))
+                written.add(digest)
+                written_bytes += length
+        # The chunks are only indexed once their directory entries are
+        # durable, and the new directories once the store's entries are:
+        for directory in directories:
+            _fsync_directory(directory)
+        _fsync_directory(self._path)
+        if written:
+            self._add_to_index(written)
+        return {
+            'referenced_bytes': referenced_bytes,
+            'written_bytes': written_bytes,
+            'dedup_ratio': (referenced_bytes / written_bytes
+                            if written_bytes else None),
+        }
+
+    def read_chunk(self, manifest, block):
+        """
+        Returns the data of the given block of a backup, given its manifest.
+        """
+        (_, length) = manifest.block_range(block)
+        if manifest.is_zero_block(block):
+            return bytes(length)
+        digest = manifest.block_hash(block)
+        with self._chunk_path(digest).open('rb') as infile:
+            data = infile.read()
+        if (len(data) != length or
+                HashManifest.hash_block(data) != digest):
+            raise ValueError("Corrupt chunk {}".format(digest.hex()))
+        return data
+
+    def verify(self, manifest, extents=None):
+        """
+        Returns the list of the (offset, length) blocks of a backup, given
+        its manifest, overlapping the given (offset, length) extents, or all
+        of them, whose chunk is missing or corrupt.
+        """
+        mismatches = []
+        for block in manifest.blocks_overlapping(extents):
+            try:
+                self.read_chunk(manifest, block)
+            except (OSError, ValueError):
+                mismatches.append(manifest.block_range(block))
+        return mismatches
+
+    def write_blocks(self, manifest, path, extents=None):
+        """
+        Writes the blocks of a backup overlapping the given (offset, length)
+        extents, or all of them, to the given file, which is extended to the
+        size of the backup. The zero blocks are left as holes.
+        """
+        fd = os.open(str(path), os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size < manifest.size:
+                os.ftruncate(fd, manifest.size)
+            for block in manifest.blocks_overlapping(extents):
+                if manifest.is_zero_block(block):
+                    continue
+                (offset, _) = manifest.block_range(block)
+                data = memoryview(self.read_chunk(manifest, block))
+                while data:
+                    written = os.pwrite(fd, data, offset)
+                    data = data[written:]
+                    offset += written
+        finally:
+            os.close(fd)
+
+    def reader(self, vdi_dir):
+        """
+        Returns a ChunkMapReader of the data of the given VDI backup.
+        """
+        return ChunkMapReader(store=self, manifest=load_manifest(vdi_dir))
+
+
+class ChunkMapReader(object):
+    """
+    Reads the data of a backup from the chunk store, with the methods of
+    sparse_file.FileReader, so that it can be restored without writing it
+    to a file first. The blocks that only contain zeroes are reported as
+    holes.
+    """
+
+    def __init__(self, store, manifest):
+        self._store = store
+        self._manifest = manifest
+        self.size = manifest.size
+        # The last block read, as several reads usually fall into it
+        self._cached = (None, None)
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def extents(self, offset, length):
+        """
+        Yields the (offset, length, is_data) extents of the given range,
+        where is_data is False for the zero blocks.
+        """
+        end = min(offset + length, self.size)
+        manifest = self._manifest
+        run = None
+        for block in manifest.blocks_overlapping([(offset, end - offset)]):
+            (block_offset, block_length) = manifest.block_range(block)
+            start = max(block_offset, offset)
+            block_end = min(block_offset + block_length, end)
+            is_data = not manifest.is_zero_block(block)
+            if run is not None and run[2] == is_data:
+                run = (run[0], block_end - run[0], is_data)
+                continue
+            if run is not None:
+                yield run
+            run = (start, block_end - start, is_data)
+        if run is not None:
+            yield run
+
+    def _chunk(self, block):
+        with self._lock:
+            (cached_block, data) = self._cached
+        if cached_block != block:
+            data = self._store.read_chunk(self._manifest, block)
+            with self._lock:
+                self._cached = (block, data)
+        return data
+
+    def pread_into(self, view, offset):
+        """
+        Fills the given writable memoryview with the data at the given
+        offset.
+        """
+        if offset + len(view) > self.size:
+            raise EOFError(
+                "Unexpected end of backup at offset {}".format(self.size))
+        block_size = self._manifest.block_size
+        while view:
+            block = offset // block_size
+            start = offset - block * block_size
+            data = self._chunk(block)
+            length = min(len(view), len(data) - start)
+            view[:length] = data[start:start + length]
+            view = view[length:]
+            offset += length
+
+    def md5sum(self):
+        """
+        Returns the MD5 checksum of the data, like md5sum.md5sum for a file.
+        """
+        hasher = hashlib.md5()
+        for block in range(self._manifest.blocks):
+            hasher.update(self._store.read_chunk(self._manifest, block))
+        return hasher.hexdigest()
+
+    @contextlib.contextmanager
+    def temporary_file(self):
+        """
+        Writes the data to a temporary sparse file in the chunk store, for
+        the consumers that need a file, and yields its path.
+        """
+        with tempfile.TemporaryDirectory(
+                dir=str(self._store.path)) as directory:
+            path = Path(directory) / 'data'
+            self._store.write_blocks(manifest=self._manifest, path=path)
+            yield path
+
+    def close(self):
+        self._cached = (None, None)
@@ -0,0 +1,74 @@
+"""
+Merges the extents to download that are separated by small gaps, when
+reading the unchanged data of a gap costs less than the extra requests
+needed for downloading the extents separately.
+"""
+
+import array
+
+from cbt_bitmap import ExtentSet
+
+# Used when the latency or the bandwidth of the link is neither configured
+# nor measured yet
+DEFAULT_LATENCY = 0.001
+DEFAULT_BANDWIDTH = 100 * 1024 * 1024
+
+
+def _requests(length, block_size):
+    """
+    Returns the number of requests of at most block_size bytes needed for
+    downloading an extent of the given length.
+    """
+    return -(-length // block_size)
+
+
+def coalesce_extents(extents,
+                     block_size,
+                     latency=DEFAULT_LATENCY,
+                     bandwidth=DEFAULT_BANDWIDTH):
+    """
+    Merges the increasingly ordered, non-overlapping (offset, length)
+    extents across the gaps between them, whenever the requests of at most
+    block_size bytes that merging saves cost more, at latency seconds each,
+    than reading the gap at bandwidth bytes per second.
+
+    Returns:
+        A tuple (extent_set, report), where extent_set is the ExtentSet of
+        the merged extents, and report is a dictionary with the number of
+        extents and requests before and after merging, and the number of
+        bytes of the gaps that are read in addition.
+    """
+    bounds = array.array('Q')
+    extents_before = 0
+    requests_before = 0
+    gap_bytes = 0
+    # Merging pays off when the gap is shorter than the data that could be
+    # transferred during the round trips saved:
+    bytes_per_request = latency * bandwidth
+    for (offset, length) in extents:
+        extents_before += 1
+        requests_before += _requests(length, block_size)
+        if bounds:
+            (start, end) = (bounds[-2], bounds[-1])
+            gap = offset - end
+            saved = (_requests(end - start, block_size) +
+                     _requests(length, block_size) -
+                     _requests(offset + length - start, block_size))
+            if saved * bytes_per_request > gap:
+                bounds[-1] = offset + length
+                gap_bytes += gap
+                continue
+        bounds.append(offset)
+        bounds.append(offset + length)
+    extent_set = ExtentSet(bounds)
+    requests_after = sum(_requests(length, block_size)
+                         for (_, length) in extent_set)
+    return (extent_set, {
+        'latency': latency,
+        'bandwidth': bandwidth,
+        'extents_before': extents_before,
+        'extents_after': len(extent_set),
+        'requests_before': requests_before,
+        'requests_after': requests_after,
+        'gap_bytes': gap_bytes,
+    })
@@ -0,0 +1,580 @@
+#!/usr/bin/env python3
+
+"""
+Keeps a manifest of the hashes of the fixed-size blocks of each VDI backup
+next to its data, so that an incremental backup only has to hash the blocks
+that changed since its base backup, and any range of a backup can be
+verified later without reading the rest of it.
+
+The block hashes are the leaves of a hash tree, whose root identifies the
+whole content of the backup: two backups with the same root hash have the
+same data, and a manifest whose root does not match its blocks is corrupt.
+The blocks are hashed by several threads at once, as hashlib releases the
+GIL while hashing, and the holes of the backups are not read. While a backup
+is downloaded, a BlockHasher hashes the blocks from the received buffers,
+so that only the blocks that did not arrive in one piece are read back.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import argparse
+import collections
+import hashlib
+import json
+import os
+import re
+import struct
+
+from sparse_file import file_extents
+
+# The name of the manifest in the directory of a VDI backup
+MANIFEST_FILE = 'block_hashes'
+
+# 1 MiB blocks: the manifest of a 2 TiB disk takes 32 MiB
+BLOCK_SIZE = 1024 * 1024
+DIGEST_SIZE = 16
+
+# The number of hashes combined by each node of the tree
+FANOUT = 1024
+
+# The number of consecutive blocks hashed by one task
+_TASK_BLOCKS = 64
+
+_MAGIC = b'CBTHASH1'
+# magic, block size, size of the disk, root hash
+_HEADER = struct.Struct('<8sQQ{}s'.format(DIGEST_SIZE))
+
+
+def _hash(data, person):
+    return hashlib.blake2b(
+        data, digest_size=DIGEST_SIZE, person=person).digest()
+
+
+def _block_hash(data):
+    return _hash(data, b'block')
+
+
+def _node_hash(data):
+    return _hash(data, b'node')
+
+
+class HashManifest(object):
+    """
+    The hashes of the blocks of block_size bytes of a disk of the given
+    size, the last block being shorter if the size is not a multiple of the
+    block size.
+    """
+
+    def __init__(self, size, block_size=BLOCK_SIZE, hashes=None):
+        self.size = size
+        self.block_size = block_size
+        blocks = -(-size // block_size)
+        if hashes is None:
+            hashes = bytes(blocks * DIGEST_SIZE)
+        if len(hashes) != blocks * DIGEST_SIZE:
+            raise ValueError("Expected {} block hashes".format(blocks))
+        self._hashes = bytearray(hashes)
+        self._zero_hashes = {}
+
+    @property
+    def blocks(self):
+        """
+        The number of blocks of the disk.
+        """
+        return len(self._hashes) // DIGEST_SIZE
+
+    def block_hash(self, block):
+        """
+        Returns the hash of the given block.
+        """
+        return bytes(
+            self._hashes[block * DIGEST_SIZE:(block + 1) * DIGEST_SIZE])
+
+    def _set_block_hash(self, block, digest):
+        self._hashes[block * DIGEST_SIZE:(block + 1) * DIGEST_SIZE] = digest
+
+    def root_hash(self):
+        """
+        Returns the root of the hash tree over the block hashes, in which
+        each node is the hash of up to FANOUT hashes of the level below.
+        """
+        level = bytes(self._hashes)
+        width = FANOUT * DIGEST_SIZE
+        while len(level) > DIGEST_SIZE:
+            level = b''.join(_node_hash(level[start:start + width])
+                             for start in range(0, len(level), width))
+        return level or _node_hash(b'')
+
+    def block_range(self, block):
+        """
+        Returns the (offset, length) range of the given block.
+        """
+        offset = block * self.block_size
+        return (offset, min(self.block_size, self.size - offset))
+
+    def is_zero_block(self, block):
+        """
+        Returns True if the given block only contains zeroes.
+        """
+        (_, length) = self.block_range(block)
+        return self.block_hash(block) == self._zero_hash(length)
+
+    def blocks_overlapping(self, extents=None):
+        """
+        Yields the blocks that overlap the given (offset, length) extents,
+        in increasing order, or all the blocks.
+        """
+        if extents is None:
+            extents = [(0, self.size)]
+        for (first, last) in self._block_ranges(extents):
+            yield from range(first, last)
+
+    @staticmethod
+    def hash_block(data):
+        """
+        Returns the hash of the given block data.
+        """
+        return _block_hash(data)
+
+    def _zero_hash(self, length):
+        if length not in self._zero_hashes:
+            self._zero_hashes[length] = _block_hash(bytes(length))
+        return self._zero_hashes[length]
+
+    def _hash_blocks(self, fd, first, last):
+        """
+        Returns the hashes of the blocks first to last (excluded) of the
+        given file, without reading the blocks that are entirely in holes.
+        """
+        (start, _) = self.block_range(first)
+        end = min(last * self.block_size, self.size)
+        data_extents = collections.deque(
+            (offset, offset + length)
+            for (offset, length, is_data)
+            in file_extents(fd, start, end - start)
+            if is_data)
+        hashes = []
+        for block in range(first, last):
+            (offset, length) = self.block_range(block)
+            while data_extents and data_extents[0][1] <= offset:
+                data_extents.popleft()
+            if data_extents and data_extents[0][0] < offset + length:
+                data = os.pread(fd, length, offset)
+                if len(data) < length:
+                    # Beyond the end of the file
+                    data += bytes(length - len(data))
+                hashes.append(_block_hash(data))
+            else:
+                hashes.append(self._zero_hash(length))
+        return hashes
+
+    def _block_ranges(self, extents):
+        """
+        Yields the (first, last) ranges of at most _TASK_BLOCKS blocks that
+        cover the given (offset, length) extents, in increasing order.
+        """
+        (first, last) = (None, None)
+        for (offset, length) in extents:
+            if length == 0:
+                continue
+            start = offset // self.block_size
+            end = min(-(-(offset + length) // self.block_size), self.blocks)
+            if first is not None and start <= last:
+                last = max(last, end)
+                continue
+            if first is not None:
+                yield from self._split(first, last)
+            (first, last) = (start, end)
+        if first is not None:
+            yield from self._split(first, last)
+
+    @staticmethod
+    def _split(first, last):
+        for start in range(first, last, _TASK_BLOCKS):
+            yield (start, min(start + _TASK_BLOCKS, last))
+
+    def _hash_ranges(self, fd, ranges, workers):
+        """
+        Yields the first block and the hashes of the given block ranges of
+        the file, hashed by the given number of threads, keeping a bounded
+        number of ranges in flight.
+        """
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            pending = collections.deque()
+            for (first, last) in ranges:
+                pending.append(
+                    (first, pool.submit(self._hash_blocks, fd, first, last)))
+                if len(pending) >= 4 * workers:
+                    (block, future) = pending.popleft()
+                    yield (block, future.result())
+            while pending:
+                (block, future) = pending.popleft()
+                yield (block, future.result())
+
+    def rehash(self, path, extents=None, workers=None):
+        """
+        Hashes the blocks of the given file that overlap the given
+        (offset, length) extents, in increasing order, or all of them, and
+        stores their hashes. Returns the number of blocks hashed.
+        """
+        if extents is None:
+            extents = [(0, self.size)]
+        workers = workers or os.cpu_count() or 1
+        hashed = 0
+        fd = os.open(str(path), os.O_RDONLY)
+        try:
+            for (block, hashes) in self._hash_ranges(
+                    fd, self._block_ranges(extents), workers):
+                self._hashes[block * DIGEST_SIZE:
+                             (block + len(hashes)) * DIGEST_SIZE] = \
+                    b''.join(hashes)
+                hashed += len(hashes)
+        finally:
+            os.close(fd)
+        return hashed
+
+    def rehash_with_md5(self, path, extents=None, workers=None):
+        """
+        Like rehash, but reads the whole file once, in order, to compute its
+        MD5 checksum as md5sum.md5sum does, and hashes the blocks from the
+        same reads, so that a backup compared with the checksum computed by
+        the server is not read twice. Returns the number of blocks hashed,
+        and the MD5 checksum.
+        """
+        workers = workers or os.cpu_count() or 1
+        wanted = bytearray(self.blocks)
+        for block in self.blocks_overlapping(extents):
+            wanted[block] = 1
+        md5 = hashlib.md5()
+        hashed = 0
+        fd = os.open(str(path), os.O_RDONLY)
+        try:
+            # The blocks entirely in holes are not read
+            data_extents = (
+                (offset, offset + length)
+                for (offset, length, is_data)
+                in file_extents(fd, 0, self.size)
+                if is_data)
+            data_extent = next(data_extents, None)
+            zeroes = memoryview(bytes(self.block_size))
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                pending = collections.deque()
+                for block in range(self.blocks):
+                    (offset, length) = self.block_range(block)
+                    while data_extent and data_extent[1] <= offset:
+                        data_extent = next(data_extents, None)
+                    if not (data_extent and
+                            data_extent[0] < offset + length):
+                        md5.update(zeroes[:length])
+                        if wanted[block]:
+                            self._set_block_hash(
+                                block, self._zero_hash(length))
+                            hashed += 1
+                        continue
+                    data = os.pread(fd, length, offset)
+                    if len(data) < length:
+                        # Beyond the end of the file
+                        data += bytes(length - len(data))
+                    md5.update(data)
+                    if not wanted[block]:
+                        continue
+                    pending.append((block, pool.submit(_block_hash, data)))
+                    if len(pending) >= 4 * workers:
+                        (done, future) = pending.popleft()
+                        self._set_block_hash(done, future.result())
+                    hashed += 1
+                while pending:
+                    (done, future) = pending.popleft()
+                    self._set_block_hash(done, future.result())
+        finally:
+            os.close(fd)
+        return (hashed, md5.hexdigest())
+
+    def verify(self, path, extents=None, workers=None):
+        """
+        Hashes the blocks of the given file that overlap the given
+        (offset, length) extents, or all of them, and returns the list of
+        the (offset, length) blocks whose hash does not match the manifest.
+        """
+        manifest = HashManifest(
+            size=self.size, block_size=self.block_size, hashes=self._hashes)
+        if extents is None:
+            extents = [(0, self.size)]
+        extents = list(extents)
+        manifest.rehash(path=path, extents=extents, workers=workers)
+        return [self.block_range(block)
+                for block in self.blocks_overlapping(extents)
+                if manifest.block_hash(block) != self.block_hash(block)]
+
+    @classmethod
+    def compute(cls, path, size=None, block_size=BLOCK_SIZE, workers=None):
+        """
+        Returns the manifest of the given file, or of its first size bytes.
+        """
+        if size is None:
+            size = os.stat(str(path)).st_size
+        manifest = cls(size=size, block_size=block_size)
+        manifest.rehash(path=path, workers=workers)
+        return manifest
+
+    def copy(self):
+        """
+        Returns a copy of this manifest, to update for a later backup.
+        """
+        return HashManifest(
+            size=self.size, block_size=self.block_size, hashes=self._hashes)
+
+    def to_bytes(self):
+        """
+        Serializes the manifest, with its root hash.
+        """
+        return _HEADER.pack(_MAGIC, self.block_size, self.size,
+                            self.root_hash()) + bytes(self._hashes)
+
+    @classmethod
+    def from_bytes(cls, data):
+        """
+        Deserializes a manifest serialized by to_bytes, and checks that its
+        block hashes match its root hash.
+        """
+        if len(data) < _HEADER.size:
+            raise ValueError("Truncated block hash manifest")
+        (magic, block_size, size, root) = _HEADER.unpack_from(data)
+        if magic != _MAGIC:
+            raise ValueError("Not a block hash manifest")
+        manifest = cls(size=size, block_size=block_size,
+                       hashes=data[_HEADER.size:])
+        if manifest.root_hash() != root:
+            raise ValueError("Corrupt block hash manifest")
+        return manifest
+
+
+class BlockHasher(object):
+    """
+    Hashes the blocks of a disk of the given size while it is downloaded,
+    from the buffers of the received data, with the given number of threads,
+    one per CPU by default. Only the blocks that lie entirely in one buffer
+    of data or in one hole are hashed this way, the others, such as the
+    blocks at the edges of the changed extents of an incremental backup, are
+    left to HashManifest.rehash.
+    Can be shared by several threads.
+    """
+
+    def __init__(self, size, block_size=BLOCK_SIZE, workers=None):
+        self._manifest = HashManifest(size=size, block_size=block_size)
+        # 1 for the blocks already hashed
+        self._hashed = bytearray(self._manifest.blocks)
+        self._pool = ThreadPoolExecutor(
+            max_workers=workers or os.cpu_count() or 1)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def size(self):
+        """
+        The size of the disk.
+        """
+        return self._manifest.size
+
+    def _blocks_within(self, offset, length):
+        """
+        Returns the range of the blocks that lie entirely in the given range.
+        """
+        manifest = self._manifest
+        first = -(-offset // manifest.block_size)
+        end = offset + length
+        if end >= manifest.size:
+            # Including the last block, which may be shorter
+            last = manifest.blocks
+        else:
+            last = end // manifest.block_size
+        return range(first, max(first, last))
+
+    def _hash(self, block, view):
+        with view:
+            self._manifest._set_block_hash(block, _block_hash(view))
+        self._hashed[block] = 1
+
+    def data(self, offset, view):
+        """
+        Hands the blocks that lie entirely in the given received data, at the
+        given offset of the disk, to the hash threads. Returns the futures of
+        their hashes, which must be complete before the buffer is reused.
+        """
+        futures = []
+        for block in self._blocks_within(offset, len(view)):
+            (block_offset, length) = self._manifest.block_range(block)
+            start = block_offset - offset
+            futures.append(self._pool.submit(
+                self._hash, block, view[start:start + length]))
+        return futures
+
+    def hole(self, offset, length):
+        """
+        Records the hashes of the blocks that lie entirely in the given
+        range, which reads back as zeroes.
+        """
+        manifest = self._manifest
+        for block in self._blocks_within(offset, length):
+            (_, block_length) = manifest.block_range(block)
+            manifest._set_block_hash(block, manifest._zero_hash(block_length))
+            self._hashed[block] = 1
+
+    def close(self):
+        """
+        Waits for the blocks handed to the hash threads to be hashed, and
+        stops the threads.
+        """
+        self._pool.shutdown(wait=True)
+
+    def update(self, manifest):
+        """
+        Copies the hashes of the blocks hashed so far into the given
+        HashManifest of the same disk. Returns a bytearray with 1 for each of
+        these blocks.
+        """
+        for run in re.finditer(b'\x01+', self._hashed):
+            (start, end) = (run.start() * DIGEST_SIZE, run.end() * DIGEST_SIZE)
+            manifest._hashes[start:end] = self._manifest._hashes[start:end]
+        return self._hashed
+
+
+def _unhashed_extents(manifest, blocks, hashed):
+    """
+    Yields the (offset, length) extents of the runs of consecutive blocks
+    among the given ones that are not marked in hashed.
+    """
+    (start, end) = (None, None)
+    for block in blocks:
+        if hashed[block]:
+            continue
+        (offset, length) = manifest.block_range(block)
+        if start is not None and offset == end:
+            end = offset + length
+            continue
+        if start is not None:
+            yield (start, end - start)
+        (start, end) = (offset, offset + length)
+    if start is not None:
+        yield (start, end - start)
+
+
+def save_manifest(vdi_dir, manifest):
+    """
+    Stores the HashManifest of the data of a VDI backup in its directory.
+    """
+    with (Path(vdi_dir) / MANIFEST_FILE).open('wb') as out:
+        out.write(manifest.to_bytes())
+
+
+def load_manifest(vdi_dir):
+    """
+    Returns the HashManifest of the given VDI backup, or None if it has none.
+    """
+    try:
+        with (Path(vdi_dir) / MANIFEST_FILE).open('rb') as infile:
+            return HashManifest.from_bytes(infile.read())
+    except FileNotFoundError:
+        return None
+
+
+def manifest_for_backup(vdi_dir, base_vdi_dir=None, changed_extents=None,
+                        workers=None, hasher=None, md5=False):
+    """
+    Computes and stores the HashManifest of the data of the given VDI
+    backup. For an incremental backup, the manifest of its base backup is
+    reused, and only the blocks overlapping the changed extents are hashed,
+    unless the base backup has no manifest or a different size.
+    The blocks already hashed by the given BlockHasher while the backup was
+    downloaded are not read back. If md5 is True, the MD5 checksum of the
+    whole data is computed too, from the same reads as the block hashes.
+
+    Returns:
+        A tuple (manifest, report), where report is a dictionary with the
+        root hash, the number of bytes of the blocks hashed while they were
+        downloaded and of the ones read back to hash them, and the MD5
+        checksum if md5 is True.
+    """
+    vdi_dir = Path(vdi_dir)
+    path = vdi_dir / 'data'
+    size = path.stat().st_size
+    manifest = None
+    if base_vdi_dir is not None:
+        base = load_manifest(base_vdi_dir)
+        if base is not None and base.size == size:
+            manifest = base.copy()
+    if manifest is None:
+        manifest = HashManifest(size=size)
+        changed_extents = None
+    hashed = bytearray(manifest.blocks)
+    if hasher is not None and hasher.size == size:
+        hashed = hasher.update(manifest)
+    extents = _unhashed_extents(
+        manifest=manifest,
+        blocks=manifest.blocks_overlapping(changed_extents),
+        hashed=hashed)
+    report = {}
+    if md5:
+        (rehashed, report['md5']) = manifest.rehash_with_md5(
+            path=path, extents=extents, workers=workers)
+    else:
+        rehashed = manifest.rehash(path=path, extents=extents,
+                                   workers=workers)
+    save_manifest(vdi_dir, manifest)
+    streamed = sum(hashed)
+    report.update({
+        'root_hash': manifest.root_hash().hex(),
+        'streamed_bytes': min(streamed * manifest.block_size, size),
+        'hashed_bytes': min(rehashed * manifest.block_size, size),
+    })
+    return (manifest, report)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Verifies the data of a local VDI backup against its block hash manifest, or its chunks if it is in the chunk store")
+    parser.add_argument('--backup-dir', type=Path, default=Path.home() / ".cbt_backups", help="The directory of the backups")
+    parser.add_argument('--vm', required=True, help="The UUID of the locally backed up VM")
+    parser.add_argument('--ts', required=True, help="The timestamp of the backup")
+    parser.add_argument('--vdi', help="The UUID of the snapshot VDI of the backup to verify, all VDIs by default")
+    parser.add_argument('--offset', type=int, default=0, help="The start of the range to verify in bytes")
+    parser.add_argument('--length', type=int, help="The length of the range to verify in bytes, up to the end of the disk by default")
+    parser.add_argument('--workers', type=int, default=None, help="Number of threads hashing the blocks, one per CPU by default")
+    args = parser.parse_args()
+
+    vdis_dir = args.backup_dir / args.vm / args.ts / 'vdis'
+    vdi_dirs = [vdis_dir / args.vdi] if args.vdi else sorted(vdis_dir.iterdir())
+    report = {}
+    for vdi_dir in vdi_dirs:
+        manifest = load_manifest(vdi_dir)
+        if manifest is None:
+            report[vdi_dir.name] = None
+            continue
+        length = args.length
+        if length is None:
+            length = max(0, manifest.size - args.offset)
+        extents = [(args.offset, length)]
+        if (vdi_dir / 'data').exists():
+            mismatches = manifest.verify(
+                path=vdi_dir / 'data', extents=extents, workers=args.workers)
+        else:
+            # Kept in the chunk store, which depends on this module
+            from chunk_store import CHUNKS_DIR, ChunkStore
+            mismatches = ChunkStore(args.backup_dir / CHUNKS_DIR).verify(
+                manifest=manifest, extents=extents)
+        report[vdi_dir.name] = {
+            'root_hash': manifest.root_hash().hex(),
+            'mismatched_blocks': mismatches,
+        }
+    print(json.dumps(report, indent=2))
+    if any(entry is None or entry['mismatched_blocks']
+           for entry in report.values()):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,326 @@
+"""
+A pool of NBD connections, SSL contexts and TLS sessions, shared by all the
+VDI transfers to the same NBD servers.
+
+Every VDI is exported separately, but all the exports of a host are served
+by the same NBD server, using the same certificate. The pool therefore keys
+everything by the server details of the VDI's NBD info, without the export
+name:
+* The SSL context, with the CA certificate loaded, is created once.
+* The TLS session of the latest connection to the server is resumed by the
+  next one, which saves a full TLS handshake.
+* Optionally, a number of idle connections that have already completed the
+  fixed-newstyle handshake and the TLS upgrade are kept open, ready to
+  select an export.
+
+The helpers shared by the downloads and the restores, for selecting an
+export and spreading blocks across several connections, are also here.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import collections
+import logging
+import threading
+import time
+
+from python_nbd_client import (
+    NBDEOFError,
+    NBDOptionError,
+    PythonNbdClient,
+    make_tls_context,
+)
+
+LOGGER = logging.getLogger('nbd_pool')
+
+
+class ExtentCursor(object):
+    """
+    Hands out the given extents as consecutive (offset, length) blocks of the
+    requested sizes. Can be shared by several threads.
+    """
+
+    def __init__(self, extents):
+        self._extents = iter(extents)
+        self._offset = 0
+        self._end = 0
+        self._lock = threading.Lock()
+        self._stopped = False
+
+    def take(self, max_length):
+        """
+        Returns the next block of at most max_length bytes, or None if there
+        are no more blocks or the cursor has been stopped.
+        """
+        with self._lock:
+            while not self._stopped and self._offset == self._end:
+                extent = next(self._extents, None)
+                if extent is None:
+                    return None
+                (self._offset, length) = extent
+                self._end = self._offset + length
+            if self._stopped:
+                return None
+            offset = self._offset
+            length = min(max_length, self._end - offset)
+            self._offset += length
+            return (offset, length)
+
+    def stop(self):
+        """
+        Stops handing out blocks.
+        """
+        self._stopped = True
+
+
+def _server_key(vdi_nbd_server_info):
+    """
+    Returns the key that identifies the NBD server of the given NBD info.
+    """
+    return (vdi_nbd_server_info['address'],
+            vdi_nbd_server_info.get('port'),
+            vdi_nbd_server_info.get('subject'),
+            vdi_nbd_server_info.get('cert'))
+
+
+class NbdConnectionPool(object):
+    """
+    Hands out NBD clients in the handshake phase, connected to the server of
+    a VDI's NBD info. The caller negotiates the options it needs and selects
+    the export with PythonNbdClient.connect.
+
+    warm_connections idle connections are kept open to each server that has
+    been used, and discarded after idle_timeout seconds, because the server
+    may close connections that stay in the handshake phase for too long.
+    """
+
+    def __init__(self, use_tls=True, warm_connections=0, idle_timeout=30):
+        self._use_tls = use_tls
+        self._warm_connections = warm_connections
+        self._idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        self._contexts = {}
+        self._sessions = {}
+        # server key -> deque of (time opened, idle client)
+        self._idle = collections.defaultdict(collections.deque)
+        self._refilling = collections.Counter()
+        self._refill_executor = None
+        if warm_connections > 0:
+            self._refill_executor = ThreadPoolExecutor(max_workers=4)
+        self._closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _ssl_context(self, cert, subject):
+        key = (cert, subject is not None)
+        with self._lock:
+            context = self._contexts.get(key)
+            if context is None:
+                context = make_tls_context(cert=cert, subject=subject)
+                self._contexts[key] = context
+            return context
+
+    def _open(self, vdi_nbd_server_info):
+        """
+        Opens a new connection to the server, resuming the latest TLS
+        session with the server if there is one.
+        """
+        key = _server_key(vdi_nbd_server_info)
+        kwargs = {}
+        if self._use_tls:
+            kwargs['ssl_context'] = self._ssl_context(
+                cert=vdi_nbd_server_info.get('cert'),
+                subject=vdi_nbd_server_info.get('subject'))
+            with self._lock:
+                kwargs['ssl_session'] = self._sessions.get(key)
+        nbd_client = PythonNbdClient(
+            **vdi_nbd_server_info,
+            use_tls=self._use_tls,
+            connect=False,
+            **kwargs)
+        session = nbd_client.get_ssl_session()
+        if session is not None:
+            with self._lock:
+                self._sessions[key] = session
+        return nbd_client
+
+    def _take_idle(self, key):
+        expired = []
+        nbd_client = None
+        with self._lock:
+            idle = self._idle[key]
+            while idle:
+                (opened, candidate) = idle.popleft()
+                if time.monotonic() - opened < self._idle_timeout:
+                    nbd_client = candidate
+                    break
+                expired.append(candidate)
+        for candidate in expired:
+            LOGGER.debug("Discarding expired idle NBD connection")
+            _close_quietly(candidate)
+        return nbd_client
+
+    def _refill(self, vdi_nbd_server_info):
+        key = _server_key(vdi_nbd_server_info)
+        try:
+            while True:
+                with self._lock:
+                    if (self._closed or
+                            len(self._idle[key]) >= self._warm_connections):
+                        return
+                nbd_client = self._open(vdi_nbd_server_info)
+                with self._lock:
+                    if self._closed:
+                        _close_quietly(nbd_client)
+                        return
+                    self._idle[key].append((time.monotonic(), nbd_client))
+        except Exception:
+            LOGGER.warning("Failed to open warm NBD connection",
+                           exc_info=True)
+        finally:
+            with self._lock:
+                self._refilling[key] -= 1
+
+    def _schedule_refill(self, vdi_nbd_server_info):
+        if self._refill_executor is None:
+            return
+        key = _server_key(vdi_nbd_server_info)
+        with self._lock:
+            if self._closed or self._refilling[key]:
+                return
+            self._refilling[key] += 1
+        self._refill_executor.submit(self._refill, vdi_nbd_server_info)
+
+    def acquire(self, vdi_nbd_server_info, warm=True):
+        """
+        Returns a tuple (nbd_client, warm) of an NBD client in the handshake
+        phase, connected to the server of the given NBD info, and whether it
+        is an idle warm connection, which is used if there is one and warm is
+        True, otherwise a new connection is opened. The pool then opens
+        another warm connection in the background to replace it.
+        The returned client belongs to the caller, who must close it.
+        """
+        nbd_client = None
+        if warm:
+            nbd_client = self._take_idle(_server_key(vdi_nbd_server_info))
+        was_idle = nbd_client is not None
+        if nbd_client is None:
+            nbd_client = self._open(vdi_nbd_server_info)
+        self._schedule_refill(vdi_nbd_server_info)
+        return (nbd_client, was_idle)
+
+    def connect_export(self, vdi_nbd_server_info, structured_reply=False,
+                       meta_contexts=(), stats=None):
+        """
+        Returns an NBD client connected to the VDI's export, using a warm
+        connection if there is one. No manual configuration is needed for
+        TLS, the client will automatically use the certificate and server
+        hostname provided by the given vdi_nbd_server_info.
+        Structured replies are negotiated if structured_reply is True, and
+        the given metadata contexts are selected if the server offers them,
+        which requires structured replies. The given TransferStats object,
+        if any, is attached to the client.
+        """
+        (nbd_client, warm) = self.acquire(vdi_nbd_server_info)
+        try:
+            return _select_export(
+                nbd_client,
+                vdi_nbd_server_info=vdi_nbd_server_info,
+                structured_reply=structured_reply,
+                meta_contexts=meta_contexts,
+                stats=stats)
+        except (NBDEOFError, OSError):
+            # Only a new connection is tried again: the server may have
+            # closed the warm connection in the meantime
+            if not warm:
+                raise
+            LOGGER.info("Warm NBD connection failed, opening a new one")
+        (nbd_client, _) = self.acquire(vdi_nbd_server_info, warm=False)
+        return _select_export(
+            nbd_client,
+            vdi_nbd_server_info=vdi_nbd_server_info,
+            structured_reply=structured_reply,
+            meta_contexts=meta_contexts,
+            stats=stats)
+
+    def prewarm(self, vdi_nbd_server_info):
+        """
+        Starts opening warm connections to the server of the given NBD info
+        in the background, before they are needed.
+        """
+        self._schedule_refill(vdi_nbd_server_info)
+
+    def close(self):
+        """
+        Closes all the idle connections, and forgets the TLS sessions.
+        """
+        with self._lock:
+            self._closed = True
+            idle = [nbd_client
+                    for connections in self._idle.values()
+                    for (_, nbd_client) in connections]
+            self._idle.clear()
+            self._sessions.clear()
+        if self._refill_executor is not None:
+            self._refill_executor.shutdown(wait=True)
+        for nbd_client in idle:
+            _close_quietly(nbd_client)
+
+
+def _select_export(nbd_client, vdi_nbd_server_info, structured_reply,
+                   meta_contexts, stats):
+    """
+    Negotiates the options of the given NBD client that is in the handshake
+    phase, and selects the VDI's export.
+    """
+    exportname = vdi_nbd_server_info['exportname']
+    try:
+        nbd_client.query_block_size_constraints(export_name=exportname)
+        if structured_reply or meta_contexts:
+            try:
+                nbd_client.negotiate_structured_reply()
+                if meta_contexts:
+                    nbd_client.set_meta_contexts(
+                        export_name=exportname, queries=meta_contexts)
+            except NBDOptionError:
+                # Fall back to simple replies, or to no metadata contexts
+                pass
+        nbd_client.connect(exportname=exportname)
+        nbd_client.set_stats(stats)
+    except BaseException:
+        nbd_client.close()
+        raise
+    return nbd_client
+
+
+def open_stripes(stack, nbd_client, connections, connect):
+    """
+    Returns the list of connections to spread the blocks of a transfer
+    across: the given one, and up to connections - 1 additional ones opened
+    with connect() in the given ExitStack, if the server supports multiple
+    connections to the same export. The additional connections are closed
+    without flushing them, the writes of all the connections must be flushed
+    through the given one.
+    """
+    nbd_clients = [nbd_client]
+    if connections <= 1:
+        return nbd_clients
+    if not nbd_client.can_multi_conn():
+        LOGGER.info("The server does not support multiple connections "
+                    "to the same export, using a single connection")
+        return nbd_clients
+    for _ in range(connections - 1):
+        stripe = connect()
+        stack.callback(stripe.close, flush=False)
+        nbd_clients.append(stripe)
+    return nbd_clients
+
+
+def _close_quietly(nbd_client):
+    try:
+        nbd_client.close()
+    except Exception:
+        LOGGER.debug("Failed to close idle NBD connection", exc_info=True)
@@ -0,0 +1,171 @@
+"""
+Counters, latency histograms and time accounting for NBD transfers.
+
+A TransferStats object can be attached to PythonNbdClient and VdiDownloader
+to find out where the time of a slow backup goes: waiting for the server to
+reply to requests, receiving data from the socket (including TLS
+decryption), or writing it to the local disk. Nothing is measured when no
+stats object is attached.
+"""
+
+import threading
+import time
+
+from python_nbd_client import (
+    NBD_CMD_BLOCK_STATUS,
+    NBD_CMD_DISC,
+    NBD_CMD_FLUSH,
+    NBD_CMD_READ,
+    NBD_CMD_WRITE,
+    NBD_CMD_WRITE_ZEROES,
+)
+
+COMMAND_NAMES = {
+    NBD_CMD_READ: 'read',
+    NBD_CMD_WRITE: 'write',
+    NBD_CMD_DISC: 'disconnect',
+    NBD_CMD_FLUSH: 'flush',
+    NBD_CMD_WRITE_ZEROES: 'write_zeroes',
+    NBD_CMD_BLOCK_STATUS: 'block_status',
+}
+
+# Latencies are counted in power-of-two buckets of microseconds: bucket i
+# counts the latencies in [2**(i-1), 2**i) microseconds, bucket 0 the ones
+# below 1 microsecond.
+HISTOGRAM_BUCKETS = 48
+
+
+class _CommandStats(object):
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.bytes = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self.histogram = [0] * HISTOGRAM_BUCKETS
+
+    def to_dict(self):
+        histogram = {}
+        for (bucket, count) in enumerate(self.histogram):
+            if count:
+                # The upper bound of the bucket in microseconds
+                histogram[1 << bucket] = count
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'bytes': self.bytes,
+            'average_latency': (self.total_latency / self.count
+                                if self.count else None),
+            'max_latency': self.max_latency,
+            'latency_histogram_us': histogram,
+        }
+
+
+class TransferStats(object):
+    """
+    Collects per-command request counts, transferred bytes and latency
+    histograms, and the time spent in each phase of a transfer, such as
+    'receive' (blocked receiving from the socket), 'send', 'write' (writing
+    to the output file) and 'connect'.
+
+    Callbacks registered with add_callback are called with the command
+    name, the length and the latency in seconds of every completed request.
+
+    The object may be shared by several connections running in different
+    threads.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self.reset()
+
+    def reset(self):
+        """
+        Clears all the collected data, and restarts the clock.
+        """
+        with self._lock:
+            self._commands = {}
+            self._times = {}
+            self._started = time.monotonic()
+
+    def add_callback(self, callback):
+        """
+        Registers a function to be called as callback(command, length,
+        latency) for every completed request.
+        """
+        self._callbacks.append(callback)
+
+    def record_request(self, request_type, length, latency, error=False):
+        """
+        Records a completed request of the given NBD command type.
+        """
+        command = COMMAND_NAMES.get(request_type, request_type)
+        bucket = min(int(latency * 1000000).bit_length(),
+                     HISTOGRAM_BUCKETS - 1)
+        with self._lock:
+            stats = self._commands.get(command)
+            if stats is None:
+                stats = self._commands[command] = _CommandStats()
+            stats.count += 1
+            stats.bytes += length
+            stats.total_latency += latency
+            stats.max_latency = max(stats.max_latency, latency)
+            stats.histogram[bucket] += 1
+            if error:
+                stats.errors += 1
+        for callback in self._callbacks:
+            callback(command, length, latency)
+
+    def add_time(self, category, seconds):
+        """
+        Adds the given number of seconds to the time spent in the given
+        category.
+        """
+        with self._lock:
+            self._times[category] = self._times.get(category, 0.0) + seconds
+
+    def timer(self, category):
+        """
+        Returns a context manager that adds the time spent in its body to
+        the given category.
+        """
+        return _Timer(self, category)
+
+    def snapshot(self):
+        """
+        Returns the collected data as a dictionary: the per-command stats,
+        the time spent in each category, the elapsed time since the last
+        reset, and the read and write throughput in bytes per second over
+        that time.
+        """
+        with self._lock:
+            elapsed = time.monotonic() - self._started
+            commands = {command: stats.to_dict()
+                        for (command, stats) in self._commands.items()}
+            times = dict(self._times)
+        throughput = {}
+        for command in ('read', 'write'):
+            if command in commands:
+                throughput[command] = commands[command]['bytes'] / elapsed
+        return {
+            'elapsed': elapsed,
+            'commands': commands,
+            'times': times,
+            'bytes_per_second': throughput,
+        }
+
+
+class _Timer(object):
+    def __init__(self, stats, category):
+        self._stats = stats
+        self._category = category
+        self._start = None
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self._stats.add_time(
+            self._category, time.perf_counter() - self._start)
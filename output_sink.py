@@ -0,0 +1,643 @@
+"""
+Output sinks that VdiDownloader receives the downloaded blocks into.
+
+A sink hands out a writable buffer for each block with get_buffer, the NBD
+client receives the block straight into it, and commit then makes sure that
+the block ends up in the output file. This way each block is copied at most
+once after it is received from the socket, and the memory used does not
+depend on the size of the VDI.
+
+The blocks received into reused buffers are written with positional writes,
+and the consecutive blocks that a writer thread writes one after the other
+are gathered into one pwritev call. The 'direct' sink writes them with
+O_DIRECT from page-aligned buffers, bypassing the page cache, so that
+backing up large VDIs does not evict the rest of the page cache.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import mmap
+import os
+import queue
+import threading
+
+from sparse_file import zero_runs
+
+LOGGER = logging.getLogger('output_sink')
+
+# fallocate(2) mode flags
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+
+_ZEROES = bytes(1024 * 1024)
+
+# The maximum number of bytes and of buffers written with one pwritev call
+MAX_GATHERED_WRITE = 8 * 1024 * 1024
+_IOV_MAX = os.sysconf('SC_IOV_MAX') if hasattr(os, 'sysconf') else 1024
+
+# The alignment of the file offsets, lengths and memory addresses of the
+# writes done with O_DIRECT, which covers the logical block size of the
+# usual devices
+DIRECT_IO_ALIGNMENT = 4096
+
+
+def _load_fallocate():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        fallocate = libc.fallocate
+    except (OSError, AttributeError):
+        return None
+    fallocate.argtypes = [ctypes.c_int, ctypes.c_int,
+                          ctypes.c_longlong, ctypes.c_longlong]
+    fallocate.restype = ctypes.c_int
+    return fallocate
+
+
+_FALLOCATE = _load_fallocate()
+
+
+def open_output(path, size):
+    """
+    Opens the given output file for writing, creating it if necessary, and
+    extends it to the given size. The extended part of the file is sparse.
+    Returns the file descriptor and the original size of the file.
+    """
+    fd = os.open(str(path), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        original_size = os.fstat(fd).st_size
+        if original_size < size:
+            os.ftruncate(fd, size)
+    except BaseException:
+        os.close(fd)
+        raise
+    return (fd, original_size)
+
+
+def pwrite_all(fd, data, offset):
+    """
+    Writes all the given data to the file at the given offset.
+    """
+    view = memoryview(data)
+    while view:
+        written = os.pwrite(fd, view, offset)
+        view = view[written:]
+        offset += written
+
+
+def _pwritev_all(fd, views, offset):
+    """
+    Writes the given consecutive buffers to the file at the given offset,
+    with as few pwritev calls as possible.
+    """
+    if not hasattr(os, 'pwritev'):
+        for view in views:
+            pwrite_all(fd, view, offset)
+            offset += len(view)
+        return
+    views = list(views)
+    while views:
+        written = os.pwritev(fd, views, offset)
+        offset += written
+        while views and written >= len(views[0]):
+            written -= len(views[0])
+            views.pop(0)
+        if written:
+            views[0] = views[0][written:]
+
+
+def _write_zeroes(fd, offset, length):
+    end = offset + length
+    while offset < end:
+        chunk = min(len(_ZEROES), end - offset)
+        pwrite_all(fd, memoryview(_ZEROES)[:chunk], offset)
+        offset += chunk
+
+
+def punch_hole(fd, offset, length):
+    """
+    Deallocates the given range of the file, so that it reads back as zeroes,
+    without changing the size of the file. If the platform or the filesystem
+    does not support punching holes, zeroes are written instead.
+    Returns True if a hole was punched.
+    """
+    if _FALLOCATE is not None:
+        mode = FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE
+        if _FALLOCATE(fd, mode, offset, length) == 0:
+            return True
+        error = ctypes.get_errno()
+        if error not in (errno.EOPNOTSUPP, errno.ENOSYS):
+            raise OSError(error, os.strerror(error))
+    _write_zeroes(fd, offset, length)
+    return False
+
+
+def allocate(fd, offset, length):
+    """
+    Allocates the disk space of the given range of the file, so that it is
+    laid out contiguously if possible and writing it cannot fail for lack of
+    space, without changing the size of the file. The range keeps reading
+    back as it did. Returns False if the platform or the filesystem does not
+    support it.
+    """
+    if _FALLOCATE is None:
+        return False
+    if _FALLOCATE(fd, FALLOC_FL_KEEP_SIZE, offset, length) == 0:
+        return True
+    error = ctypes.get_errno()
+    if error not in (errno.EOPNOTSUPP, errno.ENOSYS):
+        raise OSError(error, os.strerror(error))
+    return False
+
+
+def _address(view):
+    """
+    Returns the memory address of the given writable buffer.
+    """
+    return ctypes.addressof(ctypes.c_char.from_buffer(view))
+
+
+class _Sink(object):
+    """
+    The common parts of the output sinks.
+
+    The data ranges received into a buffer are written with write_data, the
+    ranges that the server reported as holes are handled by hole, and then
+    the buffer is given back with release. commit does both for a buffer
+    that is filled completely.
+
+    If detect_zeroes is True, the blocks of the received data that only
+    contain zeroes are not written, but handled like holes, and the number
+    of bytes that were not written is counted in zero_bytes.
+
+    If a hash_manifest.BlockHasher is given, the received data and the holes
+    are handed to it, and a buffer is only given back once the blocks handed
+    from it are hashed.
+    """
+
+    def __init__(self, path, size, detect_zeroes=False, hasher=None):
+        self._path = path
+        (self._fd, original_size) = open_output(path=path, size=size)
+        # The part of the file beyond its original size is a fresh hole
+        # created by the extension, so it does not need to be punched:
+        self._fresh_from = original_size
+        self._detect_zeroes = detect_zeroes
+        self._lock = threading.Lock()
+        self.zero_bytes = 0
+        self._hasher = hasher
+        # The futures of the hashes of the data written by each thread
+        self._hashes = threading.local()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def commit(self, offset, view):
+        """
+        Writes the given buffer, previously returned by get_buffer, to the
+        output file, and releases it.
+        """
+        self.write_data(offset=offset, view=view)
+        self.release(view)
+
+    def hole(self, offset, length):
+        """
+        Makes the given range of the output file read back as zeroes, without
+        writing any data if possible: the range is skipped if it is still
+        part of the sparse extension of a new file, otherwise a hole is
+        punched into it.
+        """
+        if self._hasher is not None:
+            self._hasher.hole(offset=offset, length=length)
+        self._hole(offset=offset, length=length)
+
+    def _hole(self, offset, length):
+        fresh_from = max(offset, self._fresh_from)
+        if fresh_from < offset + length:
+            length = fresh_from - offset
+        if length > 0:
+            punch_hole(self._fd, offset, length)
+
+    def _zero_block(self, offset, length):
+        """
+        Handles a block of received data that only contains zeroes.
+        """
+        self._hole(offset=offset, length=length)
+
+    def _hash_data(self, offset, view):
+        """
+        Hands the given received data to the hasher, if any.
+        """
+        if self._hasher is None:
+            return
+        futures = self._hasher.data(offset=offset, view=view)
+        if futures:
+            if not hasattr(self._hashes, 'futures'):
+                self._hashes.futures = []
+            self._hashes.futures += futures
+
+    def _wait_hashes(self):
+        """
+        Waits for the hashes of the data handed to the hasher by the current
+        thread, before its buffer is given back.
+        """
+        futures = getattr(self._hashes, 'futures', None)
+        if futures:
+            self._hashes.futures = []
+            for future in futures:
+                future.result()
+
+    def _data_runs(self, offset, view):
+        """
+        Returns the (offset, view) runs of the given received data that need
+        to be written: all of it, or, if detect_zeroes is True, the runs that
+        are not zero blocks, which are handled by _zero_block.
+        """
+        if not self._detect_zeroes:
+            return [(offset, view)]
+        runs = []
+        zero_bytes = 0
+        for (start, length, is_zero) in zero_runs(view):
+            if is_zero:
+                self._zero_block(offset=offset + start, length=length)
+                zero_bytes += length
+            else:
+                runs.append((offset + start, view[start:start + length]))
+        if zero_bytes:
+            with self._lock:
+                self.zero_bytes += zero_bytes
+        return runs
+
+    def preallocate(self, extents):
+        """
+        Allocates the disk space of the given (offset, length) extents of the
+        output file before they are downloaded, so that they are laid out
+        contiguously instead of in the order in which the blocks arrive. The
+        holes found in them later stay allocated, but read back as zeroes.
+        """
+        for (offset, length) in extents:
+            if not allocate(self._fd, offset, length):
+                LOGGER.info("Preallocation is not supported for %s",
+                            self._path)
+                return
+
+    def close(self):
+        """
+        Closes the output file.
+        """
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+class _GatheredWrite(object):
+    """
+    The consecutive runs of data that a writer thread is about to write with
+    one pwritev call, and the buffers to give back to the pool once they are
+    written.
+    """
+
+    def __init__(self):
+        self.offset = 0
+        self.length = 0
+        self.views = []
+        self.buffers = []
+
+
+class BufferPoolSink(_Sink):
+    """
+    Receives the blocks into a pool of reused buffers of block_size bytes,
+    and writes them to the output file with positional writes.
+    The pool only grows to the number of blocks that are in flight at the
+    same time. The sink may be shared by several connections, each running in
+    its own thread.
+
+    The data that a thread writes right after the end of its previous write
+    is held back, up to MAX_GATHERED_WRITE bytes, and written together with
+    it with one pwritev call, so that the blocks of an extent end up in few
+    large writes. The buffers held back return to the pool once written.
+    """
+
+    def __init__(self, path, size, block_size, detect_zeroes=False,
+                 hasher=None):
+        super(BufferPoolSink, self).__init__(
+            path=path, size=size, detect_zeroes=detect_zeroes, hasher=hasher)
+        self._block_size = block_size
+        self._free = []
+        self._local = threading.local()
+        self._gathered_writes = []
+
+    def _allocate_buffer(self, length):
+        return bytearray(length)
+
+    def get_buffer(self, offset, length):
+        """
+        Returns a writable buffer of the given length for receiving the data
+        at the given offset of the output file.
+        """
+        try:
+            buffer = self._free.pop()
+        except IndexError:
+            buffer = self._allocate_buffer(max(self._block_size, length))
+        if len(buffer) < length:
+            buffer = self._allocate_buffer(length)
+        return memoryview(buffer)[:length]
+
+    def _gathered_write(self):
+        """
+        Returns the write gathered by the current thread.
+        """
+        try:
+            return self._local.gathered_write
+        except AttributeError:
+            gathered_write = _GatheredWrite()
+            self._local.gathered_write = gathered_write
+            with self._lock:
+                self._gathered_writes.append(gathered_write)
+            return gathered_write
+
+    def _flush(self, gathered_write):
+        """
+        Writes the given gathered runs, and gives their buffers back to the
+        pool.
+        """
+        if gathered_write.views:
+            self._write_run(gathered_write.offset, gathered_write.views)
+            for view in gathered_write.views:
+                view.release()
+        self._free += gathered_write.buffers
+        gathered_write.views = []
+        gathered_write.buffers = []
+        gathered_write.length = 0
+
+    def _write_run(self, offset, views):
+        """
+        Writes the given consecutive views at the given offset.
+        """
+        _pwritev_all(self._fd, views, offset)
+
+    def _gather(self, offset, view):
+        """
+        Adds the given run of data to the write gathered by the current
+        thread, after writing the gathered runs that it does not follow.
+        """
+        gathered_write = self._gathered_write()
+        if gathered_write.views and (
+                offset != gathered_write.offset + gathered_write.length or
+                gathered_write.length + len(view) > MAX_GATHERED_WRITE or
+                len(gathered_write.views) >= _IOV_MAX):
+            self._flush(gathered_write)
+        if not gathered_write.views:
+            gathered_write.offset = offset
+        # A view of its own, as the caller may release the given one
+        gathered_write.views.append(memoryview(view))
+        gathered_write.length += len(view)
+
+    def write_data(self, offset, view):
+        """
+        Writes the given part of a buffer to the output file at the given
+        offset.
+        """
+        self._hash_data(offset=offset, view=view)
+        for (run_offset, run) in self._data_runs(offset=offset, view=view):
+            if run:
+                self._gather(run_offset, run)
+
+    def release(self, view):
+        """
+        Returns the given buffer, previously returned by get_buffer, to the
+        pool, once its data has been written and hashed.
+        """
+        self._wait_hashes()
+        gathered_write = self._gathered_write()
+        if gathered_write.views:
+            gathered_write.buffers.append(view.obj)
+        else:
+            self._free.append(view.obj)
+        view.release()
+
+    def close(self):
+        """
+        Writes the data held back by all the threads, which must not use
+        the sink any more, and closes the output file.
+        """
+        try:
+            if self._fd is not None:
+                for gathered_write in self._gathered_writes:
+                    self._flush(gathered_write)
+        finally:
+            super(BufferPoolSink, self).close()
+            self._free = []
+            self._gathered_writes = []
+
+
+class DirectSink(BufferPoolSink):
+    """
+    Like BufferPoolSink, but writes the data with O_DIRECT from page-aligned
+    buffers, so that it goes straight to the disk without going through the
+    page cache. The runs of data that are not aligned to
+    DIRECT_IO_ALIGNMENT, such as the partial blocks of some structured
+    replies, are written through the page cache instead. Falls back to
+    BufferPoolSink's behaviour if the filesystem does not support O_DIRECT.
+    """
+
+    def __init__(self, path, size, block_size, detect_zeroes=False,
+                 hasher=None):
+        super(DirectSink, self).__init__(
+            path=path, size=size, block_size=block_size,
+            detect_zeroes=detect_zeroes, hasher=hasher)
+        self._direct_fd = None
+        try:
+            self._direct_fd = os.open(
+                str(path), os.O_WRONLY | getattr(os, 'O_DIRECT', 0))
+        except OSError as error:
+            if error.errno != errno.EINVAL:
+                self.close()
+                raise
+            LOGGER.info("O_DIRECT is not supported for %s", path)
+
+    def _allocate_buffer(self, length):
+        # Anonymous mappings are page-aligned
+        return mmap.mmap(-1, -(-length // mmap.PAGESIZE) * mmap.PAGESIZE)
+
+    @staticmethod
+    def _is_aligned(offset, view):
+        return (offset % DIRECT_IO_ALIGNMENT == 0 and
+                len(view) % DIRECT_IO_ALIGNMENT == 0 and
+                _address(view) % DIRECT_IO_ALIGNMENT == 0)
+
+    def _gather(self, offset, view):
+        if self._direct_fd is None or self._is_aligned(offset, view):
+            super(DirectSink, self)._gather(offset, view)
+        else:
+            pwrite_all(self._fd, view, offset)
+
+    def _write_run(self, offset, views):
+        fd = self._fd if self._direct_fd is None else self._direct_fd
+        _pwritev_all(fd, views, offset)
+
+    def close(self):
+        try:
+            super(DirectSink, self).close()
+        finally:
+            if self._direct_fd is not None:
+                os.close(self._direct_fd)
+                self._direct_fd = None
+
+
+class MmapSink(_Sink):
+    """
+    Maps the whole output file into memory, and receives the blocks straight
+    into the page cache of the output file, so that no copy is needed at all.
+    """
+
+    def __init__(self, path, size, block_size=None, detect_zeroes=False,
+                 hasher=None):
+        super(MmapSink, self).__init__(
+            path=path, size=size, detect_zeroes=detect_zeroes, hasher=hasher)
+        self._map = None
+        self._view = None
+        if size:
+            self._map = mmap.mmap(self._fd, size)
+            self._view = memoryview(self._map)
+
+    def get_buffer(self, offset, length):
+        """
+        Returns the writable view of the mapped output file at the given
+        offset.
+        """
+        return self._view[offset:offset + length]
+
+    def write_data(self, offset, view):
+        """
+        Nothing to do, the data is already in the output file, unless it
+        contains zero blocks to punch out.
+        """
+        self._hash_data(offset=offset, view=view)
+        self._data_runs(offset=offset, view=view)
+
+    def _zero_block(self, offset, length):
+        # The zeroes have been received into dirty pages of the mapping,
+        # even in the fresh part of the file, punching a hole drops them:
+        punch_hole(self._fd, offset, length)
+
+    def release(self, view):
+        """
+        Releases the given view, previously returned by get_buffer, once its
+        data has been hashed.
+        """
+        self._wait_hashes()
+        view.release()
+
+    def close(self):
+        """
+        Unmaps and closes the output file. The dirty pages are written back
+        by the kernel.
+        """
+        if self._view is not None:
+            self._view.release()
+            self._view = None
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        super(MmapSink, self).close()
+
+
+class BlockWriter(object):
+    """
+    Runs the writes of the received blocks in writer threads, so that the
+    connections keep receiving while the blocks are written, and the disk
+    keeps writing while the next blocks are received.
+
+    The writes are handed over through a queue of at most queue_size
+    blocks, and submit blocks when it is full, which caps the number of
+    buffers that are waiting to be written. With 0 writers, the writes run
+    in the thread that submits them.
+    """
+
+    def __init__(self, writers=1, queue_size=16):
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._error = None
+        self._threads = [threading.Thread(target=self._run, daemon=True)
+                         for _ in range(writers)]
+        for thread in self._threads:
+            thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+            return
+        # The error that is already being raised, for example by the
+        # connection receiving the blocks, is the one to report: a write
+        # error is only logged, instead of hiding it as its context
+        self._join()
+        if self._error is not None and self._error is not exc_value:
+            LOGGER.error("Block write failed", exc_info=self._error)
+
+    def _run(self):
+        while True:
+            task = self._queue.get()
+            if task is None:
+                return
+            if self._error is not None:
+                # Keep draining the queue, so that submit never blocks
+                continue
+            (function, args) = task
+            try:
+                function(*args)
+            except BaseException as error:
+                self._error = error
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise self._error
+
+    def submit(self, function, *args):
+        """
+        Calls the given write function with the given arguments in a writer
+        thread. Raises the error of a previous write that failed.
+        """
+        self._raise_error()
+        if not self._threads:
+            function(*args)
+            return
+        self._queue.put((function, args))
+
+    def close(self):
+        """
+        Waits for the submitted writes to complete, and raises the error of
+        the first one that failed, if any.
+        """
+        self._join()
+        self._raise_error()
+
+    def _join(self):
+        threads = self._threads
+        self._threads = []
+        for _ in threads:
+            self._queue.put(None)
+        for thread in threads:
+            thread.join()
+
+
+SINKS = {
+    'buffer_pool': BufferPoolSink,
+    'direct': DirectSink,
+    'mmap': MmapSink,
+}
+
+
+def open_sink(kind, path, size, block_size, detect_zeroes=False,
+              hasher=None):
+    """
+    Opens the output sink of the given kind, one of the keys of SINKS, for
+    the output file of the given size.
+    """
+    return SINKS[kind](path=path, size=size, block_size=block_size,
+                       detect_zeroes=detect_zeroes, hasher=hasher)
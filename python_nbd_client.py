@@ -26,10 +26,12 @@ Additionally, it supports the BLOCK_STATUS extension:
 for the extension docs, see the same file in the extension-blockstatus branch.
 """
 
+import collections
 import socket
 import struct
 import ssl
 import logging
+import time
 
 LOGGER = logging.getLogger('python_nbd_client')
 
@@ -45,6 +47,8 @@ NBD_CMD_BLOCK_STATUS = 7
 # Transmission flags
 NBD_FLAG_HAS_FLAGS = (1 << 0)
 NBD_FLAG_SEND_FLUSH = (1 << 2)
+NBD_FLAG_SEND_WRITE_ZEROES = (1 << 6)
+NBD_FLAG_CAN_MULTI_CONN = (1 << 8)
 
 # Client flags
 NBD_FLAG_C_FIXED_NEWSTYLE = (1 << 0)
@@ -82,12 +86,22 @@ NBD_REPLY_TYPE_ERROR_OFFSET = (1 << 15 + 2)
 # Structured reply flags
 NBD_REPLY_FLAG_DONE = (1 << 0)
 
+# The metadata context describing the allocation status of the export
+BASE_ALLOCATION = "base:allocation"
+
+# Block status flags of the base:allocation metadata context
+NBD_STATE_HOLE = (1 << 0)
+NBD_STATE_ZERO = (1 << 1)
+
 # NBD_INFO information types
 NBD_INFO_EXPORT = 0
 NBD_INFO_NAME = 1
 NBD_INFO_DESCRIPTION = 2
 NBD_INFO_BLOCK_SIZE = 3
 
+# The default number of read requests kept in flight by read_pipelined
+DEFAULT_MAX_IN_FLIGHT = 8
+
 
 class NBDEOFError(EOFError):
     """
@@ -158,11 +172,12 @@ class NBDUnexpectedStructuredReplyType(Exception):
 
 class NBDUnexpectedReplyHandleError(Exception):
     """
-    The NBD server sent a reply to a request different from the most recent one
-    that the client is expecting a response to.
+    The NBD server sent a reply to a request different from the ones that the
+    client is expecting a response to.
 
     :attribute expected: The handle of the most recent request that the client
-                         is expecting a reply to.
+                         is expecting a reply to, or the list of handles of
+                         the in-flight requests when requests are pipelined.
     :attribute received: The server's reply contained this handle.
     """
     def __init__(self, expected, received):
@@ -189,13 +204,31 @@ def assert_protocol(assertion):
         raise NBDProtocolError
 
 
-def _check_alignment(name, value):
+def check_alignment(name, value):
+    """
+    Raises a ValueError if the given offset or length is not a multiple of
+    512 bytes.
+    """
     if not value % 512:
         return
     raise ValueError("%s=%i is not a multiple of 512" % (name, value))
 
 
-def _is_final_structured_reply_chunk(flags):
+def _byte_view(buffer):
+    """
+    Returns a memoryview of bytes over the given buffer, or the buffer itself
+    if it already is one.
+    """
+    if isinstance(buffer, memoryview) and buffer.format == 'B':
+        return buffer
+    return memoryview(buffer).cast('B')
+
+
+def is_final_structured_reply_chunk(flags):
+    """
+    Returns true if the structured reply chunk with the given flags is the
+    last one of its reply.
+    """
     return flags & NBD_REPLY_FLAG_DONE == NBD_REPLY_FLAG_DONE
 
 
@@ -207,6 +240,25 @@ def is_error_chunk(reply_type):
     return reply_type & NBD_REPLY_TYPE_ERROR_BIT != 0
 
 
+def make_tls_context(cert, subject):
+    """
+    Returns the client-side SSL context used for upgrading NBD connections to
+    TLS, which trusts the given CA certificate (in PEM format), and checks
+    that the server's certificate matches the given subject, if it is not
+    None.
+    """
+    # Forcing the client to use TLSv1_2
+    context = ssl.SSLContext(ssl.PROTOCOL_TLSv1_2)
+    context.options &= ~ssl.OP_NO_TLSv1
+    context.options &= ~ssl.OP_NO_TLSv1_1
+    context.options &= ~ssl.OP_NO_SSLv2
+    context.options &= ~ssl.OP_NO_SSLv3
+    context.verify_mode = ssl.CERT_REQUIRED
+    context.check_hostname = (subject is not None)
+    context.load_verify_locations(cadata=cert)
+    return context
+
+
 def _parse_block_status_descriptors(data):
     while data:
         (length, status_flags) = struct.unpack(">LL", data[:8])
@@ -214,12 +266,259 @@ def _parse_block_status_descriptors(data):
         data = data[8:]
 
 
+# The handshake is implemented once, without any I/O, for PythonNbdClient and
+# for the asyncio client of async_nbd_client. Each of its steps below is a
+# generator that yields either the bytes to send to the server, or the
+# number of bytes it needs to receive, which the client then sends into it,
+# and that returns the result of the step. See PythonNbdClient._negotiate.
+
+def _option_request(option, data=b''):
+    LOGGER.debug("NBD sending option header")
+    LOGGER.debug("option='%d' data_length='%d'", option, len(data))
+    yield b'IHAVEOPT' + struct.pack(">LL", option, len(data)) + data
+
+
+def _option_reply(option):
+    LOGGER.debug("NBD parsing option reply")
+    reply = yield 8 + 4 + 4 + 4
+    (magic, reply_option, reply_type, data_length) = struct.unpack(
+        ">QLLL", reply)
+    LOGGER.debug("NBD reply magic='0x%x' option='%d' reply_type='%d'",
+                 magic, reply_option, reply_type)
+    assert_protocol(magic == OPTION_REPLY_MAGIC)
+    if reply_option != option:
+        raise NBDUnexpectedOptionResponseError(
+            expected=option, received=reply_option)
+    # The data of an error reply is received too, so that the negotiation
+    # can go on with other options
+    data = yield data_length
+    if reply_type & NBD_REP_ERROR_BIT != 0:
+        raise NBDOptionError(reply=reply_type)
+    return (reply_type, data)
+
+
+def _option_reply_ack(option):
+    (reply_type, data) = yield from _option_reply(option)
+    if reply_type != NBD_REP_ACK:
+        raise NBDProtocolError()
+    return data
+
+
+def fixed_newstyle_greeting():
+    """
+    Receives the greeting of a fixed-newstyle server, and replies with the
+    client flags.
+    """
+    greeting = yield len("NBDMAGIC") + len("IHAVEOPT") + 2
+    assert_protocol(greeting[:8] == b'NBDMAGIC')
+    assert_protocol(greeting[8:16] == b'IHAVEOPT')
+    handshake_flags = struct.unpack(">H", greeting[16:])[0]
+    assert_protocol(handshake_flags & NBD_FLAG_HAS_FLAGS != 0)
+    yield struct.pack('>L', NBD_FLAG_C_FIXED_NEWSTYLE)
+
+
+def oldstyle_greeting():
+    """
+    Receives the greeting of an oldstyle server, and returns the size and
+    the transmission flags of its export.
+    """
+    LOGGER.info("Connecting to server using oldstyle negotiation")
+    greeting = yield len("NBDMAGIC") + 8 + 8 + 4 + 124
+    assert_protocol(greeting[:8] == b'NBDMAGIC')
+    # The trailing zeroes are ignored
+    (magic, size, transmission_flags) = struct.unpack(">QQL", greeting[8:28])
+    assert_protocol(magic == 0x00420281861253)
+    return (size, transmission_flags)
+
+
+def starttls_option():
+    """
+    Asks the server to upgrade the connection to TLS, which the client does
+    once this step is complete.
+    """
+    yield from _option_request(NBD_OPT_STARTTLS)
+    data = yield from _option_reply_ack(NBD_OPT_STARTTLS)
+    assert_protocol(len(data) == 0)
+
+
+def info_option(export_name, info_requests):
+    """
+    Queries the given information about the export with NBD_OPT_INFO, and
+    returns the list of the information replies as dictionaries.
+    """
+    data = struct.pack('>L', len(export_name))
+    data += export_name.encode('utf-8')
+    data += struct.pack('>H', len(info_requests))
+    for request in info_requests:
+        data += struct.pack('>H', request)
+    yield from _option_request(NBD_OPT_INFO, data)
+    infos = []
+    while True:
+        (reply_type, data) = yield from _option_reply(NBD_OPT_INFO)
+        if reply_type == NBD_REP_INFO:
+            info_type = struct.unpack(">H", data[:2])[0]
+            info = {'information_type': info_type}
+            payload = data[2:]
+            if info_type == NBD_INFO_BLOCK_SIZE:
+                assert_protocol(len(data) == 14)
+                sizes = struct.unpack('>LLL', payload)
+                (info['minimum_block_size'],
+                 info['preferred_block_size'],
+                 info['maximum_block_size']) = sizes
+                infos += [info]
+            elif info_type == NBD_INFO_EXPORT:
+                assert_protocol(len(data) == 12)
+                export_info = struct.unpack('>QH', payload)
+                (info['size'],
+                 info['transmission_flags']) = export_info
+                infos += [info]
+            else:
+                # The client MUST ignore information replies it does not
+                # understand.
+                LOGGER.warning('Unsupported info reply type: %d', info_type)
+        elif reply_type == NBD_REP_ACK:
+            assert_protocol(not data)
+            return infos
+        else:
+            raise NBDProtocolError(
+                'Unexpected reply type: {}'.format(reply_type))
+
+
+def structured_reply_option():
+    """
+    Negotiates structured replies, raises NBDOptionError if the server does
+    not support them.
+    """
+    yield from _option_request(NBD_OPT_STRUCTURED_REPLY)
+    yield from _option_reply_ack(NBD_OPT_STRUCTURED_REPLY)
+
+
+def meta_context_option(option, export_name, queries):
+    """
+    Sends NBD_OPT_SET_META_CONTEXT or NBD_OPT_LIST_META_CONTEXT with the
+    given queries, and returns the list of the (metadata context ID,
+    metadata context name) pairs of the reply.
+    """
+    data = struct.pack('>L', len(export_name))
+    data += export_name.encode('utf-8')
+    data += struct.pack('>L', len(queries))
+    for query in queries:
+        data += struct.pack('>L', len(query))
+        data += query.encode('utf-8')
+    yield from _option_request(option, data)
+    contexts = []
+    while True:
+        (reply_type, data) = yield from _option_reply(option)
+        if reply_type == NBD_REP_ACK:
+            return contexts
+        assert_protocol(reply_type == NBD_REP_META_CONTEXT)
+        context_id = struct.unpack(">L", data[:4])[0]
+        name = bytes(data[4:]).decode('utf-8')
+        contexts.append((context_id, name))
+
+
+def export_name_option(exportname):
+    """
+    Requests the given export, which ends the handshake, and returns its
+    size and transmission flags.
+    """
+    LOGGER.info("Connecting to export '%s' using newstyle negotiation",
+                exportname)
+    yield from _option_request(
+        NBD_OPT_EXPORT_NAME, exportname.encode('utf-8'))
+    # non-fixed newstyle negotiation: we get these if the server is willing
+    # to allow the export, followed by zeroes, which are ignored
+    reply = yield 8 + 2 + 124
+    (size, transmission_flags) = struct.unpack(">QH", reply[:10])
+    LOGGER.debug("NBD got size=%d transmission flags=%d",
+                 size, transmission_flags)
+    return (size, transmission_flags)
+
+
+def abort_option():
+    """
+    Ends the handshake without selecting an export.
+    """
+    yield from _option_request(NBD_OPT_ABORT)
+
+
+def encode_request(request_type, handle, offset, length):
+    """
+    Returns the header of a request of the transmission phase.
+    """
+    command_flags = 0
+    return struct.pack('>LHHQQL', NBD_REQUEST_MAGIC, command_flags,
+                       request_type, handle, offset, length)
+
+
+def parse_structured_reply_header(header):
+    """
+    Returns the fields of the given header of a structured reply chunk,
+    without its magic, as a dictionary.
+    """
+    (flags, reply_type, handle, data_length) = struct.unpack(">HHQL", header)
+    return {'flags': flags,
+            'reply_type': reply_type,
+            'handle': handle,
+            'data_length': data_length}
+
+
+def parse_structured_reply_payload(fields, payload):
+    """
+    Parses the payload of a structured reply chunk into the given dictionary
+    of its header fields.
+    """
+    reply_type = fields['reply_type']
+    data_length = fields['data_length']
+    if reply_type == NBD_REPLY_TYPE_BLOCK_STATUS:
+        assert_protocol((data_length >= 12) and (data_length % 8 == 4))
+        view = memoryview(payload)
+        fields['context_id'] = struct.unpack(">L", view[:4])[0]
+        descriptors = list(_parse_block_status_descriptors(view[4:]))
+        assert_protocol(descriptors)
+        fields['descriptors'] = descriptors
+    elif reply_type == NBD_REPLY_TYPE_NONE:
+        assert_protocol(data_length == 0)
+        assert_protocol(is_final_structured_reply_chunk(
+            flags=fields['flags']))
+    elif reply_type == NBD_REPLY_TYPE_OFFSET_DATA:
+        assert_protocol(data_length >= 9)
+        fields['offset'] = struct.unpack(">Q", payload[:8])[0]
+        fields['data'] = payload[8:]
+    elif reply_type == NBD_REPLY_TYPE_OFFSET_HOLE:
+        assert_protocol(data_length == 12)
+        (fields['offset'], fields['hole_size']) = struct.unpack(
+            ">QL", payload)
+    elif is_error_chunk(reply_type=reply_type):
+        assert_protocol(data_length >= 6)
+        (errno, message_length) = struct.unpack(">LH", payload[:6])
+        fields['error'] = errno
+        # The client MAY continue transmission in case of an unexpected
+        # error type, unless message_length does not fit into the length:
+        if message_length > data_length - 6:
+            raise NBDProtocolError(
+                'message_length is too large to fit within data_length bytes')
+        view = memoryview(payload)[6:]
+        fields['message'] = view[0:message_length].tobytes().decode('utf-8')
+        view = view[message_length:]
+        if reply_type == NBD_REPLY_TYPE_ERROR_OFFSET:
+            fields['offset'] = struct.unpack(">Q", view)[0]
+    else:
+        raise NBDUnexpectedStructuredReplyType(reply_type)
+
+
 class PythonNbdClient(object):
     """
     A pure-Python NBD client. Supports both the fixed-newstyle and the oldstyle
     negotiation, and also has support for upgrading the connection to TLS
     during fixed-newstyle negotiation, structured replies, and the BLOCK_STATUS
     extension.
+
+    An existing SSL context, for example one created by make_tls_context, can
+    be passed as ssl_context to avoid loading the certificate again, and the
+    TLS session of a previous connection to the same server, returned by
+    get_ssl_session, can be passed as ssl_session to resume it instead of
+    performing a full TLS handshake.
     """
 
     def __init__(self,
@@ -232,15 +531,23 @@ class PythonNbdClient(object):
                  use_tls=True,
                  new_style_handshake=True,
                  unix=False,
-                 connect=True):
+                 connect=True,
+                 ssl_context=None,
+                 ssl_session=None):
         LOGGER.info("Creating connection to address '%s' and port '%s'",
                     address, port)
         self._flushed = True
         self._closed = True
         self._handle = 0
-        self._last_sent_option = None
         self._structured_reply = False
+        self._meta_contexts = {}
+        self._block_size_constraints = None
         self._transmission_phase = False
+        # Instrumentation, see set_stats
+        self._stats = None
+        self._sent = {}
+        # Checked once, to keep the per-request paths cheap
+        self._debug = LOGGER.isEnabledFor(logging.DEBUG)
         if unix:
             self._s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
         else:
@@ -254,7 +561,9 @@ class PythonNbdClient(object):
             self._fixed_new_style_handshake(
                 cert=cert,
                 subject=subject,
-                use_tls=use_tls)
+                use_tls=use_tls,
+                ssl_context=ssl_context,
+                ssl_session=ssl_session)
             if connect:
                 self.connect(exportname=exportname)
         else:
@@ -266,21 +575,42 @@ class PythonNbdClient(object):
     def __exit__(self, *args):
         self.close()
 
-    def close(self):
+    def close(self, flush=True):
         """
         Sends a flush request to the server if necessary and the server
         supports it, followed by a disconnect request.
+        If flush is False, the writes of this connection are not flushed,
+        because they have already been flushed through another connection to
+        the same export (see can_multi_conn), or are not needed anymore.
         """
-        if self._transmission_phase and (not self._flushed):
+        if flush and self._transmission_phase and (not self._flushed):
             self.flush()
         if not self._closed:
             self._disconnect()
             self._closed = True
 
-    def _recvall(self, length):
-        data = bytearray(length)
-        view = memoryview(data)
-        bytes_left = length
+    def set_stats(self, stats):
+        """
+        Attaches a TransferStats object (see nbd_stats), which collects the
+        count, size and latency of every request from now on, and the time
+        spent sending and receiving. Pass None to stop collecting.
+        """
+        self._stats = stats
+        self._sent = {}
+
+    def _recvall_into(self, view):
+        """
+        Receives exactly len(view) bytes into the given writable memoryview.
+        """
+        if self._stats is not None:
+            start = time.perf_counter()
+            self._recvall_into_untimed(view)
+            self._stats.add_time('receive', time.perf_counter() - start)
+        else:
+            self._recvall_into_untimed(view)
+
+    def _recvall_into_untimed(self, view):
+        bytes_left = len(view)
         while bytes_left:
             received = self._s.recv_into(view, bytes_left)
             # If recv reads 0 bytes, that means the peer has properly
@@ -289,144 +619,103 @@ class PythonNbdClient(object):
                 raise NBDEOFError
             view = view[received:]
             bytes_left -= received
+
+    def _recvall(self, length):
+        data = bytearray(length)
+        self._recvall_into(memoryview(data))
         return data
 
     # Handshake phase
 
-    #  Newstyle handshake
+    def _negotiate(self, step):
+        """
+        Runs the given step of the handshake, one of the generators of this
+        module such as info_option, on the socket, and returns its result.
+        """
+        try:
+            request = next(step)
+            while True:
+                if isinstance(request, int):
+                    request = step.send(self._recvall(request))
+                else:
+                    self._s.sendall(request)
+                    request = step.send(None)
+        except StopIteration as stop:
+            return stop.value
 
-    def _send_option(self, option, data=b''):
-        LOGGER.debug("NBD sending option header")
-        data_length = len(data)
-        LOGGER.debug("option='%d' data_length='%d'", option, data_length)
-        self._s.sendall(b'IHAVEOPT')
-        header = struct.pack(">LL", option, data_length)
-        self._s.sendall(header + data)
-        self._last_sent_option = option
-
-    def _parse_option_reply(self):
-        LOGGER.debug("NBD parsing option reply")
-        reply = self._recvall(8 + 4 + 4 + 4)
-        (magic, option, reply_type, data_length) = struct.unpack(
-            ">QLLL", reply)
-        LOGGER.debug("NBD reply magic='0x%x' option='%d' reply_type='%d'",
-                     magic, option, reply_type)
-        assert_protocol(magic == OPTION_REPLY_MAGIC)
-        if option != self._last_sent_option:
-            raise NBDUnexpectedOptionResponseError(
-                expected=self._last_sent_option, received=option)
-        if reply_type & NBD_REP_ERROR_BIT != 0:
-            raise NBDOptionError(reply=reply_type)
-        data = self._recvall(data_length)
-        return (reply_type, data)
-
-    def _parse_option_reply_ack(self):
-        (reply_type, data) = self._parse_option_reply()
-        if reply_type != NBD_REP_ACK:
-            raise NBDProtocolError()
-        return data
+    #  Newstyle handshake
 
-    def _parse_meta_context_reply(self):
-        (reply_type, data) = self._parse_option_reply()
-        if reply_type == NBD_REP_ACK:
-            return None
-        assert_protocol(reply_type == NBD_REP_META_CONTEXT)
-        context_id = struct.unpack(">L", data[:4])[0]
-        name = (data[4:]).decode('utf-8')
-        return (context_id, name)
-
-    def _upgrade_socket_to_tls(self, cert, subject):
-        # Forcing the client to use TLSv1_2
-        context = ssl.SSLContext(ssl.PROTOCOL_TLSv1_2)
-        context.options &= ~ssl.OP_NO_TLSv1
-        context.options &= ~ssl.OP_NO_TLSv1_1
-        context.options &= ~ssl.OP_NO_SSLv2
-        context.options &= ~ssl.OP_NO_SSLv3
-        context.verify_mode = ssl.CERT_REQUIRED
-        context.check_hostname = (subject is not None)
-        context.load_verify_locations(cadata=cert)
+    def _upgrade_socket_to_tls(self, cert, subject,
+                               ssl_context=None, ssl_session=None):
+        context = ssl_context
+        if context is None:
+            context = make_tls_context(cert=cert, subject=subject)
         cleartext_socket = self._s
         self._s = context.wrap_socket(
             cleartext_socket,
             server_side=False,
             do_handshake_on_connect=True,
-            server_hostname=subject)
+            server_hostname=subject,
+            session=ssl_session)
+        LOGGER.debug("TLS session reused: %s", self._s.session_reused)
+
+    def get_ssl_session(self):
+        """
+        Returns the TLS session of this connection, which can be used to
+        resume it on a new connection, or None if TLS is not used.
+        """
+        if isinstance(self._s, ssl.SSLSocket):
+            return self._s.session
+        return None
 
-    def _initiate_tls_upgrade(self):
-        # start TLS negotiation
-        self._send_option(NBD_OPT_STARTTLS)
-        # receive reply
-        data = self._parse_option_reply_ack()
-        assert_protocol(len(data) == 0)
+    def is_ssl_session_reused(self):
+        """
+        Returns True if this connection resumed an earlier TLS session.
+        """
+        return isinstance(self._s, ssl.SSLSocket) and self._s.session_reused
 
     def request_info(self, export_name, info_requests):
         """Query information from the server."""
-        data = struct.pack('>L', len(export_name))
-        data += export_name.encode('utf-8')
-        data += struct.pack('>H', len(info_requests))
-        for request in info_requests:
-            data += struct.pack('>H', request)
-        self._send_option(NBD_OPT_INFO, data)
-        infos = []
-        while True:
-            (reply_type, data) = self._parse_option_reply()
-            if reply_type == NBD_REP_INFO:
-                info_type = struct.unpack(">H", data[:2])[0]
-                info = {'information_type': info_type}
-                payload = data[2:]
-                if info_type == NBD_INFO_BLOCK_SIZE:
-                    assert_protocol(len(data) == 14)
-                    sizes = struct.unpack('>LLL', payload)
-                    (info['minimum_block_size'],
-                     info['preferred_block_size'],
-                     info['maximum_block_size']) = sizes
-                    infos += [info]
-                elif info_type == NBD_INFO_EXPORT:
-                    assert_protocol(len(data) == 12)
-                    export_info = struct.unpack('>QH', payload)
-                    (info['size'],
-                     info['transmission_flags']) = export_info
-                    infos += [info]
-                else:
-                    # The client MUST ignore information replies it does not
-                    # understand.
-                    LOGGER.warning('Unsupported info reply type: %d',
-                                   info_type)
-            elif reply_type == NBD_REP_ACK:
-                assert_protocol(not data)
-                break
-            else:
-                raise NBDProtocolError(
-                    'Unexpected reply type: {}'.format(reply_type))
+        infos = self._negotiate(info_option(export_name, info_requests))
+        for info in infos:
+            if info['information_type'] == NBD_INFO_BLOCK_SIZE:
+                self._block_size_constraints = {
+                    key: info[key] for key in ('minimum_block_size',
+                                               'preferred_block_size',
+                                               'maximum_block_size')}
         return infos
 
+    def query_block_size_constraints(self, export_name):
+        """
+        Asks the server for the block size constraints of the given export
+        using NBD_OPT_INFO. Only valid during the handshake phase.
+        Returns None if the server does not support NBD_OPT_INFO or does
+        not report block size constraints, otherwise the same dictionary as
+        get_block_size_constraints.
+        """
+        try:
+            self.request_info(export_name, [NBD_INFO_BLOCK_SIZE])
+        except NBDOptionError:
+            LOGGER.info("Server does not support NBD_OPT_INFO")
+        return self._block_size_constraints
+
+    def get_block_size_constraints(self):
+        """
+        Returns the block size constraints reported by the server in reply
+        to request_info as a dictionary with the minimum_block_size,
+        preferred_block_size and maximum_block_size keys, or None if the
+        server has not reported them.
+        """
+        return self._block_size_constraints
+
     def negotiate_structured_reply(self):
         """
         Negotiate use of the structured reply extension, fail if unsupported.
         Only valid during the handshake phase.
         """
-        self._send_option(NBD_OPT_STRUCTURED_REPLY)
-        self._parse_option_reply_ack()
+        self._negotiate(structured_reply_option())
         self._structured_reply = True
 
-    def _process_meta_context_option(self, option, export_name, queries):
-        data = struct.pack('>L', len(export_name))
-        data += export_name.encode('utf-8')
-        data += struct.pack('>L', len(queries))
-        for query in queries:
-            data += struct.pack('>L', len(query))
-            data += query.encode('utf-8')
-        self._send_option(option, data)
-        while True:
-            reply = self._parse_meta_context_reply()
-            if reply is None:
-                break
-            yield reply
-
-    def _send_meta_context_option(self, option, export_name, queries):
-        return list(self._process_meta_context_option(
-            option, export_name, queries))
-
     def set_meta_contexts(self, export_name, queries):
         """
         Change the set of active metadata contexts. Only valid during the
@@ -435,10 +724,20 @@ class PythonNbdClient(object):
         Structured replies must be negotiated first using
         negotiate_structured_reply.
         """
-        return self._send_meta_context_option(
+        contexts = self._negotiate(meta_context_option(
             option=NBD_OPT_SET_META_CONTEXT,
             export_name=export_name,
-            queries=queries)
+            queries=queries))
+        self._meta_contexts = {name: context_id
+                               for (context_id, name) in contexts}
+        return contexts
+
+    def get_meta_context_id(self, name):
+        """
+        Returns the ID of the given active metadata context, or None if it
+        has not been selected by set_meta_contexts.
+        """
+        return self._meta_contexts.get(name)
 
     def list_meta_contexts(self, export_name, queries):
         """
@@ -448,172 +747,215 @@ class PythonNbdClient(object):
         Structured replies be negotiated first using
         negotiate_structured_reply.
         """
-        return self._send_meta_context_option(
+        return self._negotiate(meta_context_option(
             option=NBD_OPT_LIST_META_CONTEXT,
             export_name=export_name,
-            queries=queries)
-
-    def _fixed_new_style_handshake(self, cert, subject, use_tls):
-        nbd_magic = self._recvall(len("NBDMAGIC"))
-        assert_protocol(nbd_magic == b'NBDMAGIC')
-        nbd_magic = self._recvall(len("IHAVEOPT"))
-        assert_protocol(nbd_magic == b'IHAVEOPT')
-        buf = self._recvall(2)
-        handshake_flags = struct.unpack(">H", buf)[0]
-        assert_protocol(handshake_flags & NBD_FLAG_HAS_FLAGS != 0)
-        client_flags = NBD_FLAG_C_FIXED_NEWSTYLE
-        client_flags = struct.pack('>L', client_flags)
-        self._s.sendall(client_flags)
+            queries=queries))
 
+    def _fixed_new_style_handshake(self, cert, subject, use_tls,
+                                   ssl_context=None, ssl_session=None):
+        self._negotiate(fixed_newstyle_greeting())
         if use_tls:
             # start TLS negotiation
-            self._initiate_tls_upgrade()
+            self._negotiate(starttls_option())
             # upgrade socket to TLS
-            self._upgrade_socket_to_tls(cert, subject)
+            self._upgrade_socket_to_tls(
+                cert, subject,
+                ssl_context=ssl_context, ssl_session=ssl_session)
 
     def connect(self, exportname):
         """
         Valid only during the handshake phase. Requests the given
         export and enters the transmission phase.
         """
-        LOGGER.info("Connecting to export '%s' using newstyle negotiation",
-                    exportname)
-        # request export
-        self._send_option(NBD_OPT_EXPORT_NAME, exportname.encode('utf-8'))
-
-        # non-fixed newstyle negotiation: we get these if the server is willing
-        # to allow the export
-        buf = self._recvall(10)
-        (self._size, self._transmission_flags) = struct.unpack(">QH", buf)
-        LOGGER.debug("NBD got size=%d transmission flags=%d",
-                     self._size, self._transmission_flags)
-        # ignore the zeroes
-        zeroes = self._recvall(124)
-        LOGGER.debug("NBD got zeroes: %s", zeroes)
+        (self._size, self._transmission_flags) = self._negotiate(
+            export_name_option(exportname))
         self._transmission_phase = True
         LOGGER.debug("Connected")
 
     #  Oldstyle handshake
 
     def _old_style_handshake(self):
-        LOGGER.info("Connecting to server using oldstyle negotiation")
-        nbd_magic = self._recvall(len("NBDMAGIC"))
-        assert_protocol(nbd_magic == b'NBDMAGIC')
-        buf = self._recvall(8 + 8 + 4)
-        (magic,
-         self._size,
-         self._transmission_flags) = struct.unpack(">QQL", buf)
-        assert_protocol(magic == 0x00420281861253)
-        # ignore trailing zeroes
-        self._recvall(124)
+        (self._size, self._transmission_flags) = self._negotiate(
+            oldstyle_greeting())
         self._transmission_phase = True
 
     # Transmission phase
 
+    def _sendall(self, data):
+        if self._stats is not None:
+            start = time.perf_counter()
+            self._s.sendall(data)
+            self._stats.add_time('send', time.perf_counter() - start)
+        else:
+            self._s.sendall(data)
+
     def _send_request_header(self, request_type, offset, length):
-        LOGGER.debug("NBD request offset=%d length=%d", offset, length)
-        command_flags = 0
+        if self._debug:
+            LOGGER.debug("NBD request offset=%d length=%d", offset, length)
         self._handle += 1
-        header = struct.pack('>LHHQQL', NBD_REQUEST_MAGIC, command_flags,
-                             request_type, self._handle, offset, length)
-        self._s.sendall(header)
-
-    def _check_handle(self, handle):
-        if handle != self._handle:
+        header = encode_request(request_type, self._handle, offset, length)
+        if self._stats is not None:
+            self._sent[self._handle] = (
+                request_type, length, time.perf_counter())
+        self._sendall(header)
+        return self._handle
+
+    def _request_completed(self, handle, error=False):
+        """
+        Records the completion of the request with the given handle, if
+        stats are being collected.
+        """
+        if self._stats is None:
+            return
+        sent = self._sent.pop(handle, None)
+        if sent is None:
+            return
+        (request_type, length, start) = sent
+        self._stats.record_request(
+            request_type=request_type,
+            length=length,
+            latency=time.perf_counter() - start,
+            error=error)
+
+    def _check_handle(self, handle, in_flight=None):
+        if in_flight is None:
+            if handle != self._handle:
+                raise NBDUnexpectedReplyHandleError(
+                    expected=self._handle, received=handle)
+        elif handle not in in_flight:
             raise NBDUnexpectedReplyHandleError(
-                expected=self._handle, received=handle)
+                expected=sorted(in_flight), received=handle)
 
-    def _parse_simple_reply(self, data_length=0):
-        LOGGER.debug("NBD parsing simple reply, data_length=%d", data_length)
-        reply = self._recvall(4 + 4 + 8)
-        (magic, errno, handle) = struct.unpack(">LLQ", reply)
-        LOGGER.debug("NBD simple reply magic='0x%x' errno='%d' handle='%d'",
-                     magic, errno, handle)
+    def _parse_simple_reply_header(self, in_flight=None, magic=None):
+        if magic is None:
+            reply = self._recvall(4 + 4 + 8)
+            (magic, errno, handle) = struct.unpack(">LLQ", reply)
+        else:
+            # The magic has already been received
+            reply = self._recvall(4 + 8)
+            (errno, handle) = struct.unpack(">LQ", reply)
+        if self._debug:
+            LOGGER.debug(
+                "NBD simple reply magic='0x%x' errno='%d' handle='%d'",
+                magic, errno, handle)
         assert_protocol(magic == NBD_SIMPLE_REPLY_MAGIC)
-        self._check_handle(handle)
+        self._check_handle(handle, in_flight=in_flight)
+        return (errno, handle)
+
+    def _parse_simple_reply(self, data_length=0):
+        if self._debug:
+            LOGGER.debug("NBD parsing simple reply, data_length=%d",
+                         data_length)
+        (errno, handle) = self._parse_simple_reply_header()
         data = self._recvall(length=data_length)
-        LOGGER.debug("NBD response received data_length=%d bytes", data_length)
+        if self._debug:
+            LOGGER.debug("NBD response received data_length=%d bytes",
+                         data_length)
+        self._request_completed(handle, error=(errno != 0))
         if errno != 0:
             raise NBDTransmissionError(errno)
         return data
 
-    def _handle_block_status_reply(self, fields):
-        data_length = fields['data_length']
-        assert_protocol((data_length >= 12) and (data_length % 8 == 4))
-        data = self._recvall(data_length)
-        view = memoryview(data)
-        fields['context_id'] = struct.unpack(">L", view[:4])[0]
-        view = view[4:]
-        descriptors = list(_parse_block_status_descriptors(view))
-        assert_protocol(descriptors)
-        fields['descriptors'] = descriptors
-
-    def _handle_data_reply(self, fields):
+    def _handle_data_reply(self, fields, into=None):
         data_length = fields['data_length']
         assert_protocol(data_length >= 9)
         buf = self._recvall(8)
         fields['offset'] = struct.unpack(">Q", buf)[0]
-        fields['data'] = self._recvall(data_length - 8)
+        request = None if into is None else into.get(fields['handle'])
+        if request is None or request[2] is None:
+            fields['data'] = self._recvall(data_length - 8)
+        else:
+            # Receive the data straight into the caller's buffer:
+            (offset, length, buffer) = request
+            start = fields['offset'] - offset
+            end = start + data_length - 8
+            assert_protocol(0 <= start and end <= length)
+            fields['data'] = buffer[start:end]
+            self._recvall_into(fields['data'])
         assert_protocol(fields['data'])
 
-    def _handle_hole_reply(self, fields):
-        assert_protocol(fields['data_length'] == 12)
-        buf = self._recvall(12)
-        (fields['offset'], fields['hole_size']) = struct.unpack(">QL", buf)
-
-    def _handle_structured_reply_error(self, fields):
-        data_length = fields['data_length']
-        assert_protocol(data_length >= 6)
-        buf = self._recvall(4 + 2)
-        (errno, message_length) = struct.unpack(">LH", buf)
-        fields['error'] = errno
-        remaining_length = data_length - 6
-        # The client MAY continue transmission in case of an unexpected error
-        # type, unless message_length does not fit into the length:
-        if message_length > remaining_length:
-            raise NBDProtocolError(
-                'message_length is too large to fit within data_length bytes')
-        data = self._recvall(remaining_length)
-        view = memoryview(data)
-        fields['message'] = view[0:message_length].tobytes().decode('utf-8')
-        view = view[message_length:]
-        if fields['reply_type'] == NBD_REPLY_TYPE_ERROR_OFFSET:
-            fields['offset'] = struct.unpack(">Q", view)[0]
-
-    def _parse_structured_reply_chunk(self):
-        LOGGER.debug("NBD parsing structured reply chunk")
-        reply = self._recvall(4 + 2 + 2 + 8 + 4)
-        header = struct.unpack(">LHHQL", reply)
-        (magic, flags, reply_type, handle, data_length) = header
-        LOGGER.debug("NBD structured reply magic='%x' flags='%s' "
-                     "reply_type='%d' handle='%d' data_length='%d'",
-                     magic, flags, reply_type, handle, data_length)
+    def _parse_structured_reply_chunk(self, in_flight=None, into=None,
+                                      magic=None):
+        if magic is None:
+            reply = self._recvall(4 + 2 + 2 + 8 + 4)
+            magic = struct.unpack(">L", reply[:4])[0]
+            fields = parse_structured_reply_header(reply[4:])
+        else:
+            # The magic has already been received
+            fields = parse_structured_reply_header(
+                self._recvall(2 + 2 + 8 + 4))
+        if self._debug:
+            LOGGER.debug("NBD structured reply magic='%x' flags='%s' "
+                         "reply_type='%d' handle='%d' data_length='%d'",
+                         magic, fields['flags'], fields['reply_type'],
+                         fields['handle'], fields['data_length'])
         assert_protocol(magic == NBD_STRUCTURED_REPLY_MAGIC)
-        self._check_handle(handle)
-        fields = {'flags': flags,
-                  'reply_type': reply_type,
-                  'data_length': data_length}
-        if reply_type == NBD_REPLY_TYPE_BLOCK_STATUS:
-            self._handle_block_status_reply(fields)
-        elif reply_type == NBD_REPLY_TYPE_NONE:
-            assert_protocol(data_length == 0)
-            assert_protocol(_is_final_structured_reply_chunk(flags=flags))
-        elif reply_type == NBD_REPLY_TYPE_OFFSET_DATA:
-            self._handle_data_reply(fields)
-        elif reply_type == NBD_REPLY_TYPE_OFFSET_HOLE:
-            self._handle_hole_reply(fields)
-        elif is_error_chunk(reply_type=reply_type):
-            self._handle_structured_reply_error(fields)
+        self._check_handle(fields['handle'], in_flight=in_flight)
+        if fields['reply_type'] == NBD_REPLY_TYPE_OFFSET_DATA:
+            # Kept apart, to be able to receive the data into a buffer
+            self._handle_data_reply(fields, into=into)
         else:
-            raise NBDUnexpectedStructuredReplyType(reply_type)
+            parse_structured_reply_payload(
+                fields, self._recvall(fields['data_length']))
         return fields
 
     def _parse_structured_reply_chunks(self):
+        error = False
         while True:
             reply = self._parse_structured_reply_chunk()
-            yield reply
-            if _is_final_structured_reply_chunk(flags=reply['flags']):
+            error = error or is_error_chunk(reply['reply_type'])
+            if is_final_structured_reply_chunk(flags=reply['flags']):
+                self._request_completed(reply['handle'], error=error)
+                yield reply
                 return
+            yield reply
+
+    def _receive_command_reply(self, errors, in_flight=None):
+        """
+        Receives the next reply, or structured reply chunk, to the last
+        request, or to one of the given in-flight requests, of a command
+        whose reply carries no data, such as a write or a flush. Once
+        structured replies have been negotiated, the server may send either
+        a simple reply or a structured reply to these commands, so the two
+        are told apart by their magic. A structured reply is made of error
+        chunks and a final chunk, and the errors of its chunks received so
+        far are kept in the given errors dictionary, by handle.
+        Returns the handle of the request once its reply is complete, or
+        None. Raises NBDTransmissionError if the server reported an error.
+        """
+        magic = None
+        if self._structured_reply:
+            magic = struct.unpack(">L", self._recvall(4))[0]
+        if magic != NBD_STRUCTURED_REPLY_MAGIC:
+            (errno, handle) = self._parse_simple_reply_header(
+                in_flight=in_flight, magic=magic)
+        else:
+            chunk = self._parse_structured_reply_chunk(
+                in_flight=in_flight, magic=magic)
+            handle = chunk['handle']
+            reply_type = chunk['reply_type']
+            assert_protocol(reply_type == NBD_REPLY_TYPE_NONE or
+                            is_error_chunk(reply_type=reply_type))
+            errno = errors.pop(handle, 0)
+            if is_error_chunk(reply_type=reply_type):
+                errno = errno or chunk['error']
+            if not is_final_structured_reply_chunk(flags=chunk['flags']):
+                errors[handle] = errno
+                return None
+        self._request_completed(handle, error=(errno != 0))
+        if errno != 0:
+            raise NBDTransmissionError(errno)
+        return handle
+
+    def _parse_command_reply(self):
+        """
+        Receives the complete reply to the last request, of a command whose
+        reply carries no data, see _receive_command_reply.
+        """
+        errors = {}
+        while self._receive_command_reply(errors=errors) is None:
+            pass
 
     def write(self, data, offset):
         """
@@ -621,29 +963,79 @@ class PythonNbdClient(object):
         offset.
         """
         LOGGER.debug("NBD_CMD_WRITE")
-        _check_alignment("offset", offset)
-        _check_alignment("size", len(data))
+        check_alignment("offset", offset)
+        check_alignment("size", len(data))
         self._flushed = False
         self._send_request_header(NBD_CMD_WRITE, offset, len(data))
-        self._s.sendall(data)
-        # TODO: the server MAY respond with a structured reply (e.g. to report
-        # errors)
-        self._parse_simple_reply()
+        self._sendall(data)
+        self._parse_command_reply()
         return len(data)
 
+    def write_pipelined(self, requests, max_in_flight=DEFAULT_MAX_IN_FLIGHT):
+        """
+        Writes the given (offset, data) pairs to the export, where data is a
+        bytes-like object, keeping up to max_in_flight write requests
+        outstanding at the same time, instead of waiting for the reply to
+        each request before sending the next one. If data is an int instead,
+        that many zeroes are written with NBD_CMD_WRITE_ZEROES, which the
+        server must support, see can_write_zeroes.
+        Returns a generator that yields each (offset, data) pair once the
+        server has acknowledged its write, in the order of the replies, so
+        that the buffer of the data can be reused. As with
+        read_into_pipelined, the requests are consumed lazily.
+        The caller must consume this generator before further NBD commands.
+        """
+        if max_in_flight < 1:
+            raise ValueError("max_in_flight=%i must be positive" %
+                             max_in_flight)
+        requests = iter(requests)
+        # handle -> (offset, data) of requests waiting for a reply
+        in_flight = {}
+        # handle -> error of the structured reply chunks received so far
+        errors = {}
+        exhausted = False
+        while True:
+            while not exhausted and len(in_flight) < max_in_flight:
+                request = next(requests, None)
+                if request is None:
+                    exhausted = True
+                    break
+                (offset, data) = request
+                check_alignment("offset", offset)
+                self._flushed = False
+                if isinstance(data, int):
+                    if self._debug:
+                        LOGGER.debug("NBD_CMD_WRITE_ZEROES")
+                    check_alignment("length", data)
+                    handle = self._send_request_header(
+                        NBD_CMD_WRITE_ZEROES, offset, data)
+                else:
+                    view = _byte_view(data)
+                    if self._debug:
+                        LOGGER.debug("NBD_CMD_WRITE")
+                    check_alignment("size", len(view))
+                    handle = self._send_request_header(
+                        NBD_CMD_WRITE, offset, len(view))
+                    self._sendall(view)
+                in_flight[handle] = request
+            if not in_flight:
+                return
+            handle = self._receive_command_reply(
+                errors=errors, in_flight=in_flight)
+            if handle is not None:
+                yield in_flight.pop(handle)
+
     def write_zeroes(self, offset, length):
         """
         Writes the given number of zeroes to the export, starting at the given
         offset.
         """
         LOGGER.debug("NBD_CMD_WRITE")
-        _check_alignment("offset", offset)
-        _check_alignment("length", length)
+        check_alignment("offset", offset)
+        check_alignment("length", length)
         self._flushed = False
         self._send_request_header(NBD_CMD_WRITE_ZEROES, offset, length)
-        # TODO: the server MAY respond with a structured reply (e.g. to report
-        # errors)
-        self._parse_simple_reply()
+        self._parse_command_reply()
         return length
 
     def read(self, offset, length):
@@ -655,15 +1047,137 @@ class PythonNbdClient(object):
         before further NBD commands, since this client does not support
         asynchronous request processing.
         """
-        LOGGER.debug("NBD_CMD_READ")
-        _check_alignment("offset", offset)
-        _check_alignment("length", length)
+        if self._debug:
+            LOGGER.debug("NBD_CMD_READ")
+        check_alignment("offset", offset)
+        check_alignment("length", length)
         self._send_request_header(NBD_CMD_READ, offset, length)
         if self._structured_reply:
             return self._parse_structured_reply_chunks()
         data = self._parse_simple_reply(length)
         return data
 
+    def read_into(self, offset, buffer):
+        """
+        Reads len(buffer) bytes from the export, starting at the given
+        offset, straight into the given writable buffer, without allocating
+        intermediate copies of the data.
+        If structured replies have been negotiated, it returns the list of
+        the reply chunks, the data of which are views of the buffer. The
+        ranges of the buffer covered by hole chunks are left untouched.
+        """
+        return next(self.read_into_pipelined(
+            requests=[(offset, buffer)], max_in_flight=1))[1]
+
+    def _receive_read_reply(self, in_flight, chunks, completed):
+        """
+        Receives the next simple reply or structured reply chunk sent in
+        response to one of the in-flight read requests. When the reply to a
+        request is complete, it is moved from in_flight to completed.
+        """
+        if self._structured_reply:
+            chunk = self._parse_structured_reply_chunk(
+                in_flight=in_flight, into=in_flight)
+            handle = chunk['handle']
+            chunks.setdefault(handle, []).append(chunk)
+            if not is_final_structured_reply_chunk(flags=chunk['flags']):
+                return
+            completed[handle] = chunks.pop(handle)
+            if self._stats is not None:
+                self._request_completed(handle, error=any(
+                    is_error_chunk(chunk['reply_type'])
+                    for chunk in completed[handle]))
+        else:
+            (errno, handle) = self._parse_simple_reply_header(
+                in_flight=in_flight)
+            (_, length, buffer) = in_flight[handle]
+            if buffer is None:
+                data = self._recvall(length)
+            else:
+                data = buffer
+                self._recvall_into(buffer)
+            self._request_completed(handle, error=(errno != 0))
+            if errno != 0:
+                raise NBDTransmissionError(errno)
+            completed[handle] = data
+        del in_flight[handle]
+
+    def read_pipelined(self, requests, max_in_flight=DEFAULT_MAX_IN_FLIGHT):
+        """
+        Reads the given (offset, length) ranges from the export, keeping up to
+        max_in_flight read requests outstanding at the same time, instead of
+        waiting for the reply to each request before sending the next one.
+        Replies are matched to their requests by their handles, so the server
+        may reply in any order.
+        Returns a generator that yields an (offset, reply) pair for each
+        request, in the order of the requests, where reply is the data read
+        if simple replies are used, or the list of the reply chunks if
+        structured replies have been negotiated.
+        The caller must consume this generator before further NBD commands.
+        """
+        return self._read_pipelined(
+            requests=((offset, length, None) for (offset, length) in requests),
+            max_in_flight=max_in_flight)
+
+    def read_into_pipelined(self,
+                            requests,
+                            max_in_flight=DEFAULT_MAX_IN_FLIGHT):
+        """
+        Like read_pipelined, but takes (offset, buffer) pairs, and receives
+        the data of each request straight into its writable buffer, as
+        read_into does. The yielded reply is the memoryview of the buffer if
+        simple replies are used, or the list of the reply chunks if
+        structured replies have been negotiated.
+        The requests are consumed lazily, only when there is room for another
+        in-flight request, so the caller may hand out buffers from a pool of
+        max_in_flight buffers, and reuse a buffer once its reply is yielded.
+        """
+        return self._read_pipelined(
+            requests=((offset, len(view), view) for (offset, view) in
+                      ((offset, _byte_view(buffer))
+                       for (offset, buffer) in requests)),
+            max_in_flight=max_in_flight)
+
+    def _read_pipelined(self, requests, max_in_flight):
+        if max_in_flight < 1:
+            raise ValueError("max_in_flight=%i must be positive" %
+                             max_in_flight)
+        requests = iter(requests)
+        # handle -> (offset, length, buffer or None) of requests waiting for
+        # a reply
+        in_flight = {}
+        # handle -> reply chunks received so far for a structured reply
+        chunks = {}
+        # handle -> complete reply not yet yielded to the caller
+        completed = {}
+        # handles of the requests not yet yielded, in the order of requests
+        order = collections.deque()
+        exhausted = False
+        while True:
+            while not exhausted and len(order) < max_in_flight:
+                request = next(requests, None)
+                if request is None:
+                    exhausted = True
+                    break
+                (offset, length, buffer) = request
+                if self._debug:
+                    LOGGER.debug("NBD_CMD_READ")
+                check_alignment("offset", offset)
+                check_alignment("length", length)
+                handle = self._send_request_header(
+                    NBD_CMD_READ, offset, length)
+                in_flight[handle] = (offset, length, buffer)
+                order.append((handle, offset))
+            if not order:
+                return
+            (handle, offset) = order[0]
+            if handle in completed:
+                order.popleft()
+                yield (offset, completed.pop(handle))
+            else:
+                self._receive_read_reply(
+                    in_flight=in_flight, chunks=chunks, completed=completed)
+
     def _need_flush(self):
         return self._transmission_flags & NBD_FLAG_SEND_FLUSH != 0
 
@@ -679,9 +1193,7 @@ class PythonNbdClient(object):
             return False
         LOGGER.debug("NBD_CMD_FLUSH")
         self._send_request_header(NBD_CMD_FLUSH, 0, 0)
-        # TODO: the server MAY respond with a structured reply (e.g. to report
-        # errors)
-        self._parse_simple_reply()
+        self._parse_command_reply()
         self._flushed = True
         return True
 
@@ -701,7 +1213,20 @@ class PythonNbdClient(object):
             LOGGER.debug("NBD_CMD_DISC")
             self._send_request_header(NBD_CMD_DISC, 0, 0)
         else:
-            self._send_option(NBD_OPT_ABORT)
+            self._negotiate(abort_option())
+
+    def can_write_zeroes(self):
+        """
+        Returns True if the server supports NBD_CMD_WRITE_ZEROES.
+        """
+        return self._transmission_flags & NBD_FLAG_SEND_WRITE_ZEROES != 0
+
+    def can_multi_conn(self):
+        """
+        Returns True if the server allows multiple connections to the same
+        export, and guarantees that they all see a consistent state.
+        """
+        return self._transmission_flags & NBD_FLAG_CAN_MULTI_CONN != 0
 
     def get_size(self):
         """
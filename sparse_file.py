@@ -0,0 +1,229 @@
+"""
+Helpers for finding the data and the zeroes in sparse files and buffers, and
+for copying sparse files.
+"""
+
+import errno
+import fcntl
+import os
+import time
+
+# The granularity at which zero blocks are detected in the data
+ZERO_BLOCK_SIZE = 64 * 1024
+
+_ZEROES = bytes(ZERO_BLOCK_SIZE)
+
+# The ioctl sharing all the data of a file with another one, _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+# The errors meaning that a way of copying is not supported for the given
+# files, rather than that the copy failed
+_UNSUPPORTED_ERRORS = (errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV,
+                       errno.EINVAL, errno.ENOSYS)
+
+# The size of the chunks copied through userspace
+_COPY_CHUNK_SIZE = 1024 * 1024
+
+
+def file_extents(fd, offset, length):
+    """
+    Yields the (offset, length, is_data) extents of the given range of the
+    file, found with SEEK_DATA and SEEK_HOLE, where is_data is False for
+    the holes, which read as zeroes. If the platform or the filesystem does
+    not support finding holes, the whole range is reported as data.
+    """
+    end = offset + length
+    while offset < end:
+        try:
+            data = os.lseek(fd, offset, os.SEEK_DATA)
+        except OSError as error:
+            if error.errno == errno.ENXIO:
+                # Only a hole after the offset
+                data = end
+            elif error.errno in (errno.EINVAL, errno.EOPNOTSUPP):
+                yield (offset, end - offset, True)
+                return
+            else:
+                raise
+        data = min(data, end)
+        if data > offset:
+            yield (offset, data - offset, False)
+            offset = data
+            continue
+        hole = min(os.lseek(fd, offset, os.SEEK_HOLE), end)
+        yield (offset, hole - offset, True)
+        offset = hole
+
+
+class FileReader(object):
+    """
+    Reads the data of a file by offset, and finds its holes. The chunk
+    store's ChunkMapReader provides the same methods, so that restores can
+    read from either.
+    """
+
+    def __init__(self, path):
+        self._fd = os.open(str(path), os.O_RDONLY)
+        self.size = os.fstat(self._fd).st_size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def extents(self, offset, length):
+        """
+        Yields the (offset, length, is_data) extents of the given range, see
+        file_extents.
+        """
+        return file_extents(self._fd, offset, length)
+
+    def pread_into(self, view, offset):
+        """
+        Fills the given writable memoryview with the data at the given
+        offset.
+        """
+        while view:
+            read = os.preadv(self._fd, [view], offset)
+            if read == 0:
+                raise EOFError(
+                    "Unexpected end of file at offset {}".format(offset))
+            view = view[read:]
+            offset += read
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+def is_zero(view):
+    """
+    Returns True if the given memoryview of bytes only contains zeroes.
+    """
+    for start in range(0, len(view), ZERO_BLOCK_SIZE):
+        block = view[start:start + ZERO_BLOCK_SIZE]
+        # Most blocks of data are told apart by their first or last byte,
+        # without copying them:
+        if block[0] or block[-1] or block.tobytes() != _ZEROES[:len(block)]:
+            return False
+    return True
+
+
+def zero_runs(view):
+    """
+    Splits the given memoryview of bytes into runs of ZERO_BLOCK_SIZE
+    blocks, and yields the (start, length, is_zero) runs, where is_zero is
+    True for the runs of blocks that only contain zeroes. Adjacent runs of
+    the same kind are merged.
+    """
+    run_start = 0
+    run_is_zero = None
+    for start in range(0, len(view), ZERO_BLOCK_SIZE):
+        block_is_zero = is_zero(view[start:start + ZERO_BLOCK_SIZE])
+        if block_is_zero != run_is_zero:
+            if start > run_start:
+                yield (run_start, start - run_start, run_is_zero)
+            run_start = start
+            run_is_zero = block_is_zero
+    if len(view) > run_start:
+        yield (run_start, len(view) - run_start, run_is_zero)
+
+
+def _copy_range(src_fd, dst_fd, offset, length):
+    """
+    Copies the given range of the source file to the same range of the
+    destination file with copy_file_range, which lets the kernel copy the
+    data, or share it on filesystems that support it.
+    """
+    end = offset + length
+    while offset < end:
+        copied = os.copy_file_range(
+            src_fd, dst_fd, end - offset, offset, offset)
+        if copied == 0:
+            raise EOFError("Source file truncated at offset {}".format(offset))
+        offset += copied
+
+
+def _read_write_range(src_fd, dst_fd, offset, length):
+    """
+    Copies the given range of the source file to the same range of the
+    destination file through a buffer.
+    """
+    end = offset + length
+    while offset < end:
+        data = os.pread(src_fd, min(_COPY_CHUNK_SIZE, end - offset), offset)
+        if not data:
+            raise EOFError("Source file truncated at offset {}".format(offset))
+        view = memoryview(data)
+        while view:
+            written = os.pwrite(dst_fd, view, offset)
+            view = view[written:]
+            offset += written
+
+
+def _copy_data(src_fd, dst_fd, size):
+    """
+    Copies the data extents of the source file to the destination file,
+    leaving its holes as holes, with copy_file_range if possible.
+    Returns the method used and the number of bytes copied.
+    """
+    method = ('copy_file_range' if hasattr(os, 'copy_file_range')
+              else 'read_write')
+    copied = 0
+    for (offset, length, is_data) in file_extents(src_fd, 0, size):
+        if not is_data:
+            continue
+        if method == 'copy_file_range':
+            try:
+                _copy_range(src_fd, dst_fd, offset, length)
+            except OSError as error:
+                # Only possible before anything was copied, for example
+                # across filesystems on older kernels
+                if error.errno not in _UNSUPPORTED_ERRORS or copied:
+                    raise
+                method = 'read_write'
+        if method == 'read_write':
+            _read_write_range(src_fd, dst_fd, offset, length)
+        copied += length
+    return (method, copied)
+
+
+def copy_sparse_file(src, dst):
+    """
+    Copies the source file to the destination file, replacing it, without
+    the data going through userspace if possible: the data is shared with
+    the FICLONE ioctl on filesystems that support reflinks, otherwise only
+    the data extents of the source are copied with copy_file_range, and its
+    holes stay holes, and only as a last resort through a buffer.
+
+    Returns:
+        A dictionary with the method used, 'reflink', 'copy_file_range' or
+        'read_write', the number of bytes copied, 0 for reflinks, the size
+        of the file, and the time taken in seconds.
+    """
+    start = time.monotonic()
+    src_fd = os.open(str(src), os.O_RDONLY)
+    try:
+        src_stat = os.fstat(src_fd)
+        dst_fd = os.open(str(dst), os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                         src_stat.st_mode & 0o777)
+        try:
+            try:
+                fcntl.ioctl(dst_fd, FICLONE, src_fd)
+                (method, copied) = ('reflink', 0)
+            except OSError as error:
+                if error.errno not in _UNSUPPORTED_ERRORS:
+                    raise
+                os.ftruncate(dst_fd, src_stat.st_size)
+                (method, copied) = _copy_data(
+                    src_fd, dst_fd, src_stat.st_size)
+        finally:
+            os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+    return {'method': method,
+            'copied_bytes': copied,
+            'size': src_stat.st_size,
+            'seconds': time.monotonic() - start}
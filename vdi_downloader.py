@@ -2,27 +2,87 @@
 Code for backing up VDIs.
 """
 
-from enum import Enum, unique
-from pathlib import Path
-import shutil
-import subprocess
+from concurrent.futures import ThreadPoolExecutor
+import collections
+import contextlib
+import logging
+import time
 
+from block_size_tuner import BlockSizeTuner
 from cbt_bitmap import CbtBitmap
-from python_nbd_client import PythonNbdClient
+from nbd_pool import ExtentCursor, NbdConnectionPool, open_stripes
+from extent_coalescer import (
+    DEFAULT_BANDWIDTH, DEFAULT_LATENCY, coalesce_extents)
+from hash_manifest import BlockHasher
+from output_sink import BlockWriter, open_sink
+from python_nbd_client import (
+    BASE_ALLOCATION,
+    DEFAULT_MAX_IN_FLIGHT,
+    NBD_REPLY_TYPE_BLOCK_STATUS,
+    NBD_REPLY_TYPE_OFFSET_DATA,
+    NBD_REPLY_TYPE_OFFSET_HOLE,
+    NBD_STATE_ZERO,
+    NBDProtocolError,
+    NBDTransmissionError,
+    is_error_chunk,
+)
+from sparse_file import copy_sparse_file
 
 
-def _copy(src, dst):
-    try:
-        subprocess.check_output(
-            ["cp", "--reflink", str(src), str(dst)])
-    except subprocess.CalledProcessError:
-        shutil.copy(src=str(src), dst=str(dst))
+LOGGER = logging.getLogger('vdi_downloader')
 
+# The length of the ranges queried with one NBD_CMD_BLOCK_STATUS request
+BLOCK_STATUS_QUERY_LENGTH = 1024 * 1024 * 1024
 
-def _get_nbd_info(session, vdi):
+
+def get_nbd_info(session, vdi):
+    """
+    Returns the first of the NBD connection details of the given VDI.
+    """
     return session.xenapi.VDI.get_nbd_info(vdi)[0]
 
 
+class DownloadOptions(object):
+    """
+    How a VdiDownloader writes the received blocks to the output file, and
+    how it tunes its requests.
+
+    sink: one of the keys of output_sink.SINKS.
+    detect_zeroes: leave the received blocks of zeroes as holes.
+    writers, write_queue_size: the number of writer threads, and of the
+        received blocks that may wait for them; 0 writers write each block
+        before receiving the next one.
+    preallocate: allocate the extents to download before downloading them.
+    hash_workers: the number of threads hashing the blocks of the manifest.
+    adaptive_block_size: tune the request size of each connection.
+    coalesce: merge the changed extents separated by small gaps, given the
+        latency (seconds) and bandwidth (bytes per second) of the link, or
+        the ones measured by the previous downloads when they are None.
+    """
+
+    def __init__(self,
+                 sink='buffer_pool',
+                 detect_zeroes=True,
+                 writers=1,
+                 write_queue_size=16,
+                 preallocate=False,
+                 hash_workers=None,
+                 adaptive_block_size=False,
+                 coalesce=True,
+                 latency=None,
+                 bandwidth=None):
+        self.sink = sink
+        self.detect_zeroes = detect_zeroes
+        self.writers = writers
+        self.write_queue_size = write_queue_size
+        self.preallocate = preallocate
+        self.hash_workers = hash_workers
+        self.adaptive_block_size = adaptive_block_size
+        self.coalesce = coalesce
+        self.latency = latency
+        self.bandwidth = bandwidth
+
+
 class VdiDownloader(object):
     """
     Provides a way of backing up the data of a VDI incrementally to a file or
@@ -36,109 +96,440 @@ class VdiDownloader(object):
     # server must be known by Python, see
     # https://github.com/xapi-project/xen-api/issues/2100#issuecomment-361930724
 
-    def __init__(self, session, block_size, use_tls=True):
+    def __init__(self,
+                 session,
+                 block_size,
+                 use_tls=True,
+                 max_in_flight=DEFAULT_MAX_IN_FLIGHT,
+                 structured_reply=True,
+                 map_allocation=True,
+                 connections=1,
+                 pool=None,
+                 stats=None,
+                 hash_blocks=False,
+                 options=None):
+        """
+        At most max_in_flight read requests of block_size bytes are kept
+        outstanding on each of the given number of connections, which are
+        only used together if the server supports multiple connections.
+        If structured_reply is True, the holes reported by the server are
+        not transferred, and if map_allocation is True, full backups only
+        read the extents that base:allocation does not report as zeroes.
+        Connections are taken from the given NbdConnectionPool, or from one
+        private to this downloader. The given TransferStats, if any, collect
+        the requests of all the connections. If hash_blocks is True, the
+        BlockHasher of the last backup is returned by pop_block_hasher.
+        The output and tuning options are given as DownloadOptions.
+        """
+        if options is None:
+            options = DownloadOptions()
         self._session = session
         self._block_size = block_size
         self._use_tls = use_tls
+        self._max_in_flight = max_in_flight
+        self._sink = options.sink
+        self._structured_reply = structured_reply
+        self._map_allocation = map_allocation
+        self._connections = connections
+        if pool is None:
+            pool = NbdConnectionPool(use_tls=use_tls)
+        self._pool = pool
+        self._adaptive_block_size = options.adaptive_block_size
+        self._block_size_reports = []
+        self._stats = stats
+        self._detect_zeroes = options.detect_zeroes
+        self._zero_bytes = 0
+        self._coalesce = options.coalesce
+        self._latency = options.latency
+        self._bandwidth = options.bandwidth
+        self._link_estimate = None
+        self._coalescing_reports = []
+        self._writers = options.writers
+        self._write_queue_size = options.write_queue_size
+        self._preallocate = options.preallocate
+        self._copy_reports = []
+        self._hash_blocks = hash_blocks
+        self._hash_workers = options.hash_workers
+        self._block_hasher = None
+
+    def _timer(self, category):
+        if self._stats is None:
+            return contextlib.nullcontext()
+        return self._stats.timer(category)
 
-    def _nbd_client(self, vdi_nbd_server_info):
+    def _nbd_client(self, vdi_nbd_server_info, meta_contexts=()):
         """
         Connect using the given NBD server details and return the NBD client.
         No manual configuration is needed for TLS, the client will
         automatically use the certificate and server hostname provided by the
         given vdi_nbd_server_info.
+        The given metadata contexts are selected if the server offers them,
+        this requires structured replies.
         """
-        return PythonNbdClient(**vdi_nbd_server_info, use_tls=self._use_tls)
+        with self._timer('connect'):
+            return self._pool.connect_export(
+                vdi_nbd_server_info=vdi_nbd_server_info,
+                structured_reply=self._structured_reply,
+                meta_contexts=meta_contexts,
+                stats=self._stats)
 
-    @unique
-    class _OutputMode(Enum):
+    def pop_block_size_reports(self):
         """
-        Defines how to write the data in the changed blocks to the output file.
+        Returns the block size reports of the connections used since the
+        last call, one dictionary per connection as returned by
+        BlockSizeTuner.report.
         """
-        OVERWRITE = 'r+b'
-        APPEND = 'ab'
+        (reports, self._block_size_reports) = (self._block_size_reports, [])
+        return reports
 
-    def _download_nbd_extents(
-            self, nbd_client, extents, out_file, output_mode):
+    def pop_coalescing_reports(self):
         """
-        Write the given extents to the output file.
+        Returns the reports of the extent coalescing of the incremental
+        backups performed since the last call, see
+        extent_coalescer.coalesce_extents.
         """
-        with Path(out_file).open(output_mode.value) as out:
-            for extent in extents:
-                (offset, length) = extent
-                end = offset + length
-                for current_offset in range(offset, end, self._block_size):
-                    block_length = min(self._block_size, end - current_offset)
-                    data = nbd_client.read(
-                            offset=current_offset, length=block_length)
-                    out.seek(current_offset)
-                    out.write(data)
+        (reports, self._coalescing_reports) = (self._coalescing_reports, [])
+        return reports
+
+    def pop_copy_reports(self):
+        """
+        Returns the reports of the copies of the previous backups made by
+        the incremental backups since the last call, see
+        sparse_file.copy_sparse_file, and forgets them.
+        """
+        (reports, self._copy_reports) = (self._copy_reports, [])
+        return reports
+
+    def pop_block_hasher(self):
+        """
+        Returns the BlockHasher of the last backup, whose blocks it hashed
+        while they were downloaded, or None if hash_blocks is False, and
+        forgets it.
+        """
+        (hasher, self._block_hasher) = (self._block_hasher, None)
+        return hasher
+
+    def pop_zero_bytes(self):
+        """
+        Returns the number of bytes of zero blocks that were received since
+        the last call, and left as holes instead of being written.
+        """
+        (zero_bytes, self._zero_bytes) = (self._zero_bytes, 0)
+        return zero_bytes
+
+    @staticmethod
+    def _write_chunks(sink, chunks):
+        """
+        Writes the data chunks of a structured reply to the sink, and leaves
+        the holes reported by the server sparse.
+        """
+        for chunk in chunks:
+            reply_type = chunk['reply_type']
+            if reply_type == NBD_REPLY_TYPE_OFFSET_DATA:
+                sink.write_data(offset=chunk['offset'], view=chunk['data'])
+                chunk['data'].release()
+            elif reply_type == NBD_REPLY_TYPE_OFFSET_HOLE:
+                sink.hole(offset=chunk['offset'], length=chunk['hole_size'])
+            elif is_error_chunk(reply_type=reply_type):
+                raise NBDTransmissionError(chunk['error'])
+
+    def _write_reply(self, sink, offset, buffer, reply):
+        """
+        Writes a received block to the sink, and releases its buffer.
+        """
+        with self._timer('write'):
+            if isinstance(reply, list):
+                self._write_chunks(sink=sink, chunks=reply)
+                sink.release(buffer)
+            else:
+                sink.commit(offset=offset, view=buffer)
+
+    def _download_blocks(self, nbd_client, cursor, sink, tuner, writer):
+        """
+        Downloads the blocks handed out by the cursor over one connection
+        into the sink, in requests of the size chosen by the tuner. The
+        blocks are requested with pipelined reads, and each one is received
+        straight into a buffer provided by the sink, and handed to the
+        BlockWriter.
+        """
+        # The buffers of the in-flight requests and the time they were sent,
+        # in the order of the requests, which is also the order of the
+        # replies:
+        buffers = collections.deque()
+
+        def _requests():
+            while True:
+                block = cursor.take(tuner.block_size())
+                if block is None:
+                    return
+                (offset, length) = block
+                buffer = sink.get_buffer(offset=offset, length=length)
+                buffers.append((buffer, time.monotonic()))
+                yield (offset, buffer)
+
+        replies = nbd_client.read_into_pipelined(
+            requests=_requests(),
+            max_in_flight=self._max_in_flight)
+        for (offset, reply) in replies:
+            (buffer, sent) = buffers.popleft()
+            tuner.record(
+                length=len(buffer), latency=time.monotonic() - sent)
+            writer.submit(self._write_reply, sink, offset, buffer, reply)
+
+    def _open_stripes(self, stack, vdi_nbd_server_info, nbd_client):
+        """
+        Returns the list of connections to spread the blocks across, see
+        nbd_pool.open_stripes.
+        """
+        return open_stripes(
+            stack=stack,
+            nbd_client=nbd_client,
+            connections=self._connections,
+            connect=lambda: self._nbd_client(vdi_nbd_server_info))
+
+    def _download_nbd_extents(self, nbd_clients, extents, out_file):
+        """
+        Write the given extents to the output file, spreading the blocks
+        across the given connections to the same export. The extents must
+        be iterable more than once if preallocation is enabled.
+        """
+        size = nbd_clients[0].get_size()
+        cursor = ExtentCursor(extents)
+        tuners = [BlockSizeTuner(
+            initial_block_size=self._block_size,
+            constraints=nbd_client.get_block_size_constraints(),
+            adaptive=self._adaptive_block_size)
+                  for nbd_client in nbd_clients]
+        hasher = None
+        if self._hash_blocks:
+            hasher = BlockHasher(size=size, workers=self._hash_workers)
+        self._block_hasher = hasher
+        # The writers are done before the hasher, which is done before the
+        # sink is closed:
+        with open_sink(kind=self._sink,
+                       path=out_file,
+                       size=size,
+                       block_size=self._block_size,
+                       detect_zeroes=self._detect_zeroes,
+                       hasher=hasher) as sink, \
+                hasher or contextlib.nullcontext(), \
+                BlockWriter(writers=self._writers,
+                            queue_size=self._write_queue_size) as writer:
+            if self._preallocate:
+                with self._timer('preallocate'):
+                    sink.preallocate(extents)
+            if len(nbd_clients) == 1:
+                self._download_blocks(
+                    nbd_client=nbd_clients[0],
+                    cursor=cursor,
+                    sink=sink,
+                    tuner=tuners[0],
+                    writer=writer)
+            else:
+                # Each connection takes the next block when it has room for
+                # another request, so that faster connections do more work.
+                # The blocks are written with positional writes, so the order
+                # in which they complete does not matter.
+                def _download(nbd_client, tuner):
+                    try:
+                        self._download_blocks(
+                            nbd_client=nbd_client,
+                            cursor=cursor,
+                            sink=sink,
+                            tuner=tuner,
+                            writer=writer)
+                    except BaseException:
+                        cursor.stop()
+                        raise
+
+                with ThreadPoolExecutor(max_workers=len(nbd_clients)) as pool:
+                    futures = [pool.submit(_download, nbd_client, tuner)
+                               for (nbd_client, tuner)
+                               in zip(nbd_clients, tuners)]
+                for future in futures:
+                    future.result()
+        # Counted once the writers are done
+        self._zero_bytes += sink.zero_bytes
+        self._block_size_reports += [tuner.report() for tuner in tuners]
+        self._update_link_estimate(tuners)
+
+    def _update_link_estimate(self, tuners):
+        """
+        Keeps the latency and the bandwidth measured by the given tuners of
+        connections that were used at the same time: the shortest round trip
+        time, and the sum of their bandwidths.
+        """
+        estimates = [estimate for estimate
+                     in (tuner.link_estimate() for tuner in tuners)
+                     if estimate is not None]
+        if estimates:
+            self._link_estimate = {
+                'latency': min(estimate['latency'] for estimate in estimates),
+                'bandwidth': sum(
+                    estimate['bandwidth'] for estimate in estimates)}
+
+    def _coalesce_extents(self, extents):
+        """
+        Returns the given extents, merged across small gaps if coalescing is
+        enabled.
+        """
+        if not self._coalesce:
+            return extents
+        link = self._link_estimate or {}
+        latency = self._latency
+        if latency is None:
+            latency = link.get('latency', DEFAULT_LATENCY)
+        bandwidth = self._bandwidth
+        if bandwidth is None:
+            bandwidth = link.get('bandwidth', DEFAULT_BANDWIDTH)
+        (extents, report) = coalesce_extents(
+            extents=extents,
+            block_size=self._block_size,
+            latency=latency,
+            bandwidth=bandwidth)
+        self._coalescing_reports.append(report)
+        return extents
 
     def _download_changed_blocks(
             self,
             bitmap,
             vdi_nbd_server_info,
             out_file,
-            output_mode):
+            coalesce=True):
         """
         From the network block device specified by the given connection
         information, downloads the blocks that are marked as changed in
-        the bitmap via NBD, and writes these blocks to the output file.
+        the CbtBitmap via NBD, and writes these blocks to the output file.
+        The changed extents are only merged across small gaps if coalesce is
+        True, see _coalesce_extents.
         """
-        bitmap = CbtBitmap(bitmap)
-        extents = bitmap.get_extents()
-        with self._nbd_client(vdi_nbd_server_info) as nbd_client:
+        extents = bitmap.get_extent_set()
+        if coalesce:
+            extents = self._coalesce_extents(extents)
+        with contextlib.ExitStack() as stack:
+            nbd_client = stack.enter_context(
+                self._nbd_client(vdi_nbd_server_info))
             self._download_nbd_extents(
-                nbd_client=nbd_client,
+                nbd_clients=self._open_stripes(
+                    stack, vdi_nbd_server_info, nbd_client),
                 extents=extents,
-                out_file=out_file,
-                output_mode=output_mode)
+                out_file=out_file)
+
+    @staticmethod
+    def _map_allocated_extents(nbd_client, context_id):
+        """
+        Queries the base:allocation block status of the whole export, and
+        returns the list of the (offset, length) extents that are not known
+        to read as zeroes, with adjacent extents merged.
+        """
+        size = nbd_client.get_size()
+        extents = []
+        offset = 0
+        while offset < size:
+            length = min(BLOCK_STATUS_QUERY_LENGTH, size - offset)
+            chunks = nbd_client.query_block_status(
+                offset=offset, length=length)
+            end = offset
+            for chunk in chunks:
+                if is_error_chunk(reply_type=chunk['reply_type']):
+                    raise NBDTransmissionError(chunk['error'])
+                if chunk['reply_type'] != NBD_REPLY_TYPE_BLOCK_STATUS:
+                    continue
+                if chunk['context_id'] != context_id:
+                    continue
+                for (descriptor_length, flags) in chunk['descriptors']:
+                    # The last descriptor may extend beyond the queried range
+                    descriptor_length = min(
+                        descriptor_length, offset + length - end)
+                    if flags & NBD_STATE_ZERO == 0:
+                        if extents and sum(extents[-1]) == end:
+                            (last_offset, last_length) = extents[-1]
+                            extents[-1] = (
+                                last_offset, last_length + descriptor_length)
+                        else:
+                            extents.append((end, descriptor_length))
+                    end += descriptor_length
+            if end == offset:
+                raise NBDProtocolError(
+                    "No block status reported at offset {}".format(offset))
+            offset = end
+        return extents
 
     def _download_vdi(self, vdi_nbd_server_info, out_file):
         """
         Downloads the network block device specified by the given
         connection information, and writes these blocks to the output file.
+        If possible, only the allocated extents are downloaded.
         """
-        with self._nbd_client(vdi_nbd_server_info) as nbd_client:
+        meta_contexts = [BASE_ALLOCATION] if self._map_allocation else []
+        with contextlib.ExitStack() as stack:
+            nbd_client = stack.enter_context(self._nbd_client(
+                vdi_nbd_server_info, meta_contexts=meta_contexts))
             size = nbd_client.get_size()
+            context_id = nbd_client.get_meta_context_id(BASE_ALLOCATION)
+            if context_id is None:
+                extents = [(0, size)]
+            else:
+                extents = self._map_allocated_extents(
+                    nbd_client=nbd_client, context_id=context_id)
             self._download_nbd_extents(
-                nbd_client=nbd_client,
-                extents=[(0, size)],
-                out_file=out_file,
-                output_mode=self._OutputMode.APPEND)
+                nbd_clients=self._open_stripes(
+                    stack, vdi_nbd_server_info, nbd_client),
+                extents=extents,
+                out_file=out_file)
 
     def incremental_vdi_backup(
             self,
             vdi,
             latest_backup,
-            output_file):
+            output_file,
+            bitmap=None,
+            copy_base=True):
         """
         Downloads the blocks that changed between this VDI and the base VDI
         and constructs a file containing this VDI's data.
         The latest_backup argument should be a tuple (base_vdi, base_vdi_data),
         where base_vdi_data is the file containing the data of base_vdi.
         A lightweight CoW copy of base_vdi_data is performed if possible to
-        reconstruct the this VDI's data, otherwise a full copy is performed.
+        reconstruct the this VDI's data, otherwise its data extents are
+        copied, leaving its holes sparse, see sparse_file.copy_sparse_file.
+        The changed blocks are taken from the given CbtBitmap of the two VDIs
+        if the caller has already fetched it, otherwise they are fetched
+        with VDI.list_changed_blocks.
+        If copy_base is False, base_vdi_data is not copied, and the changed
+        blocks are written into the output file that the caller prepared,
+        for example from the chunk store.
         """
         (vdi_from, vdi_from_backup) = latest_backup
 
-        bitmap = self._session.xenapi.VDI.list_changed_blocks(vdi_from, vdi)
+        if bitmap is None:
+            bitmap = CbtBitmap(
+                self._session.xenapi.VDI.list_changed_blocks(vdi_from, vdi))
 
-        nbd_info = _get_nbd_info(self._session, vdi)
+        nbd_info = get_nbd_info(self._session, vdi)
 
-        _copy(str(vdi_from_backup), str(output_file))
+        reflinked = False
+        if copy_base:
+            with self._timer('copy'):
+                report = copy_sparse_file(vdi_from_backup, output_file)
+            LOGGER.info(
+                "Copied %s to %s: %s", vdi_from_backup, output_file, report)
+            self._copy_reports.append(report)
+            reflinked = report['method'] == 'reflink'
 
+        # The unchanged gaps are not downloaded again into a reflink of the
+        # previous backup, as writing them would unshare their extents:
         self._download_changed_blocks(
             bitmap=bitmap,
             vdi_nbd_server_info=nbd_info,
             out_file=output_file,
-            output_mode=self._OutputMode.OVERWRITE)
+            coalesce=not reflinked)
 
     def full_vdi_backup(self, vdi, output_file):
         """
         Downloads the data of the VDI to the give output file.
         """
-        nbd_info = _get_nbd_info(self._session, vdi)
+        nbd_info = get_nbd_info(self._session, vdi)
         self._download_vdi(
             vdi_nbd_server_info=nbd_info,
             out_file=output_file)
@@ -0,0 +1,251 @@
+"""
+Code for restoring VDIs from backups over NBD.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import collections
+import contextlib
+import logging
+import threading
+
+from block_size_tuner import BlockSizeTuner
+from nbd_pool import ExtentCursor, NbdConnectionPool, open_stripes
+from python_nbd_client import DEFAULT_MAX_IN_FLIGHT
+from sparse_file import FileReader, zero_runs
+
+LOGGER = logging.getLogger('vdi_uploader')
+
+# The length of the ranges zeroed with one NBD_CMD_WRITE_ZEROES request
+WRITE_ZEROES_LENGTH = 1024 * 1024 * 1024
+
+
+class VdiUploader(object):
+    """
+    Writes the data of backed up VDIs into VDIs over NBD, which is much
+    faster than uploading them with a single HTTP PUT request.
+    """
+
+    def __init__(self,
+                 session,
+                 block_size,
+                 use_tls=True,
+                 max_in_flight=DEFAULT_MAX_IN_FLIGHT,
+                 connections=1,
+                 pool=None,
+                 sparse=True):
+        """
+        The max_in_flight argument sets the number of NBD write requests of
+        block_size bytes that are kept outstanding at the same time on a
+        connection, and the connections argument the number of connections
+        that the blocks are spread across, if the server supports multiple
+        connections to the same export. Requests never exceed the maximum
+        block size of the server.
+        Connections are taken from the given NbdConnectionPool, which can be
+        shared with a VdiDownloader, by default a pool private to this
+        uploader is used.
+        If sparse is True, only the data of the input file is written: its
+        holes, found with SEEK_DATA and SEEK_HOLE, and the blocks of its
+        data that only contain zeroes are zeroed with NBD_CMD_WRITE_ZEROES
+        if the server supports it, or skipped altogether if the VDI is known
+        to be zeroed already, so that the time of a restore depends on the
+        amount of data, not the size of the VDI.
+        """
+        self._session = session
+        self._block_size = block_size
+        self._max_in_flight = max_in_flight
+        self._connections = connections
+        if pool is None:
+            pool = NbdConnectionPool(use_tls=use_tls)
+        self._pool = pool
+        self._sparse = sparse
+
+    def _nbd_client(self, vdi_nbd_server_info):
+        """
+        Connects to the VDI's export using the given NBD server details, and
+        returns the NBD client.
+        """
+        return self._pool.connect_export(vdi_nbd_server_info)
+
+    def _upload_blocks(self, nbd_client, cursors, reader, counts):
+        """
+        Writes the blocks handed out by the cursors to the export over one
+        connection, with pipelined requests: the blocks of the data cursor
+        are read from the input reader into a pool of reused buffers, and the
+        zero blocks found in them are not written as data, and the blocks of
+        the zero cursor, if any, are zeroed with NBD_CMD_WRITE_ZEROES.
+        The number of bytes written, zeroed and skipped are added to counts.
+        """
+        (data_cursor, zero_cursor) = cursors
+        block_size = BlockSizeTuner(
+            initial_block_size=self._block_size,
+            constraints=nbd_client.get_block_size_constraints(),
+            adaptive=False).block_size()
+        write_zeroes = nbd_client.can_write_zeroes()
+        free = []
+        # buffer -> number of its in-flight write requests:
+        pending = {}
+        local_counts = collections.Counter()
+
+        def _zero_requests(offset, length):
+            if write_zeroes:
+                local_counts['zeroed'] += length
+                yield (offset, length)
+                return
+            # Fall back to writing the zeroes as data
+            local_counts['written'] += length
+            end = offset + length
+            while offset < end:
+                chunk = min(block_size, end - offset)
+                yield (offset, bytes(chunk))
+                offset += chunk
+
+        def _requests():
+            while zero_cursor is not None:
+                block = zero_cursor.take(WRITE_ZEROES_LENGTH)
+                if block is None:
+                    break
+                yield from _zero_requests(*block)
+            while True:
+                block = data_cursor.take(block_size)
+                if block is None:
+                    return
+                (offset, length) = block
+                buffer = free.pop() if free else bytearray(block_size)
+                view = memoryview(buffer)[:length]
+                reader.pread_into(view, offset)
+                if not self._sparse:
+                    local_counts['written'] += length
+                    pending[id(buffer)] = 1
+                    yield (offset, view)
+                    continue
+                pieces = []
+                for (start, run_length, run_is_zero) in zero_runs(view):
+                    if not run_is_zero:
+                        local_counts['written'] += run_length
+                        pieces.append((offset + start,
+                                       view[start:start + run_length]))
+                    elif zero_cursor is None:
+                        local_counts['skipped'] += run_length
+                    else:
+                        pieces.extend(
+                            _zero_requests(offset + start, run_length))
+                data_pieces = sum(1 for (_, data) in pieces
+                                  if isinstance(data, memoryview))
+                if data_pieces == 0:
+                    free.append(buffer)
+                else:
+                    pending[id(buffer)] = data_pieces
+                yield from pieces
+
+        for (_, data) in nbd_client.write_pipelined(
+                requests=_requests(),
+                max_in_flight=self._max_in_flight):
+            if not isinstance(data, memoryview):
+                continue
+            buffer = data.obj
+            pending[id(buffer)] -= 1
+            if pending[id(buffer)] == 0:
+                del pending[id(buffer)]
+                free.append(buffer)
+        with counts[1]:
+            counts[0].update(local_counts)
+
+    def _upload_extents(self, nbd_clients, extents, holes, reader):
+        """
+        Writes the given extents of the input file to the export, and zeroes
+        the given holes if it is not None, spreading the blocks across the
+        given connections to the same export.
+        Returns the number of bytes written, zeroed and skipped.
+        """
+        cursors = (ExtentCursor(extents),
+                   None if holes is None else ExtentCursor(holes))
+        counts = (collections.Counter(), threading.Lock())
+        if len(nbd_clients) == 1:
+            self._upload_blocks(
+                nbd_client=nbd_clients[0], cursors=cursors, reader=reader,
+                counts=counts)
+            return counts[0]
+
+        def _upload(nbd_client):
+            try:
+                self._upload_blocks(
+                    nbd_client=nbd_client, cursors=cursors, reader=reader,
+                    counts=counts)
+            except BaseException:
+                for cursor in cursors:
+                    if cursor is not None:
+                        cursor.stop()
+                raise
+
+        with ThreadPoolExecutor(max_workers=len(nbd_clients)) as pool:
+            futures = [pool.submit(_upload, nbd_client)
+                       for nbd_client in nbd_clients]
+        for future in futures:
+            future.result()
+        return counts[0]
+
+    def _open_stripes(self, stack, vdi_nbd_server_info, nbd_client):
+        """
+        Returns the list of connections to spread the blocks across, see
+        nbd_pool.open_stripes. The writes of all the connections are flushed
+        through the given one.
+        """
+        return open_stripes(
+            stack=stack,
+            nbd_client=nbd_client,
+            connections=self._connections,
+            connect=lambda: self._nbd_client(vdi_nbd_server_info))
+
+    def _upload_vdi(self, vdi_nbd_server_info, in_file, zeroed):
+        with contextlib.ExitStack() as stack:
+            nbd_client = stack.enter_context(
+                self._nbd_client(vdi_nbd_server_info))
+            reader = in_file
+            if not hasattr(reader, 'pread_into'):
+                reader = stack.enter_context(FileReader(in_file))
+            size = min(reader.size, nbd_client.get_size())
+            if self._sparse:
+                extents = []
+                holes = []
+                for (offset, length, is_data) in reader.extents(0, size):
+                    (extents if is_data else holes).append((offset, length))
+            else:
+                (extents, holes) = ([(0, size)], [])
+            if zeroed:
+                skipped = sum(length for (_, length) in holes)
+                holes = None
+            counts = self._upload_extents(
+                nbd_clients=self._open_stripes(
+                    stack, vdi_nbd_server_info, nbd_client),
+                extents=extents,
+                holes=holes,
+                reader=reader)
+            if zeroed:
+                counts['skipped'] += skipped
+            # All the writes have been acknowledged, a single flush makes
+            # the writes of every connection durable:
+            nbd_client.flush()
+        return {'written': counts['written'],
+                'zeroed': counts['zeroed'],
+                'skipped': counts['skipped']}
+
+    def upload(self, vdi, input_file, zeroed=False):
+        """
+        Writes the data of the given file into the VDI, which must be at
+        least as large as the file. Instead of a file, a reader with the
+        methods of sparse_file.FileReader can be given, such as a
+        chunk_store.ChunkMapReader. If zeroed is True, the VDI is known to
+        read as zeroes, like a newly created VDI, and the zeroes of a sparse
+        input file are not written at all.
+        Returns the number of bytes written as data, zeroed and skipped in a
+        dictionary, or None without writing anything if the VDI is not
+        exported over NBD, for example because no network of its host has
+        NBD enabled.
+        """
+        nbd_infos = self._session.xenapi.VDI.get_nbd_info(vdi)
+        if not nbd_infos:
+            return None
+        return self._upload_vdi(
+            vdi_nbd_server_info=nbd_infos[0],
+            in_file=input_file,
+            zeroed=zeroed)
@@ -0,0 +1,257 @@
+"""
+Encodes sparse raw image files as dynamic VHD images on the fly, for
+uploading them with import_raw_vdi format=vhd, so that only the allocated
+blocks of the image are sent.
+
+The layout of a dynamic VHD is described in the Virtual Hard Disk Image
+Format Specification: a copy of the footer, the dynamic disk header, the
+block allocation table (BAT), the allocated blocks, each preceded by its
+sector bitmap, and the footer.
+"""
+
+from array import array
+import os
+import struct
+import sys
+import time
+import uuid
+
+from cbt_bitmap import set_bits
+from sparse_file import file_extents
+
+SECTOR_SIZE = 512
+
+# The default, and most widely supported, size of the blocks of a dynamic VHD
+VHD_BLOCK_SIZE = 2 * 1024 * 1024
+
+FOOTER_SIZE = 512
+DYNAMIC_HEADER_SIZE = 1024
+
+# The offsets of the checksums of the footer and of the dynamic disk header
+FOOTER_CHECKSUM_OFFSET = 64
+DYNAMIC_HEADER_CHECKSUM_OFFSET = 36
+
+# The BAT entry of blocks that are not allocated
+BAT_UNUSED = 0xFFFFFFFF
+
+DISK_TYPE_DYNAMIC = 3
+
+# VHD timestamps count the seconds since 2000-01-01 00:00:00 UTC
+_VHD_EPOCH = 946684800
+
+# The data of the blocks is read and yielded in chunks of this size
+_CHUNK_SIZE = 1024 * 1024
+
+
+def _round_up(value, multiple):
+    return -(-value // multiple) * multiple
+
+
+def _checksum(data):
+    return ~sum(data) & 0xFFFFFFFF
+
+
+def has_valid_checksum(structure, offset):
+    """
+    Returns True if the given footer or dynamic disk header holds the right
+    checksum at the given offset.
+    """
+    data = bytearray(structure)
+    (checksum,) = struct.unpack_from('>L', data, offset)
+    struct.pack_into('>L', data, offset, 0)
+    return checksum == _checksum(data)
+
+
+def _geometry(size):
+    """
+    Returns the (cylinders, heads, sectors per track) disk geometry of an
+    image of the given size, computed as described in the specification.
+    """
+    total_sectors = min(size // SECTOR_SIZE, 65535 * 16 * 255)
+    if total_sectors >= 65535 * 16 * 63:
+        sectors_per_track = 255
+        heads = 16
+        cylinder_times_heads = total_sectors // sectors_per_track
+    else:
+        sectors_per_track = 17
+        cylinder_times_heads = total_sectors // sectors_per_track
+        heads = max((cylinder_times_heads + 1023) // 1024, 4)
+        if cylinder_times_heads >= heads * 1024 or heads > 16:
+            sectors_per_track = 31
+            heads = 16
+            cylinder_times_heads = total_sectors // sectors_per_track
+        if cylinder_times_heads >= heads * 1024:
+            sectors_per_track = 63
+            heads = 16
+            cylinder_times_heads = total_sectors // sectors_per_track
+    return (cylinder_times_heads // heads, heads, sectors_per_track)
+
+
+def _footer(size, timestamp, unique_id):
+    (cylinders, heads, sectors_per_track) = _geometry(size)
+    fields = struct.pack(
+        '>8sLLQL4sL4sQQHBBLL16sB',
+        b'conectix',
+        # Features: reserved bit, always set
+        0x00000002,
+        # File format version
+        0x00010000,
+        # Data offset: the dynamic disk header follows the copy of the footer
+        FOOTER_SIZE,
+        timestamp,
+        b'pyvh',
+        0x00010000,
+        b'Wi2k',
+        # Original size and current size
+        size,
+        size,
+        cylinders,
+        heads,
+        sectors_per_track,
+        DISK_TYPE_DYNAMIC,
+        0,
+        unique_id,
+        # Saved state
+        0)
+    footer = bytearray(fields.ljust(FOOTER_SIZE, b'\0'))
+    struct.pack_into('>L', footer, FOOTER_CHECKSUM_OFFSET, _checksum(footer))
+    return bytes(footer)
+
+
+def _dynamic_header(table_offset, max_table_entries, block_size):
+    fields = struct.pack(
+        '>8sQQLLLL',
+        b'cxsparse',
+        # Data offset: unused
+        0xFFFFFFFFFFFFFFFF,
+        table_offset,
+        # Header version
+        0x00010000,
+        max_table_entries,
+        block_size,
+        0)
+    # The parent fields are all zero, this is not a differencing disk
+    header = bytearray(fields.ljust(DYNAMIC_HEADER_SIZE, b'\0'))
+    struct.pack_into(
+        '>L', header, DYNAMIC_HEADER_CHECKSUM_OFFSET, _checksum(header))
+    return bytes(header)
+
+
+class DynamicVhdStream(object):
+    """
+    A dynamic VHD encoding of a sparse raw image file, generated while it is
+    being read: iterating over it yields the consecutive chunks of the VHD,
+    and its length is the size of the VHD. It can be passed as the data of a
+    requests PUT, which then sends it with a Content-Length header.
+
+    Only the blocks that contain data, as reported by SEEK_DATA and
+    SEEK_HOLE, are allocated, and the sector bitmap of each block marks the
+    sectors that contain data. Only the BAT, which takes 4 bytes per block,
+    is kept in memory.
+    """
+
+    def __init__(self, path, block_size=VHD_BLOCK_SIZE):
+        self._path = str(path)
+        self._block_size = block_size
+        self._sectors_per_block = block_size // SECTOR_SIZE
+        self._bitmap_size = _round_up(self._sectors_per_block // 8,
+                                      SECTOR_SIZE)
+        fd = os.open(self._path, os.O_RDONLY)
+        try:
+            self._size = _round_up(os.fstat(fd).st_size, SECTOR_SIZE)
+            # The data extents, in sectors:
+            self._extents = [
+                (offset // SECTOR_SIZE,
+                 _round_up(offset + length, SECTOR_SIZE) // SECTOR_SIZE)
+                for (offset, length, is_data)
+                in file_extents(fd, 0, self._size) if is_data]
+        finally:
+            os.close(fd)
+        self._max_table_entries = -(-self._size // block_size)
+        self._table_offset = FOOTER_SIZE + DYNAMIC_HEADER_SIZE
+        table_size = _round_up(self._max_table_entries * 4, SECTOR_SIZE)
+        # The allocated blocks follow the BAT, in the order of their index
+        self._bat = array('I', [BAT_UNUSED]) * self._max_table_entries
+        sector = (self._table_offset + table_size) // SECTOR_SIZE
+        block_sectors = (self._bitmap_size + block_size) // SECTOR_SIZE
+        for block in self._allocated_blocks():
+            self._bat[block] = sector
+            sector += block_sectors
+        self._length = sector * SECTOR_SIZE + FOOTER_SIZE
+        self._table_size = table_size
+        timestamp = int(time.time()) - _VHD_EPOCH
+        self._footer = _footer(
+            size=self._size,
+            timestamp=timestamp,
+            unique_id=uuid.uuid4().bytes)
+
+    def _allocated_blocks(self):
+        """
+        Returns the sorted list of the indexes of the blocks that contain
+        data.
+        """
+        blocks = []
+        for (start, end) in self._extents:
+            first = start // self._sectors_per_block
+            last = (end - 1) // self._sectors_per_block
+            if blocks and blocks[-1] >= first:
+                first = blocks[-1] + 1
+            blocks.extend(range(first, last + 1))
+        return blocks
+
+    def _bitmaps(self):
+        """
+        Yields the sector bitmap of each allocated block, in the order of
+        their index, in which the bits of the sectors that contain data are
+        set.
+        """
+        extents = iter(self._extents)
+        extent = next(extents, None)
+        for (block, sector) in enumerate(self._bat):
+            if sector == BAT_UNUSED:
+                continue
+            bitmap = bytearray(self._bitmap_size)
+            first_sector = block * self._sectors_per_block
+            last_sector = first_sector + self._sectors_per_block
+            while extent is not None and extent[0] < last_sector:
+                (start, end) = extent
+                set_bits(bitmap,
+                         max(start, first_sector) - first_sector,
+                         min(end, last_sector) - first_sector)
+                if end > last_sector:
+                    # The extent continues in the next block
+                    break
+                extent = next(extents, None)
+            yield bytes(bitmap)
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        yield self._footer
+        yield _dynamic_header(
+            table_offset=self._table_offset,
+            max_table_entries=self._max_table_entries,
+            block_size=self._block_size)
+        table = array('I', self._bat)
+        if sys.byteorder == 'little':
+            table.byteswap()
+        yield table.tobytes().ljust(self._table_size, b'\xff')
+        bitmaps = self._bitmaps()
+        fd = os.open(self._path, os.O_RDONLY)
+        try:
+            for (block, sector) in enumerate(self._bat):
+                if sector == BAT_UNUSED:
+                    continue
+                yield next(bitmaps)
+                offset = block * self._block_size
+                end = offset + self._block_size
+                while offset < end:
+                    length = min(_CHUNK_SIZE, end - offset)
+                    data = os.pread(fd, length, offset)
+                    # The last block is padded with zeroes
+                    yield data.ljust(length, b'\0')
+                    offset += length
+        finally:
+            os.close(fd)
+        yield self._footer